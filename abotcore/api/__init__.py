@@ -1 +1,22 @@
-from .client import AsyncClient, RasaRestClient, RasaActionsClient, LangcornRestClient
+from .client import (
+    AsyncClient,
+    Upstream,
+    ClientPool,
+    RasaRestClient,
+    RasaActionsClient,
+    LangcornRestClient,
+    FulfillmentClient,
+    get_client_pool,
+    get_rasa_client,
+    get_langcorn_client,
+    get_actions_client,
+    get_fulfillment_client,
+)
+from .balancer import ROUTE_KEY, BalancingTransport
+from .hedging import (
+    LatencyTracker,
+    RequestPolicy,
+    RetryBudget,
+    get_langcorn_policy,
+    get_retry_budget,
+)
@@ -0,0 +1,155 @@
+"""Client-side load balancing of an upstream with several replicas.
+
+`BalancingTransport` is an httpx transport that sends each request to one of
+the replicas: the one with the fewest outstanding requests or, for sticky
+upstreams, the replica that the request's route key (e.g. sender id) hashes to.
+Replicas that fail repeatedly are ejected for a while (passive health check).
+"""
+
+import hashlib
+import logging
+import random
+import time
+from typing import AsyncIterator, Callable, List, Optional, Sequence
+
+import httpx
+
+LOGGER = logging.getLogger(__name__)
+
+ROUTE_KEY = "route_key"
+"""Request extension with the key of sticky routing, e.g. `client.post(..., extensions={ROUTE_KEY: sender_id})`"""
+
+
+class Replica:
+    def __init__(self, url: str, transport: httpx.AsyncBaseTransport):
+        self.url = httpx.URL(url)
+        self.transport = transport
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def is_available(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def weight(self, key: str) -> bytes:
+        """Rendezvous hash of the key on this replica"""
+        return hashlib.md5(("%s|%s" % (key, self.url)).encode()).digest()
+
+
+class _ReplicaStream(httpx.AsyncByteStream):
+    """Response body, that keeps the request outstanding until it's closed"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close: Callable[[bool], None]):
+        self._stream = stream
+        self._on_close = on_close
+        self._failed = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        except httpx.TransportError:
+            self._failed = True
+            raise
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close(self._failed)
+
+
+class BalancingTransport(httpx.AsyncBaseTransport):
+    def __init__(
+        self,
+        endpoints: Sequence[str],
+        sticky: bool = False,
+        max_failures: int = 3,
+        ejection_time: float = 30,
+        transport_factory: Callable[[], httpx.AsyncBaseTransport] = httpx.AsyncHTTPTransport,
+    ):
+        self.replicas = [Replica(url, transport_factory()) for url in endpoints]
+        self.sticky = sticky
+        self.max_failures = max_failures
+        self.ejection_time = ejection_time
+
+    def pick(self, route_key: Optional[str] = None, exclude: Sequence[Replica] = ()) -> Replica:
+        now = time.monotonic()
+        candidates = [replica for replica in self.replicas if replica not in exclude]
+        available = [replica for replica in candidates if replica.is_available(now)]
+        if not available:
+            # All are ejected: try the one that comes back first
+            return min(candidates, key=lambda replica: replica.ejected_until)
+        if self.sticky and route_key is not None:
+            return max(available, key=lambda replica: replica.weight(route_key))
+        return min(available, key=lambda replica: (replica.outstanding, random.random()))
+
+    def _record(self, replica: Replica, failed: bool):
+        if not failed:
+            replica.failures = 0
+            return
+        replica.failures += 1
+        if replica.failures >= self.max_failures and replica.is_available(time.monotonic()):
+            LOGGER.warning(
+                "Ejecting upstream replica %s for %ss after %d failures",
+                replica.url, self.ejection_time, replica.failures,
+            )
+            replica.ejected_until = time.monotonic() + self.ejection_time
+
+    def _release(self, replica: Replica) -> Callable[[bool], None]:
+        def _on_close(failed: bool):
+            replica.outstanding -= 1
+            if failed:
+                self._record(replica, True)
+
+        return _on_close
+
+    @staticmethod
+    def _route(request: httpx.Request, replica: Replica, raw_path: bytes):
+        request.url = request.url.copy_with(
+            scheme=replica.url.scheme,
+            host=replica.url.host,
+            port=replica.url.port,
+            raw_path=replica.url.raw_path.rstrip(b"/") + raw_path,
+        )
+        request.headers["Host"] = replica.url.netloc.decode("ascii")
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        raw_path = request.url.raw_path
+        route_key = request.extensions.get(ROUTE_KEY)
+        tried: List[Replica] = []
+        while True:
+            replica = self.pick(route_key, exclude=tried)
+            tried.append(replica)
+            self._route(request, replica, raw_path)
+
+            replica.outstanding += 1
+            try:
+                response = await replica.transport.handle_async_request(request)
+            except httpx.ConnectError:
+                replica.outstanding -= 1
+                self._record(replica, True)
+                # Nothing was sent, so another replica can take the request
+                if len(tried) < len(self.replicas):
+                    continue
+                raise
+            except BaseException as e:
+                replica.outstanding -= 1
+                # Not when cancelled (e.g. a hedge that lost), that says nothing of the replica
+                if isinstance(e, httpx.TransportError):
+                    self._record(replica, True)
+                raise
+
+            self._record(replica, response.status_code >= 500)
+            return httpx.Response(
+                status_code=response.status_code,
+                headers=response.headers,
+                stream=_ReplicaStream(response.stream, self._release(replica)),
+                extensions=response.extensions,
+            )
+
+    async def aclose(self):
+        for replica in self.replicas:
+            await replica.transport.aclose()
@@ -1,18 +1,152 @@
-from httpx import AsyncClient
+"""HTTP clients for the upstream services (Rasa, Langcorn, actions, fulfillments)"""
 
+import asyncio
+from enum import Enum
+from functools import lru_cache
+from typing import Dict, List, Optional, Union
+
+from httpx import AsyncClient, AsyncHTTPTransport, Limits
+
+from .balancer import BalancingTransport
 from .config import get_endpoint_settings
 
 
+class Upstream(str, Enum):
+    RASA = "rasa"
+    LANGCORN = "langcorn"
+    ACTIONS = "actions"
+    FULFILLMENT = "fulfillment"
+
+
+def _pool_limits() -> Limits:
+    settings = get_endpoint_settings()
+    return Limits(
+        max_connections=settings.http_pool_max_connections,
+        max_keepalive_connections=settings.http_pool_max_keepalive_connections,
+        keepalive_expiry=settings.http_pool_keepalive_expiry,
+    )
+
+
+def _replicated_client(
+    name: str, endpoints: Union[str, List[str]], sticky: bool = False, **kwargs
+) -> AsyncClient:
+    """Client of one endpoint, or of all replicas (load balanced) if there are several"""
+    if isinstance(endpoints, list) and len(endpoints) == 1:
+        endpoints = endpoints[0]
+    if not isinstance(endpoints, list):
+        return AsyncClient(base_url=endpoints, limits=_pool_limits(), **kwargs)
+
+    settings = get_endpoint_settings()
+    transport = BalancingTransport(
+        endpoints,
+        sticky=sticky,
+        max_failures=settings.upstream_max_failures,
+        ejection_time=settings.upstream_ejection_time,
+        transport_factory=lambda: AsyncHTTPTransport(limits=_pool_limits()),
+    )
+    # Host of the requests is replaced by the selected replica's
+    return AsyncClient(base_url="http://%s" % name, transport=transport, **kwargs)
+
+
 def RasaRestClient(**kwargs) -> AsyncClient:
     settings = get_endpoint_settings()
-    return AsyncClient(base_url=settings.rasa_rest_endpoint_base, timeout=30, **kwargs)
+    # Conversation trackers are per replica, so a sender stays on the same one
+    return _replicated_client(
+        "rasa",
+        settings.rasa_rest_endpoint_base,
+        sticky=True,
+        timeout=settings.rasa_timeout,
+        **kwargs
+    )
 
 
 def LangcornRestClient(**kwargs) -> AsyncClient:
     settings = get_endpoint_settings()
-    return AsyncClient(base_url=settings.langcorn_endpoint_base, timeout=90, **kwargs)
+    return _replicated_client(
+        "langcorn",
+        settings.langcorn_endpoint_base,
+        timeout=settings.langcorn_timeout,
+        **kwargs
+    )
 
 
 def RasaActionsClient(**kwargs) -> AsyncClient:
     settings = get_endpoint_settings()
-    return AsyncClient(base_url=settings.actions_endpoint_base, timeout=30, **kwargs)
+    return AsyncClient(
+        base_url=settings.actions_endpoint_base,
+        timeout=settings.actions_timeout,
+        limits=_pool_limits(),
+        **kwargs
+    )
+
+
+def FulfillmentClient(**kwargs) -> AsyncClient:
+    settings = get_endpoint_settings()
+    return AsyncClient(
+        timeout=settings.fulfillment_timeout, limits=_pool_limits(), **kwargs
+    )
+
+
+UPSTREAM_CLIENT_MAP = {
+    Upstream.RASA: RasaRestClient,
+    Upstream.LANGCORN: LangcornRestClient,
+    Upstream.ACTIONS: RasaActionsClient,
+    Upstream.FULFILLMENT: FulfillmentClient,
+}
+
+
+class ClientPool:
+    """Long-lived clients, one connection pool per upstream.
+    Opened at application startup and closed at shutdown. Users of these clients
+    must not close them (no `async with`)."""
+
+    def __init__(self):
+        self._clients: Dict[Upstream, AsyncClient] = {}
+        # Fulfillments have a pool each, so a slow one doesn't hold the connections of others
+        self._fulfillment_clients: Dict[str, AsyncClient] = {}
+
+    def get(self, upstream: Upstream) -> AsyncClient:
+        client = self._clients.get(upstream)
+        if client is None or client.is_closed:
+            # Created lazily as well, in case the app was not started with lifespan events
+            client = self._clients[upstream] = UPSTREAM_CLIENT_MAP[upstream]()
+        return client
+
+    def get_fulfillment(self, base_url: str) -> AsyncClient:
+        client = self._fulfillment_clients.get(base_url)
+        if client is None or client.is_closed:
+            client = self._fulfillment_clients[base_url] = FulfillmentClient()
+        return client
+
+    def open(self):
+        for upstream in Upstream:
+            self.get(upstream)
+
+    async def aclose(self):
+        clients = list(self._clients.values()) + list(self._fulfillment_clients.values())
+        self._clients, self._fulfillment_clients = {}, {}
+        await asyncio.gather(*[client.aclose() for client in clients])
+
+
+@lru_cache()
+def get_client_pool() -> ClientPool:
+    return ClientPool()
+
+
+def get_rasa_client() -> AsyncClient:
+    return get_client_pool().get(Upstream.RASA)
+
+
+def get_langcorn_client() -> AsyncClient:
+    return get_client_pool().get(Upstream.LANGCORN)
+
+
+def get_actions_client() -> AsyncClient:
+    return get_client_pool().get(Upstream.ACTIONS)
+
+
+def get_fulfillment_client(base_url: Optional[str] = None) -> AsyncClient:
+    """Client of the fulfillment at the base URL (or the shared one, for any URL)"""
+    if base_url is None:
+        return get_client_pool().get(Upstream.FULFILLMENT)
+    return get_client_pool().get_fulfillment(base_url)
@@ -0,0 +1,189 @@
+"""Hedged requests and retries, limited by a retry budget.
+
+A hedge is a second copy of a slow request: when the request hasn't been
+answered after the usual (e.g. 95th percentile) latency, it's sent again and
+the first answer is used. Failed requests are retried. Both hedges and retries
+take from a retry budget that is shared by all upstreams, so they can add only
+a fraction of extra load, even when the upstream is overloaded.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from functools import lru_cache
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set, Union
+
+import httpx
+
+from .config import get_endpoint_settings
+
+LOGGER = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = (502, 503, 504)
+# Failures that are retried (the request didn't reach, or wasn't handled by the upstream).
+# Not broken connections (e.g. RemoteProtocolError): the upstream may have handled the request,
+# and handling it again could repeat its side effects
+RETRY_ERRORS = (httpx.ConnectError, httpx.Response)
+
+
+class RetryBudget:
+    """Each request adds `ratio` retries to the budget, and `min_per_second` are added over time
+    (so there are some at low traffic). The budget holds at most `max_tokens` retries."""
+
+    def __init__(self, ratio: float = 0.1, min_per_second: float = 1, max_tokens: float = 10):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+
+    def _refill(self, amount: float = 0):
+        now = time.monotonic()
+        self._tokens = min(
+            self.max_tokens,
+            self._tokens + (now - self._updated) * self.min_per_second + amount,
+        )
+        self._updated = now
+
+    def deposit(self):
+        self._refill(self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class LatencyTracker:
+    """Latencies of the most recent successful requests"""
+
+    def __init__(self, window: int = 1000):
+        self._latencies: Deque[float] = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def record(self, latency: float):
+        self._latencies.append(latency)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+class RequestPolicy:
+    """Sends requests with hedging (opt-in) and retries. Latencies are tracked per key
+    (e.g. path), as different endpoints of the same upstream can have very different latencies."""
+
+    def __init__(
+        self,
+        budget: RetryBudget,
+        hedging: bool = False,
+        hedge_quantile: float = 0.95,
+        hedge_min_delay: float = 1,
+        hedge_min_samples: int = 20,
+        max_retries: int = 1,
+    ):
+        self.budget = budget
+        self.hedging = hedging
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.max_retries = max_retries
+        self._latencies: Dict[str, LatencyTracker] = {}
+
+    def latencies(self, key: str) -> LatencyTracker:
+        tracker = self._latencies.get(key)
+        if tracker is None:
+            tracker = self._latencies[key] = LatencyTracker()
+        return tracker
+
+    def hedge_delay(self, key: str) -> Optional[float]:
+        """Seconds after which the request is hedged (the minimum delay until there are enough samples)"""
+        if not self.hedging:
+            return None
+        tracker = self.latencies(key)
+        if len(tracker) < self.hedge_min_samples:
+            return self.hedge_min_delay
+        return max(self.hedge_min_delay, tracker.quantile(self.hedge_quantile))
+
+    async def send(
+        self, key: str, request: Callable[[], Awaitable[httpx.Response]]
+    ) -> httpx.Response:
+        """Response of the first successful copy of the request. Other copies are cancelled.
+        `request` must be safe to send more than once."""
+        self.budget.deposit()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        delay = self.hedge_delay(key)
+        retries = 0
+        # Last failed response, or exception
+        failure: Union[httpx.Response, Exception, None] = None
+        pending: Set[asyncio.Task] = {asyncio.ensure_future(request())}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=None if delay is None else max(0, started + delay - loop.time()),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    # Hedge (once), if the budget allows it
+                    delay = None
+                    if self.budget.withdraw():
+                        LOGGER.debug("Hedging request to %s", key)
+                        pending.add(asyncio.ensure_future(request()))
+                    continue
+
+                for task in done:
+                    try:
+                        response = task.result()
+                        if response.status_code not in RETRY_STATUS_CODES:
+                            self.latencies(key).record(loop.time() - started)
+                            return response
+                        failure = response
+                    except httpx.TransportError as e:
+                        # Other copies may still succeed
+                        failure = e
+
+                if (
+                    not pending
+                    and isinstance(failure, RETRY_ERRORS)
+                    and retries < self.max_retries
+                    and self.budget.withdraw()
+                ):
+                    retries += 1
+                    LOGGER.info("Retrying request to %s after: %s", key, failure)
+                    pending.add(asyncio.ensure_future(request()))
+            if isinstance(failure, httpx.Response):
+                return failure
+            raise failure
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+@lru_cache()
+def get_retry_budget() -> RetryBudget:
+    settings = get_endpoint_settings()
+    return RetryBudget(
+        ratio=settings.retry_budget_ratio,
+        min_per_second=settings.retry_budget_min_per_second,
+    )
+
+
+@lru_cache()
+def get_langcorn_policy() -> RequestPolicy:
+    settings = get_endpoint_settings()
+    return RequestPolicy(
+        get_retry_budget(),
+        hedging=settings.langcorn_hedging,
+        hedge_quantile=settings.langcorn_hedge_quantile,
+        hedge_min_delay=settings.langcorn_hedge_min_delay,
+        max_retries=settings.langcorn_max_retries,
+    )
@@ -0,0 +1,98 @@
+"""In-process LRU cache with entry/size budget and expiry"""
+
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """Least-recently-used cache, bounded by number of entries and/or total size.
+    Entries older than `ttl` seconds are treated as missing.
+    Size of each value is given by `sizeof` (or on `put`), and is 0 if neither is set."""
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+        sizeof: Optional[Callable[[V], int]] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+
+        # key -> (value, size, time stored)
+        self._data: "OrderedDict[K, Tuple[V, int, float]]" = OrderedDict()
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return self._lookup(key) is not None
+
+    def _lookup(self, key: K) -> Optional[Tuple[V, int, float]]:
+        item = self._data.get(key)
+        if item is not None and self.ttl is not None and time.monotonic() - item[2] > self.ttl:
+            self.pop(key)
+            return None
+        return item
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        item = self._lookup(key)
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return item[0]
+
+    def put(self, key: K, value: V, size: Optional[int] = None):
+        if size is None:
+            size = self.sizeof(value) if self.sizeof is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Would evict everything else and still not fit
+            self.pop(key)
+            return
+
+        self.pop(key)
+        self._data[key] = (value, size, time.monotonic())
+        self.total_bytes += size
+        self._evict()
+
+    def pop(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        self.total_bytes -= item[1]
+        return item[0]
+
+    def clear(self):
+        self._data.clear()
+        self.total_bytes = 0
+
+    def _evict(self):
+        while self._data and (
+            (self.max_entries is not None and len(self._data) > self.max_entries)
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            _, (_, size, _) = self._data.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._data),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
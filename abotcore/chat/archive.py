@@ -0,0 +1,437 @@
+"""Partitioning and archival of chat history.
+
+On PostgreSQL, chat_history is partitioned by month of `message_time`, so old
+months can be dropped without bloating the table. Months older than the
+retention are written to Parquet files in the archive directory, and removed
+from the table: by dropping the month's partition, or by deleting its rows where
+the table isn't partitioned (SQLite, or a table created before partitioning).
+Archived messages are still read by the history API (`HistoryArchive.read_page`).
+"""
+
+import asyncio
+import logging
+import os
+import re
+import warnings
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from pathlib import Path
+from tempfile import mkstemp
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import MetaData, PrimaryKeyConstraint, delete, func, inspect, select, text
+from sqlalchemy.engine import Connection as SyncConnection
+from sqlalchemy.exc import SAWarning, SQLAlchemyError
+
+from abotcore.config import ChatHistorySettings
+from abotcore.db import Session, get_sessionmaker
+
+from .models import ChatHistory
+
+LOGGER = logging.getLogger(__name__)
+
+Month = Tuple[int, int]
+HistoryPosition = Tuple[datetime, int]
+
+PARTITION_NAME = re.compile(r"^chat_history_p(\d{4})(\d{2})$")
+# Parts of a month after the first one have a number (e.g. rows written late, archived in a later run)
+ARCHIVE_NAME = re.compile(r"^chat_history_(\d{4})-(\d{2})(?:\.(\d+))?\.parquet$")
+# Key of the advisory lock that keeps workers from archiving at the same time
+ARCHIVE_LOCK_KEY = 0x61626F74
+ARCHIVE_BATCH_ROWS = 10000
+
+
+def month_of(time: datetime) -> Month:
+    return time.year, time.month
+
+
+def next_month(month: Month) -> Month:
+    year, month_number = month
+    return (year + 1, 1) if month_number == 12 else (year, month_number + 1)
+
+
+def month_start(month: Month) -> datetime:
+    return datetime(month[0], month[1], 1, tzinfo=timezone.utc)
+
+
+def _utc(time: datetime) -> datetime:
+    # SQLite returns naive datetimes (stored in UTC)
+    return time.replace(tzinfo=timezone.utc) if time.tzinfo is None else time.astimezone(timezone.utc)
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise RuntimeError("Chat history archive requires pyarrow (pip install pyarrow)") from e
+    return pyarrow, pyarrow.parquet
+
+
+""" Partitions (PostgreSQL) """
+
+
+def _qualified_name(conn: SyncConnection, name: str) -> str:
+    preparer = conn.dialect.identifier_preparer
+    schema = conn.schema_for_object(ChatHistory.__table__)
+    if schema is None:
+        return preparer.quote(name)
+    return "%s.%s" % (preparer.quote_schema(schema), preparer.quote(name))
+
+
+def is_history_partitioned(conn: SyncConnection) -> bool:
+    if conn.dialect.name != "postgresql":
+        return False
+    return bool(
+        conn.scalar(
+            text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:name)"),
+            {"name": _qualified_name(conn, ChatHistory.__tablename__)},
+        )
+    )
+
+
+def history_partitions(conn: SyncConnection) -> Dict[Month, str]:
+    """Monthly partitions of chat_history, by month"""
+    names = conn.scalars(
+        text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(:name)"
+        ),
+        {"name": _qualified_name(conn, ChatHistory.__tablename__)},
+    )
+    partitions = {}
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions[(int(match[1]), int(match[2]))] = name
+    return partitions
+
+
+def create_history_partitions(conn: SyncConnection, months_ahead: int):
+    """Partitions of the current month and `months_ahead` months after it (and the default partition)"""
+    parent = _qualified_name(conn, ChatHistory.__tablename__)
+    existing = history_partitions(conn)
+    month = month_of(datetime.now(timezone.utc))
+    for _ in range(months_ahead + 1):
+        if month not in existing:
+            name = "chat_history_p%04d%02d" % month
+            try:
+                with conn.begin_nested():
+                    conn.exec_driver_sql(
+                        "CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM ('%s') TO ('%s')"
+                        % (
+                            _qualified_name(conn, name),
+                            parent,
+                            month_start(month).isoformat(),
+                            month_start(next_month(month)).isoformat(),
+                        )
+                    )
+            except SQLAlchemyError:
+                # e.g. the default partition already has rows of the month
+                LOGGER.exception("Failed to create chat history partition %s:", name)
+        month = next_month(month)
+
+    # Rows outside of all partitions (should stay empty)
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS %s PARTITION OF %s DEFAULT"
+        % (_qualified_name(conn, "chat_history_default"), parent)
+    )
+
+
+def create_partitioned_history(conn: SyncConnection):
+    """Create chat_history partitioned by month (PostgreSQL), if it doesn't exist yet.
+    An existing table is kept as it is (its old rows are archived by deleting them)."""
+    table = ChatHistory.__table__
+    settings = ChatHistorySettings()
+    if conn.dialect.name != "postgresql" or not settings.history_partitioning:
+        return
+    if inspect(conn).has_table(table.name, schema=conn.schema_for_object(table)):
+        if not is_history_partitioned(conn):
+            LOGGER.info("Table chat_history exists and is not partitioned, keeping it as it is")
+        return
+
+    partitioned = table.to_metadata(MetaData())
+    with warnings.catch_warnings():
+        # Primary key of a partitioned table must include the partition key
+        # (only in the DB, the model's primary key stays the same)
+        warnings.simplefilter("ignore", SAWarning)
+        partitioned.append_constraint(
+            PrimaryKeyConstraint(partitioned.c.chat_message_id, partitioned.c.message_time)
+        )
+    partitioned.dialect_kwargs["postgresql_partition_by"] = "RANGE (message_time)"
+    partitioned.create(conn, checkfirst=True)
+    create_history_partitions(conn, settings.history_partitions_ahead)
+
+
+""" Archive files """
+
+
+def _archive_schema(pa):
+    timestamp = pa.timestamp("us", tz="UTC")
+    return pa.schema(
+        [
+            ("chat_message_id", pa.int64()),
+            ("chat_handler", pa.string()),
+            ("message_client_id", pa.string()),
+            ("message_role", pa.string()),
+            ("message_content", pa.string()),
+            ("message_time", timestamp),
+            ("time_created", timestamp),
+            ("time_updated", timestamp),
+        ]
+    )
+
+
+def _archive_row(row) -> Dict[str, Any]:
+    archived = dict(row._mapping)
+    if archived["message_role"] is not None:
+        archived["message_role"] = archived["message_role"].name.lower()
+    for column in ("message_time", "time_created", "time_updated"):
+        if archived[column] is not None:
+            archived[column] = _utc(archived[column])
+    return archived
+
+
+class HistoryArchive:
+    """Directory of archived chat history, Parquet files of each month (one per archival).
+    Rows are sorted by client, so reads of a client skip most row groups."""
+
+    def __init__(self, directory: Path, compression: str = "zstd"):
+        self.directory = Path(directory)
+        self.compression = compression
+
+    def path(self, month: Month, part: int = 0) -> Path:
+        if part:
+            return self.directory / ("chat_history_%04d-%02d.%d.parquet" % (*month, part))
+        return self.directory / ("chat_history_%04d-%02d.parquet" % month)
+
+    def _parts(self) -> Dict[Month, List[int]]:
+        parts: Dict[Month, List[int]] = {}
+        for entry in os.scandir(self.directory):
+            match = ARCHIVE_NAME.match(entry.name)
+            if match:
+                parts.setdefault((int(match[1]), int(match[2])), []).append(int(match[3] or 0))
+        return parts
+
+    def months(self) -> List[Month]:
+        return sorted(self._parts())
+
+    async def write_month(self, month: Month, batches: AsyncIterator[List[Dict[str, Any]]]) -> int:
+        """Write the rows to a new file of the month (earlier ones are kept).
+        Returns the number of archived messages"""
+        pa, pq = _import_pyarrow()
+        schema = _archive_schema(pa)
+        fd, tmp_path = mkstemp(dir=self.directory, suffix=".parquet.tmp")
+        os.close(fd)
+        count = 0
+        try:
+            writer = pq.ParquetWriter(tmp_path, schema, compression=self.compression)
+            try:
+                async for batch in batches:
+                    await asyncio.to_thread(
+                        writer.write_table, pa.Table.from_pylist(batch, schema=schema)
+                    )
+                    count += len(batch)
+            finally:
+                writer.close()
+            if count:
+                # Renamed at once, readers never see a partial file (months are archived by one worker)
+                part = max(self._parts().get(month, [-1])) + 1
+                os.replace(tmp_path, self.path(month, part))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return count
+
+    async def read_page(
+        self,
+        client_id: str,
+        limit: int,
+        chat_handler: Optional[str] = None,
+        before: Optional[HistoryPosition] = None,
+    ) -> List[Dict[str, Any]]:
+        """Archived messages of the client, newest first (same order as `ChatHistory.history_page`)"""
+        parts = self._parts()
+        if not parts:
+            return []
+        return await asyncio.to_thread(
+            self._read_page, parts, client_id, limit, chat_handler, before
+        )
+
+    def _read_page(
+        self,
+        parts: Dict[Month, List[int]],
+        client_id: str,
+        limit: int,
+        chat_handler: Optional[str],
+        before: Optional[HistoryPosition],
+    ) -> List[Dict[str, Any]]:
+        _, pq = _import_pyarrow()
+        filters = [("message_client_id", "==", client_id)]
+        if chat_handler is not None:
+            filters.append(("chat_handler", "==", chat_handler))
+        if before is not None:
+            before = (_utc(before[0]), before[1])
+
+        def _position(message):
+            return message["message_time"], message["chat_message_id"]
+
+        messages: List[Dict[str, Any]] = []
+        for month in sorted(parts, reverse=True):
+            if before is not None and month_start(month) >= before[0]:
+                continue
+            # By id: rows archived twice (if they couldn't be removed after they were written) are read once
+            rows = {
+                row["chat_message_id"]: row
+                for part in parts[month]
+                for row in pq.read_table(self.path(month, part), filters=filters).to_pylist()
+            }.values()
+            if before is not None:
+                rows = [row for row in rows if _position(row) < before]
+            messages.extend(sorted(rows, key=_position, reverse=True))
+            if len(messages) >= limit:
+                break
+        return messages[:limit]
+
+
+""" Retention job """
+
+
+class ChatHistoryMaintenance:
+    """Periodically creates upcoming partitions, and moves months older than
+    the retention to the archive (when both are configured)"""
+
+    def __init__(
+        self,
+        archive: Optional[HistoryArchive] = None,
+        retention_days: Optional[int] = None,
+        sessionmaker: Optional[Callable[[], Session]] = None,
+        partitions_ahead: int = 2,
+        interval: float = 3600,
+    ):
+        self.archive = archive
+        self.retention_days = retention_days
+        self._sessionmaker = sessionmaker
+        self.partitions_ahead = partitions_ahead
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def _get_sessionmaker(self):
+        if self._sessionmaker is None:
+            self._sessionmaker = get_sessionmaker()
+        return self._sessionmaker
+
+    async def run_once(self, now: Optional[datetime] = None) -> List[Month]:
+        """Returns the archived months"""
+        async with self._get_sessionmaker()() as lock_session:
+            conn = await lock_session.connection()
+            if conn.dialect.name == "postgresql":
+                # Held until this session's transaction ends
+                locked = await lock_session.scalar(
+                    text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": ARCHIVE_LOCK_KEY}
+                )
+                if not locked:
+                    return []
+
+            partitions = await self._update_partitions()
+            if self.archive is None or self.retention_days is None:
+                return []
+            cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=self.retention_days)
+            months = await self._expired_months(partitions, cutoff)
+            for month in months:
+                await self._archive_month(month, partitions.get(month))
+            return months
+
+    async def _update_partitions(self) -> Dict[Month, str]:
+        async with self._get_sessionmaker()() as session:
+            conn = await session.connection()
+            if not await conn.run_sync(is_history_partitioned):
+                return {}
+            await conn.run_sync(create_history_partitions, self.partitions_ahead)
+            partitions = await conn.run_sync(history_partitions)
+            await session.commit()
+            return partitions
+
+    async def _expired_months(self, partitions: Dict[Month, str], cutoff: datetime) -> List[Month]:
+        """Months (with rows or a partition) that end before the cutoff"""
+        months = set(partitions)
+        async with self._get_sessionmaker()() as session:
+            oldest = await session.scalar(select(func.min(ChatHistory.message_time)))
+        if oldest is not None:
+            month = month_of(_utc(oldest))
+            while month_start(month) < cutoff:
+                months.add(month)
+                month = next_month(month)
+        return sorted(month for month in months if month_start(next_month(month)) <= cutoff)
+
+    async def _archive_month(self, month: Month, partition: Optional[str]):
+        table = ChatHistory.__table__
+        in_month = (
+            table.c.message_time >= month_start(month),
+            table.c.message_time < month_start(next_month(month)),
+        )
+        async with self._get_sessionmaker()() as session:
+            result = await session.stream(
+                select(table)
+                .where(*in_month)
+                .order_by(table.c.message_client_id, table.c.message_time, table.c.chat_message_id)
+                .execution_options(yield_per=ARCHIVE_BATCH_ROWS)
+            )
+
+            async def _batches():
+                async for rows in result.partitions():
+                    yield list(map(_archive_row, rows))
+
+            count = await self.archive.write_month(month, _batches())
+
+            # Only removed after the file is complete
+            conn = await session.connection()
+            if partition is not None:
+                parent = await conn.run_sync(_qualified_name, table.name)
+                partition_name = await conn.run_sync(_qualified_name, partition)
+                await conn.exec_driver_sql("ALTER TABLE %s DETACH PARTITION %s" % (parent, partition_name))
+                await conn.exec_driver_sql("DROP TABLE %s" % partition_name)
+            else:
+                await session.execute(delete(table).where(*in_month))
+            await session.commit()
+        LOGGER.info("Archived %d chat history messages of %04d-%02d", count, *month)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                LOGGER.exception("Chat history maintenance failed:")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.retention_days is not None and self.archive is None:
+            LOGGER.error("Chat history retention is set, but there's no archive directory. Not archiving")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+@lru_cache()
+def get_history_archive() -> Optional[HistoryArchive]:
+    settings = ChatHistorySettings()
+    if settings.history_archive_directory is None:
+        return None
+    return HistoryArchive(
+        settings.history_archive_directory, settings.history_archive_compression
+    )
+
+
+@lru_cache()
+def get_history_maintenance() -> ChatHistoryMaintenance:
+    settings = ChatHistorySettings()
+    return ChatHistoryMaintenance(
+        get_history_archive(),
+        retention_days=settings.history_retention_days,
+        partitions_ahead=settings.history_partitions_ahead,
+        interval=settings.history_retention_interval,
+    )
@@ -0,0 +1,265 @@
+"""Content-addressed store of the file cache (/chat/cache).
+
+Files are named by the SHA-256 of their content (and the extension of the
+uploaded name), so an identical upload is stored once and gets the same URL.
+The total size is bounded by a quota: the least recently used files (or those
+unused for longer than the maximum age) are evicted.
+
+The index of files (size, last use) is kept in an append-only log, compacted
+when it grows, so a restarted worker doesn't rescan the directory. The index is
+kept out of the (served) directory: it lists the names of all files. Workers
+sharing the directory share the index, under a file lock: each worker reads the
+records appended by the others before it stores a file, so the quota covers all
+files, and compaction keeps the records of all workers.
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+from .uploads import ReceivedUpload
+
+from abotcore.config import FileCacheServerSettings, ServerSettings
+from abotcore.staticfiles import remove_compressed_variants
+
+try:
+    import fcntl
+except ImportError:
+    # Not on POSIX: the index is only safe with one worker
+    fcntl = None
+
+LOGGER = logging.getLogger(__name__)
+
+# Extensions longer than this (or with other characters) aren't kept in the name
+_EXTENSION = re.compile(r"\.[A-Za-z0-9]{1,16}")
+
+
+def content_name(sha256: str, filename: Optional[str]) -> str:
+    """File name of the content: digest and the (lowercase) extension of the uploaded name"""
+    extension = os.path.splitext(filename or "")[1]
+    if not _EXTENSION.fullmatch(extension):
+        extension = ""
+    return sha256 + extension.lower()
+
+
+def default_index_path(directory: Path) -> Path:
+    """Index of the directory in the temporary directory (named by the directory's path)"""
+    digest = hashlib.sha256(str(Path(directory).resolve()).encode()).hexdigest()[:16]
+    return Path(tempfile.gettempdir()) / f"abot-file-cache-{digest}.index.jsonl"
+
+
+class FileCacheStore:
+    def __init__(
+        self,
+        directory: Path,
+        max_bytes: Optional[int] = None,
+        max_age: Optional[float] = None,
+        index_path: Optional[Path] = None,
+    ):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index_path = Path(index_path) if index_path is not None else default_index_path(self.directory)
+        self._lock_path = self.index_path.with_name(self.index_path.name + ".lock")
+
+        # name -> (size, last use), least recently used first
+        self._entries: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        self.total_bytes = 0
+        self._log_lines = 0
+        # Log file (inode) and position up to which its records were read
+        self._log_inode: Optional[int] = None
+        self._log_offset = 0
+        self._lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
+
+    def _set(self, name: str, size: int, used: float):
+        self._discard(name)
+        self._entries[name] = (size, used)
+        self.total_bytes += size
+
+    def _discard(self, name: str):
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self.total_bytes -= entry[0]
+
+    """ Index """
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Exclusive access to the index (and the directory) among workers"""
+        with open(self._lock_path, "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _apply(self, line: bytes):
+        try:
+            record = json.loads(line)
+            if record.get("removed"):
+                self._discard(record["name"])
+            else:
+                self._set(record["name"], record["size"], record["used"])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # e.g. the last line of a crashed worker
+            LOGGER.warning("Skipping invalid line of the file cache index %s", self.index_path)
+
+    def _append_log(self, *records: dict):
+        with open(self.index_path, "ab") as f:
+            for record in records:
+                f.write(json.dumps(record).encode() + b"\n")
+            self._log_offset = f.tell()
+        self._log_lines += len(records)
+
+    def _compact(self):
+        """Rewrite the log with the current entries (the log must have been read up to its end)"""
+        temp_path = self.index_path.with_name(self.index_path.name + ".tmp")
+        with open(temp_path, "w") as f:
+            for name, (size, used) in self._entries.items():
+                f.write(json.dumps({"name": name, "size": size, "used": used}) + "\n")
+            offset = f.tell()
+        os.replace(temp_path, self.index_path)
+        self._log_inode = os.stat(self.index_path).st_ino
+        self._log_offset = offset
+        self._log_lines = len(self._entries)
+
+    def _scan(self):
+        """Index the files of the directory (when there's no index yet)"""
+        files = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for used, name, size in sorted(files):
+            self._set(name, size, used)
+
+    def _read_log(self):
+        """Read the records appended since the last read (all of them if the log was replaced)"""
+        try:
+            f = open(self.index_path, "rb")
+        except FileNotFoundError:
+            LOGGER.info("File cache index %s doesn't exist, scanning %s", self.index_path, self.directory)
+            self._entries.clear()
+            self.total_bytes = 0
+            self._scan()
+            self._compact()
+            return
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            if inode != self._log_inode:
+                # New or compacted (by another worker) log
+                self._entries.clear()
+                self.total_bytes = 0
+                self._log_inode, self._log_offset, self._log_lines = inode, 0, 0
+            f.seek(self._log_offset)
+            lines = f.readlines()
+            for line in lines:
+                self._apply(line)
+                self._log_offset += len(line)
+        if self._log_lines == 0:
+            # The log isn't ordered by last use
+            self._entries = OrderedDict(sorted(self._entries.items(), key=lambda item: item[1][1]))
+        self._log_lines += len(lines)
+        if lines and not lines[-1].endswith(b"\n"):
+            # Cut short by a crashed worker, the next record would be appended to it
+            self._compact()
+
+    def load(self):
+        """Read the index (or create it by scanning the directory)"""
+        with self._locked():
+            self._log_inode = None
+            self._read_log()
+
+    """ Storing and eviction """
+
+    def _expired(self, now: float):
+        if self.max_age is None:
+            return []
+        return [name for name, (_, used) in self._entries.items() if now - used > self.max_age]
+
+    def _evict(self, keep: str, now: float) -> list:
+        names = self._expired(now)
+        total = self.total_bytes - sum(self._entries[name][0] for name in names)
+        if self.max_bytes is not None:
+            for name, (size, _) in self._entries.items():
+                if total <= self.max_bytes:
+                    break
+                if name != keep and name not in names:
+                    names.append(name)
+                    total -= size
+
+        for name in names:
+            self._discard(name)
+            try:
+                os.remove(self.directory / name)
+            except FileNotFoundError:
+                pass
+            remove_compressed_variants(self.directory, name)
+        return names
+
+    def add(self, upload: ReceivedUpload) -> Path:
+        """Move the uploaded (temporary) file to its content address, and evict over the quota.
+        If the content is already stored, the upload is removed and the stored file is used."""
+        with self._locked():
+            # Including the files stored by other workers
+            self._read_log()
+            return self._add(upload)
+
+    def _add(self, upload: ReceivedUpload) -> Path:
+        name = content_name(upload.sha256, upload.filename)
+        path = self.directory / name
+        now = time.time()
+        if path.exists():
+            os.remove(upload.path)
+        else:
+            os.replace(upload.path, path)
+        self._set(name, upload.size, now)
+
+        evicted = self._evict(keep=name, now=now)
+        if evicted:
+            LOGGER.info("Evicted %d files from the file cache", len(evicted))
+        self._append_log(
+            {"name": name, "size": upload.size, "used": now},
+            *({"name": evicted_name, "removed": True} for evicted_name in evicted),
+        )
+        if self._log_lines > 2 * len(self._entries) + 100:
+            self._compact()
+        return path
+
+    async def store(self, upload: ReceivedUpload) -> Path:
+        async with self._lock:
+            return await asyncio.to_thread(self.add, upload)
+
+
+@lru_cache()
+def get_file_cache_store(directory: Path) -> FileCacheStore:
+    settings = FileCacheServerSettings()
+    store = FileCacheStore(
+        directory,
+        max_bytes=settings.cache_max_size,
+        max_age=settings.cache_max_age,
+        index_path=settings.cache_index_file,
+    )
+    static_directory = ServerSettings().static_serve_directory
+    if static_directory is not None and Path(static_directory).resolve() in store.index_path.resolve().parents:
+        raise RuntimeError(
+            f"File cache index {store.index_path} would be served under /static, "
+            "set ABOT_BACKEND_CACHE_INDEX_FILE outside of the static directory"
+        )
+    return store
@@ -0,0 +1,331 @@
+"""Write-behind journal for chat history and user memory writes.
+
+Writes are buffered in-process and flushed as bulk statements by a single
+background task, either when the buffer is large enough or periodically.
+Flushes are serialized, so the order of writes (per sender) is kept.
+
+A failed flush is put back and retried (with a growing delay), as long as the
+database is unreachable. Otherwise (e.g. a row that the database rejects) the
+writes are retried `max_retries` times, then written one by one, and those that
+still fail are dropped.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+from abotcore.config import ChatJournalSettings, ChatMemorySettings
+from abotcore.db import Session, get_sessionmaker
+
+from .memory import (
+    MemoryCache,
+    archive_memory,
+    archive_memory_outside_window,
+    get_memory_cache,
+    memory_entry_row,
+    memory_versions,
+)
+from .models import ChatHistory, UserChatMemoryEntry
+from .schemas import ChatRole, Memory
+
+LOGGER = logging.getLogger(__name__)
+
+# Longest delay between flushes while they fail
+MAX_RETRY_DELAY = 30
+
+
+# Memory writes of a user: whether the stored entries are replaced, and the entries to append
+PendingMemory = Tuple[bool, List[dict]]
+
+
+def _merge_pending_memory(older: PendingMemory, newer: PendingMemory) -> PendingMemory:
+    if newer[0]:
+        return newer
+    return older[0], older[1] + newer[1]
+
+
+def _is_unreachable(e: Exception) -> bool:
+    """Whether the write failed because of the database (connection), not the written rows"""
+    if isinstance(e, (OSError, asyncio.TimeoutError, OperationalError)):
+        return True
+    return isinstance(e, DBAPIError) and e.connection_invalidated
+
+
+class ChatJournal:
+    def __init__(
+        self,
+        sessionmaker: Optional[Callable[[], Session]] = None,
+        max_batch: int = 100,
+        flush_interval: float = 0.5,
+        max_pending: int = 10000,
+        write_behind: bool = True,
+        memory_window_entries: Optional[int] = None,
+        max_retries: int = 3,
+        memory_cache: Optional[MemoryCache] = None,
+    ):
+        """`memory_cache`: cache of the users' memory, whose version is set once their writes are in the DB"""
+        self._sessionmaker = sessionmaker
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.write_behind = write_behind
+        self.memory_window_entries = memory_window_entries
+        self.max_retries = max_retries
+        self.memory_cache = memory_cache
+
+        self._history: List[Dict[str, Any]] = []
+        # Memory writes of each user, not yet written. Insertion ordered
+        self._memory: Dict[str, PendingMemory] = {}
+        # History and memory that are being written by the current flush
+        self._flushing_history: List[Dict[str, Any]] = []
+        self._flushing_memory: Dict[str, PendingMemory] = {}
+        # Consecutive failed flushes, and those of them that weren't caused by the connection
+        self._failures = 0
+        self._rejections = 0
+
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def pending(self) -> int:
+        return len(self._history) + len(self._memory)
+
+    def _get_sessionmaker(self):
+        if self._sessionmaker is None:
+            self._sessionmaker = get_sessionmaker()
+        return self._sessionmaker
+
+    def _get_flush_lock(self) -> asyncio.Lock:
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+
+    async def start(self):
+        if not self.write_behind or self.running:
+            return
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and drain all pending writes"""
+        if self.running:
+            task, self._task = self._task, None
+            self._wakeup.set()
+            await task
+        await self.flush()
+        self._flush_lock = self._wakeup = None
+
+    def _next_delay(self) -> float:
+        if not self._failures:
+            return self.flush_interval
+        return min(self.flush_interval * 2 ** self._failures, MAX_RETRY_DELAY)
+
+    async def _run(self):
+        while self._task is not None:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._next_delay())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # Keep writing (what's pending stays queued)
+                LOGGER.exception("Chat journal flush failed:")
+
+    async def _submitted(self):
+        if not self.running:
+            await self.flush()
+        elif self.pending >= self.max_batch:
+            self._wakeup.set()
+
+    async def record_history(
+        self,
+        chat_handler: str,
+        message_client_id: Optional[str],
+        message_role: ChatRole,
+        message_content: Optional[str],
+    ):
+        self._history.append(
+            dict(
+                chat_handler=chat_handler,
+                message_client_id=message_client_id,
+                message_role=message_role,
+                message_content=message_content,
+                # Time of the message, not of the (later) write
+                message_time=datetime.now(timezone.utc),
+            )
+        )
+        if len(self._history) > self.max_pending:
+            LOGGER.error(
+                "Chat journal is over capacity (%d), dropping oldest history entry",
+                self.max_pending,
+            )
+            del self._history[0]
+        await self._submitted()
+
+    async def record_memory(
+        self, user_id: str, entries: List[Memory], replace: bool = False
+    ):
+        """Append entries to the memory of the user.
+        With `replace`, all stored entries of the user are archived first."""
+        if not entries and not replace:
+            return
+        pending: PendingMemory = (replace, list(map(Memory.dict, entries)))
+        if user_id in self._memory:
+            pending = _merge_pending_memory(self._memory.pop(user_id), pending)
+        # (Re-)insert to move the user to the end (flush order)
+        self._memory[user_id] = pending
+        await self._submitted()
+
+    def has_pending_memory(self, user_id: str) -> bool:
+        """Whether there are memory writes of the user that are not in the DB yet"""
+        return user_id in self._memory or user_id in self._flushing_memory
+
+    def _requeue(self, history: List[Dict[str, Any]], memory: Dict[str, PendingMemory]):
+        """Put writes back in front of anything recorded in the meantime"""
+        self._history[:0] = history
+        del self._history[: max(0, len(self._history) - self.max_pending)]
+        for user_id, pending in self._memory.items():
+            memory[user_id] = _merge_pending_memory(memory.pop(user_id, (False, [])), pending)
+        self._memory = memory
+
+    async def _commit(self, history: List[Dict[str, Any]], memory: Dict[str, PendingMemory]):
+        async with self._get_sessionmaker()() as session:
+            versions = await self._write(session, history, memory)
+            await session.commit()
+        self._memory_written(versions)
+
+    def _memory_written(self, versions: Dict[str, int]):
+        if self.memory_cache is None:
+            return
+        for user_id, version in versions.items():
+            if user_id in self._memory:
+                # Written again since (the cached memory is newer)
+                continue
+            cached = self.memory_cache.get(user_id)
+            if cached is not None and cached.version is None:
+                self.memory_cache.put(user_id, cached._replace(version=version))
+
+    async def _commit_each(self, history: List[Dict[str, Any]], memory: Dict[str, PendingMemory]):
+        """Write the history rows and the memory of each user separately, dropping those that fail"""
+        writes = [([row], {}) for row in history] + [([], {user_id: pending}) for user_id, pending in memory.items()]
+        for index, (rows, users) in enumerate(writes):
+            try:
+                await self._commit(rows, users)
+            except BaseException as e:
+                if isinstance(e, Exception) and not _is_unreachable(e):
+                    LOGGER.exception("Dropping chat %s that can't be written:", "history row" if rows else "memory")
+                    continue
+                # Not written yet: the rest of the batch
+                remaining = writes[index:]
+                self._requeue(
+                    [row for rows, _ in remaining for row in rows],
+                    {user_id: pending for _, users in remaining for user_id, pending in users.items()},
+                )
+                raise
+
+    def has_pending_history(self, sender_id: str) -> bool:
+        """Whether there are history rows of the sender that are not in the DB yet"""
+        return any(
+            row["message_client_id"] == sender_id
+            for rows in (self._history, self._flushing_history)
+            for row in rows
+        )
+
+    async def flush(self):
+        async with self._get_flush_lock():
+            history, self._history = self._history, []
+            memory, self._memory = self._memory, {}
+            if not history and not memory:
+                return
+            self._flushing_history, self._flushing_memory = history, memory
+
+            # After repeated rejections of the batch, the rows that are rejected are found and dropped
+            write_each = self._rejections > self.max_retries
+            try:
+                if write_each:
+                    await self._commit_each(history, memory)
+                else:
+                    await self._commit(history, memory)
+            except Exception as e:
+                self._failures += 1
+                if not _is_unreachable(e):
+                    self._rejections += 1
+                LOGGER.exception(
+                    "Failed to write %d chat history and %d memory entries, will retry:",
+                    len(history),
+                    len(memory),
+                )
+                if not write_each:
+                    # (Otherwise the unwritten part was put back)
+                    self._requeue(history, memory)
+            except BaseException:
+                # e.g. cancelled
+                if not write_each:
+                    self._requeue(history, memory)
+                raise
+            else:
+                self._failures = self._rejections = 0
+            finally:
+                self._flushing_history, self._flushing_memory = [], {}
+
+    async def _write(
+        self,
+        session: Session,
+        history: List[Dict[str, Any]],
+        memory: Dict[str, PendingMemory],
+    ) -> Dict[str, int]:
+        """Write the rows, returns the version of the written memory of each user"""
+        if history:
+            await session.execute(insert(ChatHistory), history)
+        if not memory:
+            return {}
+
+        replaced_users = [user_id for user_id, (replace, _) in memory.items() if replace]
+        if replaced_users:
+            await archive_memory(session, replaced_users)
+
+        entry_rows = [
+            memory_entry_row(user_id, entry)
+            for user_id, (_, entries) in memory.items()
+            for entry in entries
+        ]
+        if entry_rows:
+            await session.execute(insert(UserChatMemoryEntry), entry_rows)
+
+        if self.memory_window_entries is not None:
+            for user_id in memory.keys():
+                await archive_memory_outside_window(
+                    session, user_id, self.memory_window_entries
+                )
+
+        if self.memory_cache is None:
+            return {}
+        return await memory_versions(session, memory.keys())
+
+
+@lru_cache()
+def get_chat_journal() -> ChatJournal:
+    settings = ChatJournalSettings()
+    memory_settings = ChatMemorySettings()
+    return ChatJournal(
+        max_batch=settings.chat_journal_max_batch,
+        flush_interval=settings.chat_journal_flush_interval,
+        max_pending=settings.chat_journal_max_pending,
+        write_behind=settings.chat_journal_enabled,
+        memory_window_entries=memory_settings.memory_window_entries,
+        max_retries=settings.chat_journal_max_retries,
+        memory_cache=get_memory_cache(),
+    )
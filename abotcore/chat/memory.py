@@ -0,0 +1,183 @@
+"""User chat memory: windowed storage helpers and in-process cache.
+
+Memory is stored as append-only rows (`UserChatMemoryEntry`). Only the most
+recent entries (the window) are loaded and sent to the chain, older ones are
+marked as archived so that the cost of a turn doesn't grow with the length
+of the conversation.
+"""
+
+from functools import lru_cache
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import func, select, update
+
+from abotcore.cache import LRUCache
+from abotcore.config import ChatMemorySettings
+from abotcore.db import Session
+
+from .models import UserChatMemory, UserChatMemoryEntry
+from .schemas import Memory
+
+# Rough per-entry overhead of a parsed `Memory` object (models, dicts)
+MEMORY_ENTRY_OVERHEAD = 512
+
+
+class CachedMemory(NamedTuple):
+    """Memory window of a user, and the version of the stored entries it matches
+    (None while it has writes that aren't in the DB yet)"""
+
+    memory: List[Memory]
+    version: Optional[int]
+
+
+MemoryCache = LRUCache[str, CachedMemory]
+
+
+def memory_size(memory_list: List[Memory]) -> int:
+    """Estimated size (bytes) of parsed memory, for the cache budget"""
+    return sum(
+        MEMORY_ENTRY_OVERHEAD + len(memory.data.content) for memory in memory_list
+    )
+
+
+def cached_memory_size(cached: CachedMemory) -> int:
+    return memory_size(cached.memory)
+
+
+def memory_window(
+    memory_list: List[Memory],
+    max_entries: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+) -> List[Memory]:
+    """Most recent entries of the memory that fit in the window"""
+    if max_entries is not None:
+        memory_list = memory_list[-max_entries:] if max_entries > 0 else []
+    if max_bytes is not None:
+        total = 0
+        for i in range(len(memory_list) - 1, -1, -1):
+            total += len(memory_list[i].data.content)
+            if total > max_bytes:
+                return memory_list[i + 1:]
+    return memory_list
+
+
+def memory_appended(
+    sent: List[Memory], received: List[Memory]
+) -> Tuple[List[Memory], bool]:
+    """Entries to store after the chain returned `received` for the `sent` memory.
+    Returns the new entries and whether they replace the stored ones
+    (when the chain rewrote the memory instead of appending to it)."""
+    if len(received) >= len(sent) and received[: len(sent)] == sent:
+        return received[len(sent):], False
+    return received, True
+
+
+def memory_entry_row(user_id: str, memory: dict) -> dict:
+    return {
+        "user_id": user_id,
+        "memory_type": memory["type"],
+        "memory_data": memory["data"],
+        "archived": False,
+    }
+
+
+async def load_memory_window(
+    session: Session,
+    user_id: str,
+    max_entries: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+) -> Optional[List[Memory]]:
+    """Load the memory window of the user from the entries.
+    Returns None if the user has no (active) entries."""
+    stmt = (
+        select(UserChatMemoryEntry.memory_type, UserChatMemoryEntry.memory_data)
+        .where(
+            UserChatMemoryEntry.user_id == user_id,
+            UserChatMemoryEntry.archived.is_(False),
+        )
+        .order_by(UserChatMemoryEntry.memory_entry_id.desc())
+    )
+    if max_entries is not None:
+        stmt = stmt.limit(max_entries)
+    rows = (await session.execute(stmt)).all()
+    if not rows:
+        return None
+
+    memory = [
+        Memory.parse_obj({"type": memory_type, "data": memory_data})
+        for memory_type, memory_data in reversed(rows)
+    ]
+    return memory_window(memory, max_bytes=max_bytes)
+
+
+async def memory_versions(session: Session, user_ids: Iterable[str]) -> Dict[str, int]:
+    """Version of the stored memory of each user: id of its latest active entry (0 if none).
+    Entries are only appended (replaced ones are archived), so every write changes it"""
+    user_ids = list(user_ids)
+    rows = await session.execute(
+        select(UserChatMemoryEntry.user_id, func.max(UserChatMemoryEntry.memory_entry_id))
+        .where(
+            UserChatMemoryEntry.user_id.in_(user_ids),
+            UserChatMemoryEntry.archived.is_(False),
+        )
+        .group_by(UserChatMemoryEntry.user_id)
+    )
+    versions = dict(rows.all())
+    return {user_id: versions.get(user_id) or 0 for user_id in user_ids}
+
+
+async def load_legacy_memory(session: Session, user_id: str) -> Optional[List[Memory]]:
+    """Whole memory of the user from the legacy single-blob table"""
+    chat_memory_obj: Optional[UserChatMemory] = await session.get(UserChatMemory, user_id)
+    if chat_memory_obj is None or not chat_memory_obj.memory_data:
+        return None
+    return [Memory.parse_obj(memory) for memory in chat_memory_obj.memory_data]
+
+
+async def archive_memory(session: Session, user_ids: Iterable[str]):
+    """Archive all active entries of the users"""
+    await session.execute(
+        update(UserChatMemoryEntry)
+        .where(
+            UserChatMemoryEntry.user_id.in_(list(user_ids)),
+            UserChatMemoryEntry.archived.is_(False),
+        )
+        .values(archived=True)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def archive_memory_outside_window(session: Session, user_id: str, max_entries: int):
+    """Archive the active entries of the user that are older than the window"""
+    window_ids = (
+        select(UserChatMemoryEntry.memory_entry_id)
+        .where(
+            UserChatMemoryEntry.user_id == user_id,
+            UserChatMemoryEntry.archived.is_(False),
+        )
+        .order_by(UserChatMemoryEntry.memory_entry_id.desc())
+        .limit(max_entries)
+    )
+    await session.execute(
+        update(UserChatMemoryEntry)
+        .where(
+            UserChatMemoryEntry.user_id == user_id,
+            UserChatMemoryEntry.archived.is_(False),
+            UserChatMemoryEntry.memory_entry_id.not_in(window_ids),
+        )
+        .values(archived=True)
+        .execution_options(synchronize_session=False)
+    )
+
+
+@lru_cache()
+def get_memory_cache() -> MemoryCache:
+    """Parsed memory window of each user (by user id), updated write-through.
+    Used while the stored version of the memory is the cached one"""
+    settings = ChatMemorySettings()
+    return MemoryCache(
+        max_entries=settings.memory_cache_max_entries,
+        max_bytes=settings.memory_cache_max_bytes,
+        ttl=settings.memory_cache_ttl,
+        sizeof=cached_memory_size,
+    )
@@ -2,19 +2,49 @@
 
 from datetime import datetime
 
-from sqlalchemy import JSON, Column, DateTime, Identity, Integer, String, Enum, select
+from sqlalchemy import (
+    JSON,
+    Boolean,
+    Column,
+    DateTime,
+    Enum,
+    Identity,
+    Index,
+    Integer,
+    String,
+    select,
+    tuple_,
+)
 from sqlalchemy.orm import Mapped
 from sqlalchemy.sql import func
 
 from ..db.common_schemas import AbotBase
 from ..db.session import Session
-from .schemas import Memory, ChatRole
+from .schemas import Memory, MemoryData, ChatRole
 
-from typing import List
+from typing import List, Optional, Tuple
 
 
 class ChatHistory(AbotBase):
     __tablename__ = "chat_history"
+    __table_args__ = (
+        # Messages of a client (or of a client with a chat handler) in time order
+        # (chat_message_id breaks ties of equal times)
+        Index(
+            "ix_chat_history_client_time",
+            "message_client_id",
+            "message_time",
+            "chat_message_id",
+        ),
+        Index(
+            "ix_chat_history_client_handler_time",
+            "message_client_id",
+            "chat_handler",
+            "message_time",
+            "chat_message_id",
+        ),
+        AbotBase.__table_args__,
+    )
     chat_message_id: Mapped[int] = Column(
         "chat_message_id", Integer, Identity(start=1), primary_key=True
     )
@@ -43,8 +73,34 @@ class ChatHistory(AbotBase):
             .limit(1)
         )
 
+    @classmethod
+    async def history_page(
+        cls,
+        session: Session,
+        client_id: str,
+        limit: int,
+        chat_handler: Optional[str] = None,
+        before: Optional[Tuple[datetime, int]] = None,
+    ) -> List["ChatHistory"]:
+        """Messages of the client, newest first, that come before the (message_time, chat_message_id)
+        position `before`. Seeks in the client/time (or client/handler/time) index, so every page costs the same"""
+        query = select(ChatHistory).filter(ChatHistory.message_client_id == client_id)
+        if chat_handler is not None:
+            query = query.filter(ChatHistory.chat_handler == chat_handler)
+        if before is not None:
+            query = query.filter(
+                tuple_(ChatHistory.message_time, ChatHistory.chat_message_id) < tuple_(*before)
+            )
+        query = query.order_by(
+            ChatHistory.message_time.desc(), ChatHistory.chat_message_id.desc()
+        ).limit(limit)
+        return list(await session.scalars(query))
+
 
 class UserChatMemory(AbotBase):
+    """Whole memory of a user as one blob (legacy, superseded by `UserChatMemoryEntry`).
+    Only read to carry over memory of users that have no entries yet."""
+
     __tablename__ = "user_chat_memory"
     user_id: Mapped[str] = Column("user_id", String, primary_key=True)
     memory_data: Mapped[List[Memory]] = Column("memory_data", JSON, default=[])
@@ -54,3 +110,29 @@ class UserChatMemory(AbotBase):
     time_updated: Mapped[datetime] = Column(
         "time_updated", DateTime(timezone=True), onupdate=func.now()
     )
+
+
+class UserChatMemoryEntry(AbotBase):
+    """Single memory entry of a user. Rows are only appended, and entries
+    that fall out of the memory window are marked as archived."""
+
+    __tablename__ = "user_chat_memory_entry"
+    __table_args__ = (
+        Index(
+            "ix_user_chat_memory_entry_user_active",
+            "user_id",
+            "archived",
+            "memory_entry_id",
+        ),
+        AbotBase.__table_args__,
+    )
+    memory_entry_id: Mapped[int] = Column(
+        "memory_entry_id", Integer, Identity(start=1), primary_key=True
+    )
+    user_id: Mapped[str] = Column("user_id", String, nullable=False)
+    memory_type: Mapped[str] = Column("memory_type", String)
+    memory_data: Mapped[MemoryData] = Column("memory_data", JSON)
+    archived: Mapped[bool] = Column("archived", Boolean, default=False, nullable=False)
+    time_created: Mapped[datetime] = Column(
+        "time_created", DateTime(timezone=True), server_default=func.now()
+    )
@@ -1,7 +1,8 @@
 """Data validation schemas (Pydantic) used by chat endpoints"""
 
-from pydantic import BaseModel, Extra, Field
+from pydantic import BaseModel, Extra, Field, validator
 from typing import Optional, Dict, List, Any
+from datetime import datetime
 from enum import Enum
 
 # Base
@@ -23,6 +24,8 @@ class ChatMessageIn(ChatMessage):
     """
 
     sender_id: Optional[str] = None
+    idempotency_key: Optional[str] = None
+    """Set by the client, same for retries of the message. Duplicates get the reply of the original message"""
 
 
 class ChatMessageOut(
@@ -36,6 +39,29 @@ class ChatMessageOut(
     custom: Optional[Dict[str, Any]] = None
 
 
+class ChatBatchItemOut(BaseModel):
+    """Reply to one message of a batch (in the same position as the message)"""
+
+    status_code: int = 200
+    messages: Optional[List[ChatMessageOut]] = None
+    detail: Optional[str] = None
+
+
+class ChatStreamEvent(str, Enum):
+    DELTA = "delta"
+    """Partial text of the message that is being generated"""
+    MESSAGE = "message"
+    """Complete message"""
+    DONE = "done"
+    ERROR = "error"
+
+
+class ChatStreamChunk(BaseModel):
+    event: ChatStreamEvent
+    data: Optional[ChatMessageOut] = None
+    detail: Optional[str] = None
+
+
 class RestEndpointStatus(Enum):
     OK = "ok"
     UNREACHABLE = "unreachable"
@@ -46,6 +72,26 @@ class ChatRole(Enum):
     AI = "ai"
 
 
+class ChatHistoryOut(BaseModel, orm_mode=True):
+    chat_message_id: int
+    chat_handler: str
+    message_client_id: Optional[str]
+    message_role: str
+    message_content: Optional[str]
+    message_time: datetime
+
+    @validator("message_role", pre=True)
+    def role_name(cls, role):
+        return role.name.lower() if isinstance(role, ChatRole) else role
+
+
+class ChatHistoryPage(BaseModel):
+    messages: List[ChatHistoryOut]
+    """Newest first"""
+    next_cursor: Optional[str] = None
+    """Cursor of the next (older) page, None on the last page"""
+
+
 class ChatStatusOut(BaseModel):
     status: RestEndpointStatus
 
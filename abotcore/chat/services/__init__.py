@@ -1,6 +1,33 @@
 
+from functools import lru_cache, partial
+from typing import Callable, Dict
+
+from abotcore.schemas import ChatServiceType
+
 from .base import BaseChatServer
 
 from .dummy import DummyChatServer
 from .rasa import RasaChatServer
 from .langcorn import LangcornChatServer
+
+
+CHAT_SERVICE_MAP: Dict[str, Callable[..., BaseChatServer]] = {
+    ChatServiceType.DUMMY: DummyChatServer,
+    ChatServiceType.RASA: RasaChatServer,
+    ChatServiceType.LANGCHAIN_GENESIS: partial(
+        LangcornChatServer, chain_name="genesis.langcorn:chain"
+    ),
+    ChatServiceType.LANGCHAIN_FUNCTION: partial(
+        LangcornChatServer, chain_name="logic:chain"
+    ),
+}
+
+
+def create_chat_server(service: ChatServiceType, **kwargs) -> BaseChatServer:
+    return CHAT_SERVICE_MAP[service](service_type=service, **kwargs)
+
+
+@lru_cache()
+def get_shared_chat_server(service: ChatServiceType) -> BaseChatServer:
+    """Long-lived server of the service, shared by all requests (servers keep no per-request state)"""
+    return create_chat_server(service)
@@ -1,18 +1,69 @@
-from typing import List
+from typing import AsyncIterator, List, Optional
 
-from pydantic import BaseModel, Extra
+from fastapi import HTTPException
+from pydantic import BaseModel, Extra, Field
 
-from ..schemas import ChatMessageIn, ChatMessageOut, ChatStatusOut, RestEndpointStatus
+from abotcore.schemas import ChatServiceType
 
+from ..schemas import (
+    ChatMessageIn,
+    ChatMessageOut,
+    ChatStatusOut,
+    ChatStreamChunk,
+    ChatStreamEvent,
+    RestEndpointStatus,
+)
+from .coordinator import ChatTurnCoordinator, get_turn_coordinator
+from .health import ChatHealthMonitor, get_health_monitor
+
+
+class BaseChatServer(BaseModel, extra=Extra.ignore, arbitrary_types_allowed=True):
+    service_type: Optional[ChatServiceType] = None
+    coordinator: ChatTurnCoordinator = Field(default_factory=get_turn_coordinator)
+    health: ChatHealthMonitor = Field(default_factory=get_health_monitor)
 
-class BaseChatServer(BaseModel, extra=Extra.ignore):
     async def send_chat_message(
         self, chat_message: ChatMessageIn
     ) -> List[ChatMessageOut]:
         return []
 
+    async def stream_chat_message(
+        self, chat_message: ChatMessageIn
+    ) -> AsyncIterator[ChatStreamChunk]:
+        """Reply as a stream of chunks. Servers that can't stream send the whole reply once it's ready"""
+        for message in await self.send_chat_message(chat_message):
+            yield ChatStreamChunk(event=ChatStreamEvent.MESSAGE, data=message)
+
     async def get_status(self) -> ChatStatusOut:
         return {"status": RestEndpointStatus.UNREACHABLE}
 
-    async def __call__(self, chat_message: ChatMessageIn):
-        return await self.send_chat_message(chat_message)
+    def _record_error(self, e: HTTPException):
+        if e.status_code >= 500:
+            self.health.record_failure(self.service_type)
+
+    async def __call__(self, chat_message: ChatMessageIn) -> List[ChatMessageOut]:
+        """Reply to the message, after the previous messages of the sender (and only once per idempotency key).
+        Fails fast while the service is known to be down"""
+        self.health.ensure_available(self.service_type)
+        try:
+            reply = await self.coordinator.run(chat_message, self.send_chat_message)
+        except HTTPException as e:
+            self._record_error(e)
+            raise
+        self.health.record_success(self.service_type)
+        return reply
+
+    def stream(self, chat_message: ChatMessageIn) -> AsyncIterator[ChatStreamChunk]:
+        """Streamed version of calling the server. Fails fast (here, not while streaming)
+        while the service is known to be down"""
+        self.health.ensure_available(self.service_type)
+        return self._stream(chat_message)
+
+    async def _stream(self, chat_message: ChatMessageIn) -> AsyncIterator[ChatStreamChunk]:
+        try:
+            async for chunk in self.coordinator.stream(chat_message, self.stream_chat_message):
+                yield chunk
+        except HTTPException as e:
+            self._record_error(e)
+            raise
+        self.health.record_success(self.service_type)
@@ -0,0 +1,166 @@
+"""Ordering and de-duplication of chat turns.
+
+Messages of the same sender are handled one at a time, in the order they
+arrive. Messages with an idempotency key that is already being handled, or
+was handled recently, get the reply of the original message instead of
+being sent to the chat server again. Keys are scoped by sender, so messages
+without a sender are never de-duplicated (different clients may use the
+same key).
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from abotcore.cache import LRUCache
+from abotcore.config import ChatEndpointSettings
+
+from ..schemas import ChatMessageIn, ChatMessageOut, ChatStreamChunk, ChatStreamEvent
+
+TurnKey = Tuple[Optional[str], str]
+
+
+class ChatTurnCoordinator:
+    def __init__(self, result_ttl: Optional[float] = 600, max_results: Optional[int] = 10000):
+        # Lock of each sender, and number of turns using it
+        self._locks: Dict[str, Tuple[asyncio.Lock, int]] = {}
+        self._in_flight: Dict[TurnKey, asyncio.Future] = {}
+        self._results: LRUCache[TurnKey, List[ChatMessageOut]] = LRUCache(
+            max_entries=max_results, ttl=result_ttl
+        )
+
+    @staticmethod
+    def _key(chat_message: ChatMessageIn) -> Optional[TurnKey]:
+        if chat_message.idempotency_key is None or chat_message.sender_id is None:
+            return None
+        return chat_message.sender_id, chat_message.idempotency_key
+
+    @asynccontextmanager
+    async def sender_turn(self, sender_id: Optional[str]):
+        """Wait for the previous turns of the sender to finish (no-op without sender)"""
+        if sender_id is None:
+            yield
+            return
+
+        lock, users = self._locks.get(sender_id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[sender_id] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[sender_id]
+            if users <= 1:
+                del self._locks[sender_id]
+            else:
+                self._locks[sender_id] = (lock, users - 1)
+
+    async def _previous_reply(self, key: TurnKey) -> Optional[List[ChatMessageOut]]:
+        """Reply of the same (recent or in-flight) message, if there is one"""
+        while True:
+            result = self._results.get(key)
+            if result is not None:
+                return result
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                return None
+            try:
+                # Don't cancel the original if this request is cancelled
+                return await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                if not in_flight.cancelled():
+                    raise
+                # The original was cancelled (e.g. its stream's client is gone): reply again,
+                # or attach to another duplicate that does
+                if self._in_flight.get(key) is in_flight:
+                    del self._in_flight[key]
+
+    def _remember(self, key: TurnKey, future: asyncio.Future):
+        self._in_flight[key] = future
+
+        def _done(future: asyncio.Future):
+            self._in_flight.pop(key, None)
+            if not future.cancelled() and future.exception() is None:
+                self._results.put(key, future.result())
+
+        future.add_done_callback(_done)
+
+    async def run(
+        self,
+        chat_message: ChatMessageIn,
+        reply: Callable[[ChatMessageIn], Awaitable[List[ChatMessageOut]]],
+    ) -> List[ChatMessageOut]:
+        """Reply to the message in the sender's turn, or get the reply of its original"""
+        key = self._key(chat_message)
+        if key is None:
+            async with self.sender_turn(chat_message.sender_id):
+                return await reply(chat_message)
+
+        previous = await self._previous_reply(key)
+        if previous is not None:
+            return previous
+
+        async def _turn():
+            async with self.sender_turn(chat_message.sender_id):
+                return await reply(chat_message)
+
+        # Separate task, so that the reply completes for duplicates even if this request is cancelled
+        task = asyncio.ensure_future(_turn())
+        self._remember(key, task)
+        return await asyncio.shield(task)
+
+    async def _stream_turn(
+        self,
+        chat_message: ChatMessageIn,
+        reply: Callable[[ChatMessageIn], AsyncIterator[ChatStreamChunk]],
+        messages: List[ChatMessageOut],
+    ) -> AsyncIterator[ChatStreamChunk]:
+        async with self.sender_turn(chat_message.sender_id):
+            async for chunk in reply(chat_message):
+                if chunk.event == ChatStreamEvent.MESSAGE:
+                    messages.append(chunk.data)
+                yield chunk
+
+    async def stream(
+        self,
+        chat_message: ChatMessageIn,
+        reply: Callable[[ChatMessageIn], AsyncIterator[ChatStreamChunk]],
+    ) -> AsyncIterator[ChatStreamChunk]:
+        """Stream the reply in the sender's turn. Duplicates get the original's messages"""
+        key = self._key(chat_message)
+        previous = None if key is None else await self._previous_reply(key)
+        if previous is not None:
+            for message in previous:
+                yield ChatStreamChunk(event=ChatStreamEvent.MESSAGE, data=message)
+            return
+
+        messages: List[ChatMessageOut] = []
+        if key is None:
+            async for chunk in self._stream_turn(chat_message, reply, messages):
+                yield chunk
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._remember(key, future)
+        try:
+            async for chunk in self._stream_turn(chat_message, reply, messages):
+                yield chunk
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        except BaseException:
+            # Stream was closed or cancelled before the reply was complete
+            future.cancel()
+            raise
+        future.set_result(messages)
+
+
+@lru_cache()
+def get_turn_coordinator() -> ChatTurnCoordinator:
+    settings = ChatEndpointSettings()
+    return ChatTurnCoordinator(
+        result_ttl=settings.chat_idempotency_ttl,
+        max_results=settings.chat_idempotency_max_entries,
+    )
@@ -1,8 +1,17 @@
-from uuid import uuid4 as uuidv4
-from typing import List
+import asyncio
 import logging
+import re
+from uuid import uuid4 as uuidv4
+from typing import AsyncIterator, List
 
-from ..schemas import ChatMessageIn, ChatMessageOut, ChatStatusOut, RestEndpointStatus
+from ..schemas import (
+    ChatMessageIn,
+    ChatMessageOut,
+    ChatStatusOut,
+    ChatStreamChunk,
+    ChatStreamEvent,
+    RestEndpointStatus,
+)
 
 from .base import BaseChatServer
 
@@ -14,6 +23,9 @@ TEST_MESSAGE = "Test message response.\nMarkdown working? *Yes*.\n[Link test](ht
 
 
 class DummyChatServer(BaseChatServer):
+    stream_chunk_delay: float = 0.02
+    """Delay between streamed words, to imitate a generating model"""
+
     async def send_chat_message(
         self, chat_message: ChatMessageIn
     ) -> List[ChatMessageOut]:
@@ -71,6 +83,19 @@ class DummyChatServer(BaseChatServer):
             )
         ]
 
+    async def stream_chat_message(
+        self, chat_message: ChatMessageIn
+    ) -> AsyncIterator[ChatStreamChunk]:
+        """Local stand-in of a streaming model: streams the reply word by word"""
+        for message in await self.send_chat_message(chat_message):
+            for word in re.findall(r"\s*\S+", message.text or ""):
+                await asyncio.sleep(self.stream_chunk_delay)
+                yield ChatStreamChunk(
+                    event=ChatStreamEvent.DELTA,
+                    data=ChatMessageOut(recipient_id=message.recipient_id, text=word),
+                )
+            yield ChatStreamChunk(event=ChatStreamEvent.MESSAGE, data=message)
+
     async def get_status(self) -> ChatStatusOut:
         """Get Langcorn server health"""
         return ChatStatusOut(status=RestEndpointStatus.OK)
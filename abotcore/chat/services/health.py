@@ -0,0 +1,188 @@
+"""Health of the chat services: background status probes and circuit breakers.
+
+Status of each chat service is probed periodically and cached, so status
+requests don't reach the upstream. While a service is known to be down,
+messages to it fail immediately instead of waiting for the upstream timeout.
+"""
+
+import asyncio
+import logging
+import time
+from enum import Enum
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Optional, Tuple
+
+from fastapi import HTTPException, status
+
+from abotcore.config import ChatEndpointSettings
+from abotcore.schemas import ChatServiceType
+
+from ..schemas import ChatStatusOut, RestEndpointStatus
+
+if TYPE_CHECKING:
+    from .base import BaseChatServer
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures (or a failed status probe).
+    While open, requests are refused. After `reset_timeout` seconds a single trial
+    request is let through (half-open), which closes or re-opens the circuit."""
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+
+    def allow_request(self) -> bool:
+        if self.state == CircuitState.CLOSED:
+            return True
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            # Let a trial request through (again, if the previous trial never finished)
+            self.state = CircuitState.HALF_OPEN
+            self._opened_at = time.monotonic()
+            return True
+        return False
+
+    def retry_after(self) -> float:
+        return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def record_success(self):
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.trip()
+
+    def trip(self):
+        if self.state == CircuitState.CLOSED:
+            self._opened_at = time.monotonic()
+        self.state = CircuitState.OPEN
+
+
+class ChatHealthMonitor:
+    def __init__(
+        self,
+        server_factory: Callable[[ChatServiceType], "BaseChatServer"],
+        probe_interval: float = 10,
+        status_ttl: float = 30,
+        failure_threshold: int = 3,
+        reset_timeout: float = 30,
+    ):
+        self.server_factory = server_factory
+        self.probe_interval = probe_interval
+        self.status_ttl = status_ttl
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        # Last status of each service and when it was probed
+        self._status: Dict[ChatServiceType, Tuple[ChatStatusOut, float]] = {}
+        self._breakers: Dict[ChatServiceType, CircuitBreaker] = {}
+        self._probes: Dict[ChatServiceType, asyncio.Task] = {}
+        self._running = False
+
+    def breaker(self, service: ChatServiceType) -> CircuitBreaker:
+        breaker = self._breakers.get(service)
+        if breaker is None:
+            breaker = self._breakers[service] = CircuitBreaker(
+                self.failure_threshold, self.reset_timeout
+            )
+        return breaker
+
+    async def probe(self, service: ChatServiceType) -> ChatStatusOut:
+        """Request the status from the service, and update the cache and the breaker"""
+        try:
+            service_status = await self.server_factory(service).get_status()
+            if isinstance(service_status, dict):
+                service_status = ChatStatusOut.parse_obj(service_status)
+        except Exception:
+            LOGGER.exception("Status probe of chat service '%s' failed:", service.value)
+            service_status = ChatStatusOut(status=RestEndpointStatus.UNREACHABLE)
+
+        previous = self._status.get(service)
+        self._status[service] = (service_status, time.monotonic())
+        if service_status.status == RestEndpointStatus.OK:
+            self.breaker(service).record_success()
+        else:
+            self.breaker(service).trip()
+        if previous is not None and previous[0].status != service_status.status:
+            LOGGER.warning(
+                "Chat service '%s' is now %s", service.value, service_status.status
+            )
+        return service_status
+
+    async def get_status(self, service: ChatServiceType) -> ChatStatusOut:
+        """Cached status of the service (probed now if there's none, or it is stale)"""
+        cached = self._status.get(service)
+        if self._running and service not in self._probes:
+            self._start_probe(service)
+        if cached is not None and time.monotonic() - cached[1] <= self.status_ttl:
+            return cached[0]
+        return await self.probe(service)
+
+    def ensure_available(self, service: Optional[ChatServiceType]):
+        """Fail fast (503) while the service is known to be down"""
+        if service is None:
+            return
+        breaker = self.breaker(service)
+        if not breaker.allow_request():
+            raise HTTPException(
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Chat service '%s' is currently unavailable" % service.value,
+                headers={"Retry-After": str(max(1, round(breaker.retry_after())))},
+            )
+
+    def record_success(self, service: Optional[ChatServiceType]):
+        if service is not None:
+            self.breaker(service).record_success()
+
+    def record_failure(self, service: Optional[ChatServiceType]):
+        if service is not None:
+            self.breaker(service).record_failure()
+
+    def _start_probe(self, service: ChatServiceType):
+        self._probes[service] = asyncio.create_task(self._probe_loop(service))
+
+    async def _probe_loop(self, service: ChatServiceType):
+        while True:
+            await self.probe(service)
+            await asyncio.sleep(self.probe_interval)
+
+    def start(self, services: Iterable[ChatServiceType]):
+        """Probe the services in the background. Other services are probed after their first status request"""
+        self._running = True
+        for service in services:
+            if service not in self._probes:
+                self._start_probe(service)
+
+    async def stop(self):
+        self._running = False
+        probes, self._probes = list(self._probes.values()), {}
+        for probe in probes:
+            probe.cancel()
+        await asyncio.gather(*probes, return_exceptions=True)
+
+
+@lru_cache()
+def get_health_monitor() -> ChatHealthMonitor:
+    from . import get_shared_chat_server
+
+    settings = ChatEndpointSettings()
+    return ChatHealthMonitor(
+        get_shared_chat_server,
+        probe_interval=settings.chat_health_probe_interval,
+        status_ttl=settings.chat_health_status_ttl,
+        failure_threshold=settings.chat_breaker_failure_threshold,
+        reset_timeout=settings.chat_breaker_reset_timeout,
+    )
@@ -1,20 +1,35 @@
+import json
 import logging
-from typing import List, Optional, Dict, Any
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
 from uuid import uuid4 as uuidv4
 
 import httpx
 from fastapi import HTTPException
-from pydantic import BaseModel, Extra, Field, parse_obj_as
-
-from abotcore.api import LangcornRestClient
-from abotcore.db import Session, get_session
-
-from ..models import ChatHistory, UserChatMemory
+from pydantic import BaseModel, Extra, Field
+
+from abotcore.api import RequestPolicy, get_langcorn_client, get_langcorn_policy
+from abotcore.config import ChatMemorySettings
+from abotcore.db import Session, get_sessionmaker
+
+from ..journal import ChatJournal, get_chat_journal
+from ..memory import (
+    CachedMemory,
+    MemoryCache,
+    get_memory_cache,
+    load_legacy_memory,
+    load_memory_window,
+    memory_appended,
+    memory_versions,
+    memory_window,
+)
 from ..schemas import (
     ChatMessageIn,
     ChatMessageOut,
     ChatRole,
     ChatStatusOut,
+    ChatStreamChunk,
+    ChatStreamEvent,
     RestEndpointStatus,
     Memory,
 )
@@ -49,21 +64,57 @@ class LangResponse(BaseModel, extra=Extra.allow):
     memory: List[Memory]
 
 
+# Streamed replies: lines of JSON objects, or Server-Sent Events with JSON data
+LANGCORN_STREAM_CONTENT_TYPES = ("application/x-ndjson", "text/event-stream")
+LANGCORN_STREAM_ACCEPT = "application/x-ndjson, text/event-stream;q=0.9, application/json;q=0.8"
+
+
+def _parse_stream_line(line: str) -> Optional[Dict[str, Any]]:
+    if line.startswith("data:"):
+        line = line[len("data:"):]
+    elif line.startswith(("event:", "id:", "retry:", ":")):
+        return None
+    line = line.strip()
+    if not line:
+        return None
+    return json.loads(line)
+
+
 LOGGER = logging.getLogger(__name__)
 
+_memory_settings = ChatMemorySettings()
+
 
 class LangcornChatServer(BaseChatServer, arbitrary_types_allowed=True):
     chain_name: str
     input_key: str = "input"
     output_key: str = "output"
-    dbsession: Session = Field(default_factory=get_session)
+    sessionmaker: Optional[Callable[[], Session]] = None
+    """DB sessions are only opened when memory is read from the DB (default: configured DB)"""
+    journal: ChatJournal = Field(default_factory=get_chat_journal)
+    memory_cache: MemoryCache = Field(default_factory=get_memory_cache)
+    request_policy: RequestPolicy = Field(default_factory=get_langcorn_policy)
+    memory_window_entries: Optional[int] = _memory_settings.memory_window_entries
+    memory_window_bytes: Optional[int] = _memory_settings.memory_window_bytes
+
+    def _get_sessionmaker(self) -> Callable[[], Session]:
+        if self.sessionmaker is None:
+            self.sessionmaker = get_sessionmaker()
+        return self.sessionmaker
 
     def _chan_name_path(self):
         return self.chain_name.replace(":", ".")
 
-    async def send_chat_message(
-        self, chat_message: ChatMessageIn
-    ) -> List[ChatMessageOut]:
+    def _run_path(self):
+        return "/%s/run" % self._chan_name_path()
+
+    def _lang_request(
+        self, chat_message: ChatMessageIn, memory: List[Memory]
+    ) -> LangRequest:
+        LOGGER.info("Memory: %s", memory)
+        return LangRequest.parse_obj({self.input_key: chat_message.text, "memory": memory})
+
+    def _assign_sender(self, chat_message: ChatMessageIn):
         if chat_message.sender_id is None:
             chat_message.sender_id = uuidv4().hex
 
@@ -73,80 +124,148 @@ class LangcornChatServer(BaseChatServer, arbitrary_types_allowed=True):
             chat_message.text,
         )
 
+    async def send_chat_message(
+        self, chat_message: ChatMessageIn
+    ) -> List[ChatMessageOut]:
+        self._assign_sender(chat_message)
+
         memory: List[Memory] = await self._get_user_memory(chat_message.sender_id)
 
         await self._insert_chat_history_user(chat_message)
 
-        async with LangcornRestClient() as client:
-            try:
-                LOGGER.info("Memory: %s", memory)
-                lcorn_message: LangRequest = LangRequest.parse_obj(
-                    {self.input_key: chat_message.text, "memory": memory}
-                )
-                response = await client.post(
-                    "/%s/run" % self._chan_name_path(), json=lcorn_message.dict()
-                )
+        client = get_langcorn_client()
+        request = self._lang_request(chat_message, memory).dict()
+        with self._upstream_errors(chat_message):
+            # Hedges and retries only send the request again, the reply is persisted once (below)
+            response = await self.request_policy.send(
+                self._run_path(), lambda: client.post(self._run_path(), json=request)
+            )
+            response.raise_for_status()
+            resp_data = response.json()
+            response_message: LangResponse = LangResponse.parse_obj(resp_data)
+            return await self._complete_reply(response_message, chat_message, memory)
+
+    async def stream_chat_message(
+        self, chat_message: ChatMessageIn
+    ) -> AsyncIterator[ChatStreamChunk]:
+        """Streams the reply when the chain server sends it as NDJSON (or SSE) lines of
+        partial output (`{"delta": "..."}`) followed by the final response object.
+        Otherwise the whole reply is sent as one message when it's ready.
+        History and memory are persisted after the stream is complete."""
+        self._assign_sender(chat_message)
+
+        memory: List[Memory] = await self._get_user_memory(chat_message.sender_id)
+
+        client = get_langcorn_client()
+        with self._upstream_errors(chat_message):
+            async with client.stream(
+                "POST",
+                self._run_path(),
+                json=self._lang_request(chat_message, memory).dict(),
+                headers={"Accept": LANGCORN_STREAM_ACCEPT},
+            ) as response:
                 response.raise_for_status()
-                resp_data = response.json()
-                response_message: LangResponse = LangResponse.parse_obj(resp_data)
-                await self._insert_chat_history_ai(response_message, chat_message)
-                await self._upsert_user_memory(
-                    chat_message.sender_id, response_message.memory
-                )
-                return self._map_response_to_message(response_message, chat_message)
-            except httpx.ConnectError:
-                raise HTTPException(
-                    500, detail="Failed to connect to the Langcorn REST service"
-                )
-            except httpx.ReadTimeout:
-                raise HTTPException(
-                    500, detail="Langcorn REST service took too long to respond"
-                )
-            except httpx.HTTPStatusError as e:
-                LOGGER.warning(
-                    'Failed to respond to the chat message by [%s] "%s" due to an exception in Langcorn:',
-                    chat_message.sender_id,
-                    chat_message.text,
-                    exc_info=e,
-                )
-                LOGGER.info(
-                    "Content received (for above exception):\n%s",
-                    e.request.content.decode(errors="replace"),
-                )
-                raise HTTPException(
-                    500, detail="Failed to generate response: %s" % str(e)
-                )
-            except Exception as e:
-                LOGGER.exception(
-                    'Failed to respond to the chat message by [%s] "%s" due to an exception:',
-                    chat_message.sender_id,
-                    chat_message.text,
-                )
-                raise HTTPException(
-                    500, detail="Failed to generate response: %s" % str(e)
-                )
+                response_message: Optional[LangResponse] = None
+                if response.headers.get("content-type", "").startswith(
+                    LANGCORN_STREAM_CONTENT_TYPES
+                ):
+                    async for line in response.aiter_lines():
+                        data = _parse_stream_line(line)
+                        if data is None:
+                            continue
+                        if "memory" in data:
+                            response_message = LangResponse.parse_obj(data)
+                        elif data.get("delta"):
+                            yield ChatStreamChunk(
+                                event=ChatStreamEvent.DELTA,
+                                data=ChatMessageOut(
+                                    recipient_id=chat_message.sender_id,
+                                    text=data["delta"],
+                                ),
+                            )
+                    if response_message is None:
+                        raise ValueError("Stream ended without the final response")
+                else:
+                    response_message = LangResponse.parse_raw(await response.aread())
+
+            await self._insert_chat_history_user(chat_message)
+            for message in await self._complete_reply(
+                response_message, chat_message, memory
+            ):
+                yield ChatStreamChunk(event=ChatStreamEvent.MESSAGE, data=message)
+
+    async def _complete_reply(
+        self,
+        response_message: LangResponse,
+        chat_message: ChatMessageIn,
+        memory: List[Memory],
+    ) -> List[ChatMessageOut]:
+        await self._insert_chat_history_ai(response_message, chat_message)
+        await self._upsert_user_memory(
+            chat_message.sender_id, memory, response_message.memory
+        )
+        return self._map_response_to_message(response_message, chat_message)
+
+    @contextmanager
+    def _upstream_errors(self, chat_message: ChatMessageIn):
+        """Reports errors of requests to Langcorn as HTTP errors"""
+        try:
+            yield
+        except HTTPException:
+            raise
+        except httpx.ConnectError:
+            raise HTTPException(
+                500, detail="Failed to connect to the Langcorn REST service"
+            )
+        except httpx.ReadTimeout:
+            raise HTTPException(
+                500, detail="Langcorn REST service took too long to respond"
+            )
+        except httpx.HTTPStatusError as e:
+            LOGGER.warning(
+                'Failed to respond to the chat message by [%s] "%s" due to an exception in Langcorn:',
+                chat_message.sender_id,
+                chat_message.text,
+                exc_info=e,
+            )
+            LOGGER.info(
+                "Content received (for above exception):\n%s",
+                e.request.content.decode(errors="replace"),
+            )
+            raise HTTPException(
+                500, detail="Failed to generate response: %s" % str(e)
+            )
+        except Exception as e:
+            LOGGER.exception(
+                'Failed to respond to the chat message by [%s] "%s" due to an exception:',
+                chat_message.sender_id,
+                chat_message.text,
+            )
+            raise HTTPException(
+                500, detail="Failed to generate response: %s" % str(e)
+            )
 
     async def get_status(self) -> LangcornStatusOut:
         """Get Langcorn server health"""
-        async with LangcornRestClient() as client:
-            try:
-                response = await client.get("/ht")
-                endpoints_status: LangcornServerStatus = response.json()
-                endpoint_available_functions: List[str] = endpoints_status.get(
-                    "functions", []
-                )
-                if self.chain_name in endpoint_available_functions:
-                    return LangcornStatusOut(status=LangcornRestStatus.OK)
-                LOGGER.warning(
-                    "Langcorn model endpoint '%s' was unavailable. Available ones: [%s]"
-                    % (self.chain_name, ", ".join(endpoint_available_functions))
-                )
-                return LangcornStatusOut(status=LangcornRestStatus.UNREACHABLE)
-            except (httpx.ConnectError, httpx.ReadTimeout) as e:
-                LOGGER.warning(
-                    "Langcorn chat endpoint was unreachable when requested:", exc_info=e
-                )
-                return LangcornStatusOut(status=LangcornRestStatus.UNREACHABLE)
+        client = get_langcorn_client()
+        try:
+            response = await client.get("/ht")
+            endpoints_status: LangcornServerStatus = response.json()
+            endpoint_available_functions: List[str] = endpoints_status.get(
+                "functions", []
+            )
+            if self.chain_name in endpoint_available_functions:
+                return LangcornStatusOut(status=LangcornRestStatus.OK)
+            LOGGER.warning(
+                "Langcorn model endpoint '%s' was unavailable. Available ones: [%s]"
+                % (self.chain_name, ", ".join(endpoint_available_functions))
+            )
+            return LangcornStatusOut(status=LangcornRestStatus.UNREACHABLE)
+        except (httpx.ConnectError, httpx.ReadTimeout) as e:
+            LOGGER.warning(
+                "Langcorn chat endpoint was unreachable when requested:", exc_info=e
+            )
+            return LangcornStatusOut(status=LangcornRestStatus.UNREACHABLE)
 
     def _map_response_to_message(
         self, msg: LangResponse, user_message: ChatMessageIn
@@ -162,41 +281,81 @@ class LangcornChatServer(BaseChatServer, arbitrary_types_allowed=True):
         return [ChatMessageOut(recipient_id=user_message.sender_id, **msg.output)]
 
     async def _insert_chat_history_user(self, user_message: ChatMessageIn):
-        self.dbsession.add(
-            ChatHistory(
-                chat_handler=self.chain_name,
-                message_client_id=user_message.sender_id,
-                message_role=ChatRole.HUMAN,
-                message_content=user_message.text,
-            )
+        await self.journal.record_history(
+            chat_handler=self.chain_name,
+            message_client_id=user_message.sender_id,
+            message_role=ChatRole.HUMAN,
+            message_content=user_message.text,
         )
-        await self.dbsession.commit()
 
     async def _insert_chat_history_ai(
         self, ai_message: LangResponse, user_message: ChatMessageIn
     ):
-        self.dbsession.add(
-            ChatHistory(
-                chat_handler=self.chain_name,
-                message_client_id=user_message.sender_id,
-                message_role=ChatRole.AI,
-                message_content=ai_message.output.get(self.output_key),
-            )
+        await self.journal.record_history(
+            chat_handler=self.chain_name,
+            message_client_id=user_message.sender_id,
+            message_role=ChatRole.AI,
+            message_content=ai_message.output.get(self.output_key),
         )
-        await self.dbsession.commit()
+
+    async def _cached_memory(self, user_id: str) -> Optional[List[Memory]]:
+        """Cached memory of the user, unless the stored memory changed since (e.g. by another worker)"""
+        cached = self.memory_cache.get(user_id)
+        if cached is None:
+            return None
+        if self.journal.has_pending_memory(user_id):
+            # Written by this worker, not persisted yet
+            return cached.memory
+        if cached.version is None:
+            return None
+        async with self._get_sessionmaker()() as session:
+            versions = await memory_versions(session, [user_id])
+        return cached.memory if versions[user_id] == cached.version else None
 
     async def _get_user_memory(self, user_id: str) -> List[Memory]:
-        chat_memory_obj: Optional[UserChatMemory] = await self.dbsession.get(
-            UserChatMemory, user_id
-        )
-        if chat_memory_obj is None:
-            return []
-        return parse_obj_as(List[Memory], chat_memory_obj.memory_data)
-
-    async def _upsert_user_memory(self, user_id: str, memory_list: List[Memory]):
-        await self.dbsession.merge(
-            UserChatMemory(
-                user_id=user_id, memory_data=list(map(Memory.dict, memory_list))
+        memory = await self._cached_memory(user_id)
+        if memory is not None:
+            return list(memory)
+
+        if self.journal.has_pending_memory(user_id):
+            # Written recently, but not persisted yet
+            await self.journal.flush()
+
+        async with self._get_sessionmaker()() as session:
+            # Read before the entries: if they change in between, the cached memory is just reloaded
+            versions = await memory_versions(session, [user_id])
+            memory = await load_memory_window(
+                session, user_id, self.memory_window_entries, self.memory_window_bytes
             )
+            legacy_memory = None
+            if memory is None:
+                legacy_memory = await load_legacy_memory(session, user_id)
+
+        if memory is not None:
+            self.memory_cache.put(user_id, CachedMemory(memory, versions[user_id]))
+            return list(memory)
+
+        memory = memory_window(
+            legacy_memory or [], self.memory_window_entries, self.memory_window_bytes
+        )
+        # The version of carried over memory is set once it's written
+        self.memory_cache.put(user_id, CachedMemory(memory, None if memory else versions[user_id]))
+        if memory:
+            # Carry over the memory into entries
+            await self.journal.record_memory(user_id, memory, replace=True)
+        return list(memory)
+
+    async def _upsert_user_memory(
+        self, user_id: str, sent_memory: List[Memory], memory_list: List[Memory]
+    ):
+        entries, replace = memory_appended(sent_memory, memory_list)
+        self.memory_cache.put(
+            user_id,
+            CachedMemory(
+                memory_window(
+                    memory_list, self.memory_window_entries, self.memory_window_bytes
+                ),
+                None,
+            ),
         )
-        await self.dbsession.commit()
+        await self.journal.record_memory(user_id, entries, replace=replace)
@@ -0,0 +1,161 @@
+"""Streaming receiver of file uploads (multipart/form-data).
+
+The file is written to its destination chunk by chunk as the request body
+arrives (file I/O in a worker thread), so memory use doesn't depend on the
+size of the file, and the size limit is enforced before the body is read whole.
+"""
+
+import asyncio
+import hashlib
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import mkstemp
+from typing import BinaryIO, List, Optional, Tuple
+
+import multipart
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import parse_options_header
+from starlette.requests import Request
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadTooLarge(UploadError):
+    pass
+
+
+@dataclass
+class ReceivedUpload:
+    path: str
+    filename: str
+    size: int
+    sha256: str
+    """Hex digest of the content, computed while writing"""
+
+
+class _UploadReceiver:
+    """Callbacks of the multipart parser. Collects data of the file field, to be written after each chunk"""
+
+    def __init__(self, field_name: str, max_size: Optional[int]):
+        self.field_name = field_name
+        self.max_size = max_size
+        self.filename: Optional[str] = None
+        self.size = 0
+        self.complete = False
+        self._data: List[bytes] = []
+        self._in_field = False
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+
+    def callbacks(self):
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        }
+
+    def on_part_begin(self):
+        self._disposition = b""
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name = self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        self._in_field = (
+            not self.complete
+            and self.filename is None
+            and options.get(b"name") == self.field_name.encode()
+            and b"filename" in options
+        )
+        if self._in_field:
+            self.filename = options[b"filename"].decode(errors="replace")
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if not self._in_field:
+            return
+        self.size += end - start
+        if self.max_size is not None and self.size > self.max_size:
+            raise UploadTooLarge("File is larger than %d bytes" % self.max_size)
+        self._data.append(data[start:end])
+
+    def on_part_end(self):
+        if self._in_field:
+            self._in_field = False
+            self.complete = True
+
+    def take_data(self) -> bytes:
+        data, self._data = b"".join(self._data), []
+        return data
+
+
+def _open_destination(directory: Path, filename: str) -> Tuple[BinaryIO, str]:
+    fd, path = mkstemp(dir=directory, prefix=".upload-", suffix="_%s" % os.path.basename(filename or "download"))
+    # Grant RW to owner, groups and others
+    if hasattr(os, "fchmod"):
+        os.fchmod(fd, 0o666)
+    return os.fdopen(fd, "wb"), path
+
+
+def _write(file: BinaryIO, digest, data: bytes):
+    digest.update(data)
+    file.write(data)
+
+
+def _discard(file: BinaryIO, path: str):
+    file.close()
+    os.remove(path)
+
+
+async def receive_upload(
+    request: Request, directory: Path, field_name: str = "file", max_size: Optional[int] = None
+) -> ReceivedUpload:
+    """Write the file of the form field into a new file in the directory"""
+    content_type, params = parse_options_header(request.headers.get("Content-Type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadError("Expected a multipart/form-data request")
+
+    receiver = _UploadReceiver(field_name, max_size)
+    parser = multipart.MultipartParser(params[b"boundary"], receiver.callbacks())
+    file: Optional[BinaryIO] = None
+    path = None
+    digest = hashlib.sha256()
+    try:
+        async for chunk in request.stream():
+            try:
+                parser.write(chunk)
+            except MultipartParseError as e:
+                raise UploadError("Invalid multipart/form-data: %s" % e)
+            if receiver.filename is not None and file is None:
+                file, path = await asyncio.to_thread(_open_destination, directory, receiver.filename)
+            data = receiver.take_data()
+            if data:
+                await asyncio.to_thread(_write, file, digest, data)
+        parser.finalize()
+        if not receiver.complete:
+            raise UploadError("No file in the form field '%s'" % field_name)
+        await asyncio.to_thread(file.close)
+    except BaseException:
+        # Including disconnects, don't leave partial files (the thread completes even if cancelled again)
+        if file is not None:
+            await asyncio.to_thread(_discard, file, path)
+        raise
+    return ReceivedUpload(
+        path=path, filename=receiver.filename, size=receiver.size, sha256=digest.hexdigest()
+    )
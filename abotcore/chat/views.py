@@ -1,17 +1,44 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    Query,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+    status,
+)
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 
+import asyncio
+import base64
+import binascii
+import logging
 import os
-from tempfile import mkstemp
-
-from .schemas import ChatMessageIn, ChatMessageOut, ChatStatusOut
-from .services import (
-    BaseChatServer,
-    DummyChatServer,
-    RasaChatServer,
-    LangcornChatServer,
+from collections import defaultdict
+from datetime import datetime
+from uuid import uuid4 as uuidv4
+
+from .schemas import (
+    ChatBatchItemOut,
+    ChatHistoryOut,
+    ChatHistoryPage,
+    ChatMessageIn,
+    ChatMessageOut,
+    ChatStatusOut,
+    ChatStreamChunk,
+    ChatStreamEvent,
 )
+from .archive import get_history_archive
+from .filecache import get_file_cache_store
+from .journal import get_chat_journal
+from .models import ChatHistory
+from .services import BaseChatServer, get_shared_chat_server
+from .uploads import UploadError, UploadTooLarge, receive_upload
 
 from abotcore.db import Session, get_session
+from abotcore.responses import FastJSONResponse
 from abotcore.schemas import ChatServiceType
 from abotcore.config import (
     ChatEndpointSettings,
@@ -19,10 +46,11 @@ from abotcore.config import (
     joinurl,
 )
 
-from typing import List, Dict, Callable
-from functools import partial
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
 
+LOGGER = logging.getLogger(__name__)
+
 _base_endpoint = ChatEndpointSettings()
 
 
@@ -31,43 +59,202 @@ router = APIRouter(prefix="/chat")
 chat_webhook = APIRouter(prefix="/webhook")
 
 
-CHAT_SERVICE_MAP: Dict[str, Callable[..., BaseChatServer]] = {
-    ChatServiceType.DUMMY: DummyChatServer,
-    ChatServiceType.RASA: RasaChatServer,
-    ChatServiceType.LANGCHAIN_GENESIS: partial(
-        LangcornChatServer, chain_name="genesis.langcorn:chain"
-    ),
-    ChatServiceType.LANGCHAIN_FUNCTION: partial(
-        LangcornChatServer, chain_name="logic:chain"
-    ),
-}
+@router.on_event("startup")
+async def check_file_cache():
+    # Fails startup if the cache's index would be served
+    cache_directory = FileCacheServerSettings.get_cache_storage_path()
+    if cache_directory is not None:
+        get_file_cache_store(cache_directory)
 
 
 async def get_chat_server(
     service: ChatServiceType = _base_endpoint.chat_endpoint_server,
-    abot_dbsession: Session = Depends(get_session),
 ) -> BaseChatServer:
-    return CHAT_SERVICE_MAP[service](dbsession=abot_dbsession)
+    return get_shared_chat_server(service)
+
+
+def _messages_response(messages: List[ChatMessageOut], by_alias: bool) -> FastJSONResponse:
+    """Reply messages, without validating them again (the chat server built them).
+    Same JSON as the response model options of the chat routes give"""
+    return FastJSONResponse(
+        [message.dict(by_alias=by_alias, exclude_unset=True, exclude_none=True) for message in messages]
+    )
 
 
 # Default route (/chat)
-# Chat endpoint service webhook
 @router.post(
     "",
+    response_model=List[ChatMessageOut],
     response_model_exclude_unset=True,
     response_model_exclude_none=True,
     response_model_by_alias=False,
 )
+async def chat_service_hook(
+    msg: ChatMessageIn, server: BaseChatServer = Depends(get_chat_server)
+) -> FastJSONResponse:
+    """Get the selected chat server's response to the user's message"""
+    return _messages_response(await server(msg), by_alias=False)
+
+
+# Chat endpoint service webhook (messages' text is named by its alias, "output")
 @chat_webhook.post(
     "/{service:str}",
+    response_model=List[ChatMessageOut],
     response_model_exclude_unset=True,
     response_model_exclude_none=True,
 )
-async def chat_service_hook(
+async def chat_service_webhook(
     msg: ChatMessageIn, server: BaseChatServer = Depends(get_chat_server)
-) -> List[ChatMessageOut]:
+) -> FastJSONResponse:
     """Get the selected chat server's response to the user's message"""
-    return await server(msg)
+    return _messages_response(await server(msg), by_alias=True)
+
+
+async def _reply_batch(
+    server: BaseChatServer, messages: List[ChatMessageIn], concurrency: int
+) -> List[ChatBatchItemOut]:
+    """Replies to the messages, in the same order. Messages of the same sender are sent
+    one after another (in the given order), others concurrently up to the limit"""
+    semaphore = asyncio.Semaphore(concurrency)
+    results: List[Optional[ChatBatchItemOut]] = [None] * len(messages)
+
+    # Positions of the messages of each sender. Messages without sender are independent
+    sender_queues: Dict[Any, List[int]] = defaultdict(list)
+    for i, msg in enumerate(messages):
+        sender_queues[msg.sender_id if msg.sender_id is not None else ("", i)].append(i)
+
+    async def _reply(i: int) -> ChatBatchItemOut:
+        try:
+            async with semaphore:
+                return ChatBatchItemOut(messages=await server(messages[i]))
+        except HTTPException as e:
+            return ChatBatchItemOut(status_code=e.status_code, detail=e.detail)
+        except Exception as e:
+            LOGGER.exception("Failed to reply to message %d of the batch:", i)
+            return ChatBatchItemOut(status_code=500, detail=str(e))
+
+    async def _reply_sender(positions: List[int]):
+        for i in positions:
+            results[i] = await _reply(i)
+
+    await asyncio.gather(*map(_reply_sender, sender_queues.values()))
+    return results
+
+
+# Replies to many messages (of any senders) at once
+@router.post(
+    "/batch",
+    response_model=List[ChatBatchItemOut],
+    response_model_exclude_none=True,
+    response_model_by_alias=False,
+)
+@chat_webhook.post(
+    "/{service:str}/batch",
+    response_model=List[ChatBatchItemOut],
+    response_model_exclude_none=True,
+    response_model_by_alias=False,
+)
+async def chat_service_batch(
+    messages: List[ChatMessageIn], server: BaseChatServer = Depends(get_chat_server)
+):
+    """Get the selected chat server's responses to a list of messages, in the same order"""
+    if len(messages) > _base_endpoint.chat_batch_max_size:
+        raise HTTPException(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail="At most %d messages are allowed per batch" % _base_endpoint.chat_batch_max_size,
+        )
+    results = await _reply_batch(server, messages, _base_endpoint.chat_batch_concurrency)
+    # Built here, no need to validate again (same JSON as the response model options)
+    return FastJSONResponse([result.dict(exclude_none=True) for result in results])
+
+
+async def _stream_chunks(
+    chunks: AsyncIterator[ChatStreamChunk],
+) -> AsyncIterator[ChatStreamChunk]:
+    """Chunks of the reply, ending with either a "done" or an "error" chunk"""
+    try:
+        async for chunk in chunks:
+            yield chunk
+    except HTTPException as e:
+        yield ChatStreamChunk(event=ChatStreamEvent.ERROR, detail=e.detail)
+        return
+    except Exception as e:
+        LOGGER.exception("Failed to stream the reply to the chat message:")
+        yield ChatStreamChunk(event=ChatStreamEvent.ERROR, detail=str(e))
+        return
+    yield ChatStreamChunk(event=ChatStreamEvent.DONE)
+
+
+def _encode_chunk(chunk: ChatStreamChunk) -> str:
+    return chunk.json(exclude_none=True)
+
+
+async def _sse_stream(chunks: AsyncIterator[ChatStreamChunk]) -> AsyncIterator[str]:
+    async for chunk in chunks:
+        yield "event: %s\ndata: %s\n\n" % (chunk.event.value, _encode_chunk(chunk))
+
+
+async def _ndjson_stream(chunks: AsyncIterator[ChatStreamChunk]) -> AsyncIterator[str]:
+    async for chunk in chunks:
+        yield _encode_chunk(chunk) + "\n"
+
+
+# Streamed reply of the chat server (as Server-Sent Events, or NDJSON if accepted)
+@router.post("/stream", response_class=StreamingResponse)
+@chat_webhook.post("/{service:str}/stream", response_class=StreamingResponse)
+async def chat_service_stream(
+    msg: ChatMessageIn,
+    request: Request,
+    server: BaseChatServer = Depends(get_chat_server),
+):
+    """Stream the selected chat server's response to the user's message, as it is generated"""
+    chunks = _stream_chunks(server.stream(msg))
+    if "application/x-ndjson" in request.headers.get("accept", ""):
+        return StreamingResponse(_ndjson_stream(chunks), media_type="application/x-ndjson")
+    return StreamingResponse(
+        _sse_stream(chunks),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _send_error_chunk(websocket: WebSocket, detail: str):
+    await websocket.send_text(
+        _encode_chunk(ChatStreamChunk(event=ChatStreamEvent.ERROR, detail=detail))
+    )
+
+
+# Conversation over a WebSocket: ChatMessageIn frames in, chunks of the replies out
+@router.websocket("/ws")
+@chat_webhook.websocket("/{service:str}/ws")
+async def chat_service_websocket(
+    websocket: WebSocket,
+    sender_id: Optional[str] = None,
+    server: BaseChatServer = Depends(get_chat_server),
+):
+    """Chat with the selected server over one connection. Sender of all messages is the
+    `sender_id` query parameter, or else the one of the first message (or a new one)"""
+    await websocket.accept()
+    try:
+        while True:
+            try:
+                msg = ChatMessageIn.parse_raw(await websocket.receive_text())
+            except ValidationError as e:
+                await _send_error_chunk(websocket, str(e))
+                continue
+
+            if sender_id is None:
+                sender_id = msg.sender_id or uuidv4().hex
+            msg.sender_id = sender_id
+
+            try:
+                async for chunk in _stream_chunks(server.stream(msg)):
+                    await websocket.send_text(_encode_chunk(chunk))
+            except HTTPException as e:
+                # Service is down
+                await _send_error_chunk(websocket, e.detail)
+    except WebSocketDisconnect:
+        pass
 
 
 # Chat endpoint status webhook
@@ -76,8 +263,64 @@ async def chat_service_hook(
 async def chat_service_status(
     server: BaseChatServer = Depends(get_chat_server),
 ) -> ChatStatusOut:
-    """Heartbeat and status enquiry of selected server"""
-    return await server.get_status()
+    """Heartbeat and status enquiry of selected server (cached, see services/health.py)"""
+    return await server.health.get_status(server.service_type)
+
+
+def _encode_history_cursor(message: ChatHistoryOut) -> str:
+    position = "%s|%d" % (message.message_time.isoformat(), message.chat_message_id)
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def _decode_history_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        message_time, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(message_time), int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Invalid history cursor")
+
+
+@router.get("/history/{sender_id:str}")
+async def chat_history(
+    sender_id: str,
+    handler: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    abot_dbsession: Session = Depends(get_session),
+) -> ChatHistoryPage:
+    """Chat history of the sender (optionally of one chat handler), newest first.
+    Pass `next_cursor` of a page as `cursor` to get the next page"""
+    before = None if cursor is None else _decode_history_cursor(cursor)
+
+    # Read the sender's own messages that are still in the write-behind buffer
+    journal = get_chat_journal()
+    if journal.has_pending_history(sender_id):
+        await journal.flush()
+
+    messages = list(
+        map(
+            ChatHistoryOut.from_orm,
+            await ChatHistory.history_page(
+                abot_dbsession, sender_id, limit + 1, chat_handler=handler, before=before
+            ),
+        )
+    )
+
+    # Older messages continue in the archive
+    archive = get_history_archive()
+    if len(messages) <= limit and archive is not None:
+        if messages:
+            before = (messages[-1].message_time, messages[-1].chat_message_id)
+        archived = await archive.read_page(
+            sender_id, limit + 1 - len(messages), chat_handler=handler, before=before
+        )
+        messages.extend(map(ChatHistoryOut.parse_obj, archived))
+
+    next_cursor = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        next_cursor = _encode_history_cursor(messages[-1])
+    return ChatHistoryPage(messages=messages, next_cursor=next_cursor)
 
 
 def resolve_cache_file_public_url(cache_save: str, file_path: str):
@@ -87,30 +330,45 @@ def resolve_cache_file_public_url(cache_save: str, file_path: str):
     return joinurl(cache_base_url, os.path.relpath(file_path, cache_save))
 
 
-@router.post("/cache")
-async def gen_cache(file: UploadFile) -> dict:
+@router.post(
+    "/cache",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {"file": {"type": "string", "format": "binary"}},
+                        "required": ["file"],
+                    }
+                }
+            },
+        }
+    },
+)
+async def gen_cache(request: Request) -> dict:
+    """Store the uploaded file (form field `file`) in the cache. The upload is streamed to disk.
+    Files are content-addressed, so uploading the same content again returns the same URL"""
     cache_save = FileCacheServerSettings.get_cache_storage_path()
 
     if cache_save is None:
-        return HTTPException(501, detail="Cache was not set-up, can't create the file.")
+        raise HTTPException(501, detail="Cache was not set-up, can't create the file.")
 
     if not cache_save.exists():
-        return HTTPException(501, detail="Cache storage directory isn't properly initialized, can't create the file.")
-
-    in_fname = file.filename or 'download'
-
-    tmp_fd, file_path = mkstemp(dir=cache_save, suffix="_%s" % in_fname)
-
-    # Grant RW to owner, groups and others
-    if hasattr(os, 'fchmod'):
-        os.fchmod(tmp_fd, 0o666)
-
-    with os.fdopen(tmp_fd, "wb") as f:
-        f.write(await file.read())
+        raise HTTPException(501, detail="Cache storage directory isn't properly initialized, can't create the file.")
 
-    await file.close()
+    try:
+        upload = await receive_upload(
+            request, cache_save, max_size=FileCacheServerSettings.get_cache_max_upload_size()
+        )
+    except UploadTooLarge as e:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except UploadError as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e))
 
-    return {"url": resolve_cache_file_public_url(cache_save, file_path)}
+    path = await get_file_cache_store(cache_save).store(upload)
+    return {"url": resolve_cache_file_public_url(cache_save, path)}
 
 
 router.include_router(chat_webhook)
@@ -2,6 +2,7 @@
 
 import logging
 from functools import lru_cache
+from pathlib import Path
 from typing import List, Union, Optional
 
 from .schemas import ChatServiceType
@@ -19,17 +20,60 @@ class ServerSettings(BaseBackendSettings):
     cors_origins: List[str] = ["*"]
     app_log_level: Union[int, str] = logging.INFO
     static_serve_directory: Optional[DirectoryPath] = None
+    static_cache_control: str = "no-cache"
+    """Cache-Control of static files (content-addressed files are always cached for a year)"""
+    static_compress_min_size: int = 1024
+    static_compress_max_size: Optional[int] = 10 * 1024 * 1024
+    """Largest text file that's compressed on the first request (None: only precompressed .br/.gz files are used)"""
 
 
 class EndpointSettings(BaseBackendSettings):
-    rasa_rest_endpoint_base: AnyUrl = "http://localhost:5005"
+    rasa_rest_endpoint_base: Union[AnyUrl, List[AnyUrl]] = "http://localhost:5005"
+    """One URL, or a JSON list of replicas' URLs (load balanced, sticky by sender)"""
     actions_endpoint_base: AnyUrl = "http://localhost:5055"
-    langcorn_endpoint_base: AnyUrl = "http://localhost:7860"
+    langcorn_endpoint_base: Union[AnyUrl, List[AnyUrl]] = "http://localhost:7860"
+    """One URL, or a JSON list of replicas' URLs (load balanced)"""
+
+    # Passive health check of replicas: consecutive failures after which a replica
+    # is ejected, and for how many seconds
+    upstream_max_failures: int = 3
+    upstream_ejection_time: float = 30
+
+    # Retries and hedged requests may add at most this ratio of requests (plus a few per second)
+    retry_budget_ratio: float = 0.1
+    retry_budget_min_per_second: float = 1
+    langcorn_max_retries: int = 1
+    """Retries of Langcorn requests that failed to connect or got 502/503/504"""
+    langcorn_hedging: bool = False
+    """Send a second copy of slow Langcorn requests (to another replica) and use the first reply"""
+    langcorn_hedge_quantile: float = 0.95
+    """Quantile of recent latencies after which a request is hedged"""
+    langcorn_hedge_min_delay: float = 1
+
+    # Request timeouts (seconds) per upstream
+    rasa_timeout: float = 30
+    actions_timeout: float = 30
+    langcorn_timeout: float = 90
+    fulfillment_timeout: float = 30
+
+    # Connection pool limits of each long-lived upstream client
+    http_pool_max_connections: Optional[int] = 100
+    http_pool_max_keepalive_connections: Optional[int] = 20
+    http_pool_keepalive_expiry: Optional[float] = 30
 
 
 class FileCacheServerSettings(BaseBackendSettings):
     cache_public_base: AnyUrl = "http://localhost:8000/static/"
     cache_directory: Optional[DirectoryPath] = None
+    cache_max_upload_size: Optional[int] = 100 * 1024 * 1024
+    """Largest file (bytes) that can be uploaded to the cache (/chat/cache)"""
+    cache_max_size: Optional[int] = None
+    """Quota (bytes) of all cached files, least recently used files are evicted over it"""
+    cache_max_age: Optional[float] = None
+    """Seconds since the last upload after which a cached file is evicted"""
+    cache_index_file: Optional[Path] = None
+    """Index of the cached files, shared by the workers (default: in the temporary directory). It lists all
+    cached files, so it must not be in the served (static) directory"""
 
     @classmethod
     @lru_cache()
@@ -41,10 +85,106 @@ class FileCacheServerSettings(BaseBackendSettings):
     def get_cache_storage_path(cls):
         return cls().cache_directory
 
+    @classmethod
+    @lru_cache()
+    def get_cache_max_upload_size(cls):
+        return cls().cache_max_upload_size
+
 
 class ChatEndpointSettings(BaseBackendSettings):
     chat_endpoint_server: ChatServiceType = ChatServiceType.DUMMY
     """Which endpoint server handles the /chat endpoint (See ChatServiceType enum in schemas.py)"""
+    chat_idempotency_ttl: float = 600
+    """Seconds that replies are kept to answer retried messages (with the same idempotency key)"""
+    chat_idempotency_max_entries: int = 10000
+
+    chat_batch_concurrency: int = 8
+    """Messages of a batch (/chat/batch) that are sent to the chat server at the same time"""
+    chat_batch_max_size: int = 1000
+
+    # Health of the chat services
+    chat_health_probe_services: Optional[List[ChatServiceType]] = None
+    """Services probed from startup (default: chat_endpoint_server). Others are probed after being requested"""
+    chat_health_probe_interval: float = 10
+    chat_health_status_ttl: float = 30
+    """Age of the cached status after which a status request probes the service itself"""
+    chat_breaker_failure_threshold: int = 3
+    """Consecutive failed messages after which a service is treated as down"""
+    chat_breaker_reset_timeout: float = 30
+    """Seconds until a message is let through again to a service that is down"""
+
+
+class ChatJournalSettings(BaseBackendSettings):
+    chat_journal_enabled: bool = True
+    """Persist chat history and memory in the background (write-behind). When disabled, each write is awaited"""
+    chat_journal_max_batch: int = 100
+    """Pending writes that trigger a flush before the interval elapses"""
+    chat_journal_flush_interval: float = 0.5
+    chat_journal_max_pending: int = 10000
+    """Upper bound of buffered history rows (oldest are dropped if the DB stays unavailable)"""
+    chat_journal_max_retries: int = 3
+    """Failed writes of a batch (while the DB is reachable) before its rows are written one by one"""
+
+
+class ChatMemorySettings(BaseBackendSettings):
+    # Memory window: only the most recent entries are loaded and sent to the chain,
+    # older entries are archived
+    memory_window_entries: Optional[int] = 40
+    memory_window_bytes: Optional[int] = None
+    """Budget of the window's text content. Only applied when loading, archiving is by entries"""
+
+    # In-process cache of parsed user memory (per worker). A cached memory is only used if the stored
+    # memory wasn't changed since (e.g. by another worker), which is checked on each turn (latest entry id)
+    memory_cache_max_entries: Optional[int] = 1024
+    memory_cache_max_bytes: Optional[int] = 64 * 1024 * 1024
+    memory_cache_ttl: Optional[float] = 300
+    """Seconds until a cached memory is dropped (e.g. of users that are gone)"""
+
+
+class ChatHistorySettings(BaseBackendSettings):
+    history_partitioning: bool = True
+    """Create chat_history partitioned by month of message_time (PostgreSQL, only when the table is created)"""
+    history_partitions_ahead: int = 2
+    """Months of partitions that are created in advance"""
+
+    # Retention: whole months older than the retention are moved to the archive directory (Parquet)
+    history_retention_days: Optional[int] = None
+    """Age of messages that are archived. Disabled if not set"""
+    history_archive_directory: Optional[DirectoryPath] = None
+    history_archive_compression: str = "zstd"
+    history_retention_interval: float = 3600
+
+
+class FulfillmentSettings(BaseBackendSettings):
+    fulfillment_registry_refresh_interval: float = 60
+    """Seconds between reloads of the fulfillments (changes made by other workers)"""
+    fulfillment_sync_interval: Optional[float] = 300
+    """Seconds between syncs of the fulfillments with their manifests (disabled if not set)"""
+    fulfillment_sync_concurrency: int = 8
+    fulfillment_sync_jitter: float = 0.1
+    """Fraction of the sync interval by which syncs are randomly shifted and spread"""
+
+    # Cache of GET responses of fulfillments (by their Cache-Control)
+    fulfillment_cache_enabled: bool = False
+    fulfillment_cache_max_bytes: int = 64 * 1024 * 1024
+    fulfillment_cache_max_entry_size: int = 1024 * 1024
+    """Largest response body that's cached (responses without Content-Length aren't cached)"""
+    fulfillment_cache_directory: Optional[DirectoryPath] = None
+    """Directory of the disk tier (responses are also kept there, e.g. across restarts). Disabled if not set"""
+    fulfillment_cache_disk_max_bytes: Optional[int] = 1024 * 1024 * 1024
+    """Budget of the disk tier, applied by each worker to the files it uses"""
+    fulfillment_cache_stale_while_revalidate: float = 0
+    """Seconds a stale response is served while revalidated, if the fulfillment doesn't set stale-while-revalidate"""
+
+
+class StatisticsSettings(BaseBackendSettings):
+    statistics_processes: Optional[int] = None
+    """Worker processes for large inputs (default: number of CPUs, 0: all work runs in threads)"""
+    statistics_threads: int = 4
+    statistics_process_min_size: int = 1024 * 1024
+    """Request bodies (bytes) under this size are parsed and computed in a thread (not worth sending to a process)"""
+    statistics_max_pending: int = 32
+    """Requests running or queued in the workers, over which requests are rejected (503)"""
 
 
 class DBSettings(BaseBackendSettings):
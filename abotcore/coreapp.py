@@ -7,13 +7,14 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 
 # Routers
-from abotcore import chat
+from abotcore import chat, fulfillment
 from abotcore.config import ServerSettings
+from abotcore.responses import FastJSONResponse
 
 
 def create_app() -> FastAPI:
     """Application instance"""
-    app = FastAPI()
+    app = FastAPI(default_response_class=FastJSONResponse)
     settings = ServerSettings()
 
     logging.basicConfig(level=settings.app_log_level)
@@ -33,11 +34,16 @@ def create_app() -> FastAPI:
 
     # Static folder serve
     if settings.static_serve_directory is not None:
-        from fastapi.staticfiles import StaticFiles
+        from abotcore.staticfiles import CachingStaticFiles
 
         app.mount(
             "/static",
-            StaticFiles(directory=settings.static_serve_directory),
+            CachingStaticFiles(
+                directory=settings.static_serve_directory,
+                cache_control=settings.static_cache_control,
+                compress_min_size=settings.static_compress_min_size,
+                compress_max_size=settings.static_compress_max_size,
+            ),
             name="static",
         )
 
@@ -49,11 +55,13 @@ def create_app() -> FastAPI:
         from abotcore.db import (
             Base,
             Connection,
+            create_missing_indexes,
             get_engine,
             get_schema_mapping,
         )
         from sqlalchemy.schema import CreateSchema
         from multiprocessing import Lock
+        from abotcore.chat.archive import create_partitioned_history
 
         engine = get_engine()
         conn: Connection
@@ -76,12 +84,66 @@ def create_app() -> FastAPI:
                         for schema_name in Base.metadata._schemas
                     ]
                 )
+                await conn.run_sync(create_partitioned_history)
                 logger.info("Creating/updating tables (if needed)...")
                 await conn.run_sync(Base.metadata.create_all)
+                await conn.run_sync(create_missing_indexes, Base.metadata)
 
-            # sessionmaker = get_sessionmaker()
-            # async with sessionmaker() as db:
-            #     await fulfillment.FulfillmentSync(db).sync_all(True)
+    @app.on_event("startup")
+    async def open_upstream_clients():
+        from abotcore.api import get_client_pool
+
+        logger.info("Opening upstream HTTP connection pools...")
+        get_client_pool().open()
+
+    @app.on_event("shutdown")
+    async def close_upstream_clients():
+        from abotcore.api import get_client_pool
+
+        logger.info("Closing upstream HTTP connection pools...")
+        await get_client_pool().aclose()
+
+    @app.on_event("startup")
+    async def start_chat_journal():
+        from abotcore.chat.journal import get_chat_journal
+
+        await get_chat_journal().start()
+
+    @app.on_event("shutdown")
+    async def stop_chat_journal():
+        from abotcore.chat.journal import get_chat_journal
+
+        logger.info("Writing pending chat history and memory...")
+        await get_chat_journal().stop()
+
+    @app.on_event("startup")
+    async def start_chat_health_probes():
+        from abotcore.config import ChatEndpointSettings
+        from abotcore.chat.services.health import get_health_monitor
+
+        chat_settings = ChatEndpointSettings()
+        get_health_monitor().start(
+            chat_settings.chat_health_probe_services
+            or [chat_settings.chat_endpoint_server]
+        )
+
+    @app.on_event("shutdown")
+    async def stop_chat_health_probes():
+        from abotcore.chat.services.health import get_health_monitor
+
+        await get_health_monitor().stop()
+
+    @app.on_event("startup")
+    async def start_chat_history_maintenance():
+        from abotcore.chat.archive import get_history_maintenance
+
+        get_history_maintenance().start()
+
+    @app.on_event("shutdown")
+    async def stop_chat_history_maintenance():
+        from abotcore.chat.archive import get_history_maintenance
+
+        await get_history_maintenance().stop()
 
     """ Exception handlers """
 
@@ -96,5 +158,6 @@ def create_app() -> FastAPI:
 
     # Add routes to the application
     app.include_router(chat.router)
+    app.include_router(fulfillment.router)
 
     return app
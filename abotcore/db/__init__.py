@@ -2,4 +2,4 @@
 from .base import Base
 from .engine import Session, Transaction, Connection, get_engine, get_sessionmaker, get_schema_mapping
 from .session import get_session
-from .utils import ReadableMixin
+from .utils import ReadableMixin, create_missing_indexes
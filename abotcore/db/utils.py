@@ -1,5 +1,6 @@
 
-from sqlalchemy import select
+from sqlalchemy import MetaData, select
+from sqlalchemy.engine import Connection as SyncConnection
 from sqlalchemy.engine.result import ScalarResult
 
 from .session import Session
@@ -9,3 +10,10 @@ class ReadableMixin:
     @classmethod
     async def read_all(cls, session: Session) -> ScalarResult:
         return await session.scalars(select(cls))
+
+
+def create_missing_indexes(conn: SyncConnection, metadata: MetaData):
+    """Create indexes that were added to tables that already exist (`create_all` skips them)"""
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
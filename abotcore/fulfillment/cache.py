@@ -0,0 +1,417 @@
+"""Cache of fulfillment GET responses (opt-in), as a shared HTTP cache would do.
+
+Responses are cached by URL (and Accept-Encoding) as long as the fulfillment's
+Cache-Control allows it, in a memory-bounded LRU and optionally in a directory
+on disk. Stale responses with a validator (ETag/Last-Modified) are revalidated
+with a conditional request: in the background while they may still be served
+(`stale-while-revalidate`), or before answering otherwise. Concurrent misses of
+the same URL wait for a single upstream request.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from pathlib import Path
+from tempfile import mkstemp
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+
+from abotcore.cache import LRUCache
+from abotcore.config import FulfillmentSettings
+
+from .proxy import REQUEST_EXCLUDED_HEADERS, RawHeaders, filter_headers, send_upstream, streaming_response
+
+logger = logging.getLogger(__name__)
+
+# Requests that are answered by the fulfillment itself: personalized, conditional or partial
+BYPASS_REQUEST_HEADERS = ("authorization", "cookie", "if-none-match", "if-modified-since", "range")
+# Headers of a 304 that update the cached response
+REVALIDATION_HEADERS = (b"cache-control", b"date", b"etag", b"expires", b"last-modified")
+
+
+def parse_cache_control(value: str) -> Dict[str, Optional[str]]:
+    directives = {}
+    for directive in value.split(","):
+        name, _, argument = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else None
+    return directives
+
+
+def _seconds(directives: Dict[str, Optional[str]], name: str) -> Optional[float]:
+    try:
+        return max(0.0, float(directives[name]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    url: str
+    status_code: int
+    headers: RawHeaders
+    body: bytes
+    stored_at: float
+    lifetime: float
+    """Seconds for which the response is fresh"""
+    stale_while_revalidate: float = 0
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(name) + len(value) for name, value in self.headers)
+
+    def header(self, name: bytes) -> Optional[str]:
+        for header_name, value in self.headers:
+            if header_name == name:
+                return value.decode("latin-1")
+        return None
+
+    def age(self, now: float) -> float:
+        return max(0.0, now - self.stored_at)
+
+    def is_fresh(self, now: float) -> bool:
+        return self.age(now) < self.lifetime
+
+    def may_serve_stale(self, now: float) -> bool:
+        return self.age(now) < self.lifetime + self.stale_while_revalidate
+
+    def validators(self) -> Dict[str, str]:
+        headers = {}
+        if self.header(b"etag") is not None:
+            headers["If-None-Match"] = self.header(b"etag")
+        if self.header(b"last-modified") is not None:
+            headers["If-Modified-Since"] = self.header(b"last-modified")
+        return headers
+
+    def revalidated(self, not_modified: httpx.Response, now: float, default_swr: float) -> "CachedResponse":
+        """Same response, fresh again (with the headers of the 304)"""
+        updates = {
+            name: value
+            for name, value in filter_headers(not_modified.headers.raw)
+            if name in REVALIDATION_HEADERS
+        }
+        headers = [(name, updates.pop(name, value)) for name, value in self.headers]
+        headers.extend(updates.items())
+        lifetime, stale_while_revalidate = freshness(dict(headers).get(b"cache-control", b"").decode("latin-1"))
+        return replace(
+            self,
+            headers=headers,
+            stored_at=now,
+            lifetime=lifetime or 0.0,
+            stale_while_revalidate=default_swr if stale_while_revalidate is None else stale_while_revalidate,
+        )
+
+    def response(self, now: float) -> Response:
+        response = Response(self.body, status_code=self.status_code)
+        response.raw_headers = self.headers + [(b"age", str(int(self.age(now))).encode())]
+        return response
+
+    def to_bytes(self) -> bytes:
+        meta = {
+            "url": self.url,
+            "status_code": self.status_code,
+            "headers": [[name.decode("latin-1"), value.decode("latin-1")] for name, value in self.headers],
+            "stored_at": self.stored_at,
+            "lifetime": self.lifetime,
+            "stale_while_revalidate": self.stale_while_revalidate,
+        }
+        return json.dumps(meta).encode() + b"\n" + self.body
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CachedResponse":
+        meta, _, body = data.partition(b"\n")
+        meta = json.loads(meta)
+        meta["headers"] = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in meta["headers"]]
+        return cls(body=body, **meta)
+
+
+def freshness(cache_control: str) -> Tuple[Optional[float], Optional[float]]:
+    """Lifetime (None if the response can't be stored) and stale-while-revalidate of the response"""
+    directives = parse_cache_control(cache_control)
+    if "no-store" in directives or "private" in directives:
+        return None, None
+    if "no-cache" in directives:
+        lifetime = 0.0
+    else:
+        lifetime = _seconds(directives, "s-maxage")
+        if lifetime is None:
+            lifetime = _seconds(directives, "max-age")
+    return lifetime, _seconds(directives, "stale-while-revalidate")
+
+
+class DiskResponseStore:
+    """Cached responses in files of a directory, least recently used are removed over `max_bytes`.
+    The directory can be shared by workers, but each one applies `max_bytes` to the files it
+    has written or read: with several workers, it can grow to a multiple of `max_bytes`."""
+
+    def __init__(self, directory: Path, max_bytes: Optional[int] = None):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        # file name -> size, least recently used first
+        self._files: Optional["OrderedDict[str, int]"] = None
+        self.total_bytes = 0
+        # Guards the index (get, put and remove run in threads). Files are read and written without it
+        self._lock = threading.Lock()
+
+    def _index(self) -> "OrderedDict[str, int]":
+        if self._files is None:
+            files = []
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith(".response") and entry.is_file():
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, entry.name, stat.st_size))
+            self._files = OrderedDict((name, size) for _, name, size in sorted(files))
+            self.total_bytes = sum(self._files.values())
+        return self._files
+
+    @staticmethod
+    def _name(key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest() + ".response"
+
+    def _used(self, name: str, size: Optional[int]) -> List[str]:
+        """Update the index for a file that was used (None: that is gone), returns the files to evict"""
+        with self._lock:
+            files = self._index()
+            self.total_bytes -= files.pop(name, 0)
+            if size is None:
+                return []
+            files[name] = size
+            self.total_bytes += size
+            evicted = []
+            while self.max_bytes is not None and self.total_bytes > self.max_bytes and len(files) > 1:
+                evicted_name, evicted_size = files.popitem(last=False)
+                self.total_bytes -= evicted_size
+                evicted.append(evicted_name)
+            return evicted
+
+    def _remove_files(self, names: List[str]):
+        for name in names:
+            try:
+                os.remove(self.directory / name)
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        name = self._name(key)
+        try:
+            with open(self.directory / name, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._used(name, None)
+            return None
+        try:
+            entry = CachedResponse.from_bytes(data)
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Removing invalid cached response %s", name)
+            self.remove(key)
+            return None
+        # (Possibly written by another worker)
+        self._remove_files(self._used(name, len(data)))
+        return entry
+
+    def put(self, key: str, entry: CachedResponse):
+        name = self._name(key)
+        data = entry.to_bytes()
+        fd, temp_path = mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, self.directory / name)
+        self._remove_files(self._used(name, len(data)))
+
+    def remove(self, key: str):
+        name = self._name(key)
+        self._used(name, None)
+        self._remove_files([name])
+
+
+class FulfillmentResponseCache:
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_entry_size: int = 1024 * 1024,
+        disk: Optional[DiskResponseStore] = None,
+        stale_while_revalidate: float = 0,
+    ):
+        """`stale_while_revalidate`: default seconds for which a stale response is served while revalidated"""
+        self.memory: LRUCache[str, CachedResponse] = LRUCache(
+            max_bytes=max_bytes, sizeof=lambda entry: entry.size
+        )
+        self.max_entry_size = max_entry_size
+        self.disk = disk
+        self.stale_while_revalidate = stale_while_revalidate
+
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._revalidations: Dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def accepts(request: Request) -> bool:
+        if request.method != "GET" or any(name in request.headers for name in BYPASS_REQUEST_HEADERS):
+            return False
+        directives = parse_cache_control(request.headers.get("cache-control", ""))
+        return "no-cache" not in directives and "no-store" not in directives
+
+    @staticmethod
+    def key(upstream_request: httpx.Request) -> str:
+        return "%s|%s" % (upstream_request.url, upstream_request.headers.get("accept-encoding", ""))
+
+    async def _lookup(self, key: str) -> Optional[CachedResponse]:
+        entry = self.memory.get(key)
+        if entry is None and self.disk is not None:
+            entry = await asyncio.to_thread(self.disk.get, key)
+            if entry is not None:
+                self.memory.put(key, entry)
+        return entry
+
+    async def _store(self, key: str, entry: CachedResponse):
+        self.memory.put(key, entry)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.put, key, entry)
+
+    async def _discard(self, key: str):
+        self.memory.pop(key)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.remove, key)
+
+    def _to_store(self, upstream_response: httpx.Response, now: float) -> Optional[CachedResponse]:
+        """Cached response to be made of the (unread) response, if it can be stored"""
+        if upstream_response.status_code != 200:
+            return None
+        # The key includes Accept-Encoding, but no other request header
+        vary = {name.strip().lower() for name in upstream_response.headers.get("vary", "").split(",")}
+        if not vary <= {"", "accept-encoding"}:
+            return None
+        content_length = upstream_response.headers.get("content-length")
+        if content_length is None or not content_length.isdigit() or int(content_length) > self.max_entry_size:
+            return None
+        lifetime, stale_while_revalidate = freshness(upstream_response.headers.get("cache-control", ""))
+        if lifetime is None:
+            return None
+        if lifetime == 0 and not ({"etag", "last-modified"} & upstream_response.headers.keys()):
+            # Could never be used
+            return None
+        return CachedResponse(
+            url=str(upstream_response.request.url),
+            status_code=upstream_response.status_code,
+            headers=filter_headers(upstream_response.headers.raw, exclude=(b"age",)),
+            body=b"",
+            stored_at=now,
+            lifetime=lifetime,
+            stale_while_revalidate=(
+                self.stale_while_revalidate if stale_while_revalidate is None else stale_while_revalidate
+            ),
+        )
+
+    async def _fetch(
+        self, client: httpx.AsyncClient, upstream_request: httpx.Request, key: str, entry: Optional[CachedResponse]
+    ) -> Tuple[Optional[CachedResponse], Optional[httpx.Response]]:
+        """Request (conditional, if there's an entry) the response. Returns the stored entry,
+        or the open upstream response if it can't be stored"""
+        if entry is not None:
+            upstream_request.headers.update(entry.validators())
+        upstream_response = await send_upstream(client, upstream_request)
+        now = time.time()
+        if upstream_response.status_code == httpx.codes.NOT_MODIFIED and entry is not None:
+            await upstream_response.aclose()
+            entry = entry.revalidated(upstream_response, now, self.stale_while_revalidate)
+            await self._store(key, entry)
+            return entry, None
+
+        entry = self._to_store(upstream_response, now)
+        if entry is None:
+            await self._discard(key)
+            return None, upstream_response
+        try:
+            body = b"".join([chunk async for chunk in upstream_response.aiter_raw()])
+        finally:
+            await upstream_response.aclose()
+        entry = replace(entry, body=body)
+        await self._store(key, entry)
+        return entry, None
+
+    def _request(self, client: httpx.AsyncClient, url: str, request: Request) -> httpx.Request:
+        return client.build_request(
+            "GET",
+            url,
+            headers=filter_headers(request.headers.raw, exclude=REQUEST_EXCLUDED_HEADERS),
+            params=request.query_params,
+        )
+
+    async def _revalidate(
+        self, client: httpx.AsyncClient, upstream_request: httpx.Request, key: str, entry: CachedResponse
+    ):
+        try:
+            _, upstream_response = await self._fetch(client, upstream_request, key, entry)
+            if upstream_response is not None:
+                await upstream_response.aclose()
+        except Exception as e:
+            logger.warning("Revalidation of cached fulfillment response %s failed: %r", entry.url, e)
+        finally:
+            self._revalidations.pop(key, None)
+
+    async def handle(self, client: httpx.AsyncClient, url: str, request: Request) -> Response:
+        """Response of the GET request from the cache, or from the fulfillment (and then stored)"""
+        upstream_request = self._request(client, url, request)
+        key = self.key(upstream_request)
+        entry = await self._lookup(key)
+        now = time.time()
+        if entry is not None and entry.is_fresh(now):
+            return entry.response(now)
+        if entry is not None and entry.may_serve_stale(now):
+            if key not in self._revalidations:
+                self._revalidations[key] = asyncio.create_task(
+                    self._revalidate(client, upstream_request, key, entry)
+                )
+            return entry.response(now)
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            # Same request is on its way, use its response (if it was stored)
+            entry = await asyncio.shield(inflight)
+            if entry is not None:
+                return entry.response(time.time())
+            return streaming_response(await send_upstream(client, self._request(client, url, request)))
+
+        inflight = self._inflight[key] = asyncio.get_running_loop().create_future()
+        stored = None
+        try:
+            stored, upstream_response = await self._fetch(client, upstream_request, key, entry)
+        except HTTPException:
+            if entry is None:
+                raise
+            # Unreachable, the stale response is better than none
+            logger.warning("Serving stale response of %s", entry.url)
+            stored, upstream_response = entry, None
+        finally:
+            inflight.set_result(stored)
+            del self._inflight[key]
+        if upstream_response is not None:
+            return streaming_response(upstream_response)
+        return stored.response(time.time())
+
+
+@lru_cache()
+def get_fulfillment_response_cache() -> Optional[FulfillmentResponseCache]:
+    """Cache of fulfillment responses, None if it's disabled"""
+    settings = FulfillmentSettings()
+    if not settings.fulfillment_cache_enabled:
+        return None
+    disk = None
+    if settings.fulfillment_cache_directory is not None:
+        disk = DiskResponseStore(settings.fulfillment_cache_directory, settings.fulfillment_cache_disk_max_bytes)
+    return FulfillmentResponseCache(
+        max_bytes=settings.fulfillment_cache_max_bytes,
+        max_entry_size=settings.fulfillment_cache_max_entry_size,
+        disk=disk,
+        stale_while_revalidate=settings.fulfillment_cache_stale_while_revalidate,
+    )
@@ -0,0 +1,86 @@
+"""Forwarding of requests to fulfillments, with the response body streamed back"""
+
+import logging
+from typing import AsyncIterator, Iterable, List, Tuple
+
+import httpx
+from fastapi import HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+# Headers of a single connection (RFC 9110 7.6.1), not forwarded by proxies
+HOP_BY_HOP_HEADERS = frozenset((
+    b"connection",
+    b"keep-alive",
+    b"proxy-connection",
+    b"proxy-authenticate",
+    b"proxy-authorization",
+    b"te",
+    b"trailer",
+    b"trailers",
+    b"transfer-encoding",
+    b"upgrade",
+))
+# Set by the client for the fulfillment's host
+REQUEST_EXCLUDED_HEADERS = frozenset((b"host",))
+
+RawHeaders = List[Tuple[bytes, bytes]]
+
+
+def filter_headers(headers: Iterable[Tuple[bytes, bytes]], exclude: Iterable[bytes] = ()) -> RawHeaders:
+    """Headers without hop-by-hop headers (including those listed in `Connection`)"""
+    headers = [(name.lower(), value) for name, value in headers]
+    excluded = set(HOP_BY_HOP_HEADERS)
+    excluded.update(exclude)
+    for name, value in headers:
+        if name == b"connection":
+            excluded.update(option.strip().lower() for option in value.split(b","))
+    return [(name, value) for name, value in headers if name not in excluded]
+
+
+def build_upstream_request(client: httpx.AsyncClient, url: str, request: Request) -> httpx.Request:
+    """Request to the URL with the method, headers, query and (streamed) body of the request"""
+    return client.build_request(
+        request.method,
+        url,
+        headers=filter_headers(request.headers.raw, exclude=REQUEST_EXCLUDED_HEADERS),
+        params=request.query_params,
+        content=request.stream(),
+    )
+
+
+async def _raw_body(upstream_response: httpx.Response) -> AsyncIterator[bytes]:
+    # Closed however the stream ends (upstream or client errors too), so the connection goes back to the pool
+    try:
+        async for chunk in upstream_response.aiter_raw():
+            yield chunk
+    finally:
+        await upstream_response.aclose()
+
+
+def streaming_response(upstream_response: httpx.Response) -> StreamingResponse:
+    """Response with the body streamed from the (open) upstream response, which is closed after it"""
+    # Raw (still encoded) body, so Content-Encoding and Content-Length stay valid
+    response = StreamingResponse(
+        _raw_body(upstream_response),
+        status_code=upstream_response.status_code,
+    )
+    response.raw_headers = filter_headers(upstream_response.headers.raw)
+    return response
+
+
+async def send_upstream(client: httpx.AsyncClient, upstream_request: httpx.Request) -> httpx.Response:
+    """Send the request (response body not read yet). Unreachable fulfillments are 502 errors"""
+    logger.debug("Sending fulfillment request to %s using %s method", upstream_request.url, upstream_request.method)
+    try:
+        return await client.send(upstream_request, stream=True)
+    except httpx.TransportError as e:
+        logger.warning("Fulfillment request to %s failed: %r", upstream_request.url, e)
+        raise HTTPException(status.HTTP_502_BAD_GATEWAY, detail="Fulfillment is unavailable")
+
+
+async def forward_request(client: httpx.AsyncClient, url: str, request: Request) -> StreamingResponse:
+    """Send the request (body streamed) to the URL, and stream the response back as it arrives"""
+    upstream_request = build_upstream_request(client, url, request)
+    return streaming_response(await send_upstream(client, upstream_request))
@@ -0,0 +1,151 @@
+"""Process-local registry of fulfillments, so proxied requests don't query the DB.
+
+All fulfillments are loaded at startup and reloaded periodically (other workers
+may have changed them). Changes made by this worker are applied immediately.
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from sqlalchemy import select
+
+from abotcore.config import FulfillmentSettings
+from abotcore.db import get_sessionmaker
+
+from .models import Fulfillment
+from .routing import ServiceIndex, ServiceRoute
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class RegisteredFulfillment:
+    """Snapshot of a fulfillment record (not bound to a DB session)"""
+
+    fulfillment_id: int
+    endpoint_base_url: str
+    app_class: Optional[str] = None
+    friendly_name: Optional[str] = None
+    version: Optional[str] = None
+    services: Optional[List[Dict]] = None
+
+    @classmethod
+    def from_record(cls, fulfillment: Fulfillment) -> "RegisteredFulfillment":
+        return cls(
+            fulfillment_id=fulfillment.fulfillment_id,
+            endpoint_base_url=fulfillment.endpoint_base_url,
+            app_class=fulfillment.app_class,
+            friendly_name=fulfillment.friendly_name,
+            version=fulfillment.version,
+            services=fulfillment.services,
+        )
+
+
+class FulfillmentRegistry:
+    def __init__(self, sessionmaker=None, refresh_interval: float = 60, miss_refresh_interval: float = 5):
+        """`miss_refresh_interval`: least seconds between reloads for unknown ids (e.g. added by another worker)"""
+        self._sessionmaker = sessionmaker
+        self.refresh_interval = refresh_interval
+        self.miss_refresh_interval = miss_refresh_interval
+
+        self._fulfillments: Dict[int, RegisteredFulfillment] = {}
+        self.services = ServiceIndex()
+        self._loaded = False
+        self._refreshed_at = 0.0
+        self._refreshing: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _get_sessionmaker(self):
+        if self._sessionmaker is None:
+            self._sessionmaker = get_sessionmaker()
+        return self._sessionmaker
+
+    def __len__(self) -> int:
+        return len(self._fulfillments)
+
+    def get(self, fulfillment_id: int) -> Optional[RegisteredFulfillment]:
+        return self._fulfillments.get(fulfillment_id)
+
+    def all(self) -> List[RegisteredFulfillment]:
+        return list(self._fulfillments.values())
+
+    async def _load(self):
+        async with self._get_sessionmaker()() as session:
+            result = await session.scalars(select(Fulfillment))
+            fulfillments = {
+                fulfillment.fulfillment_id: RegisteredFulfillment.from_record(fulfillment)
+                for fulfillment in result
+            }
+        # Only the services of changed fulfillments are re-indexed
+        for fulfillment_id in self._fulfillments:
+            if fulfillment_id not in fulfillments:
+                self.services.remove(fulfillment_id)
+        for fulfillment_id, fulfillment in fulfillments.items():
+            if self._fulfillments.get(fulfillment_id) != fulfillment:
+                self.services.update(fulfillment)
+        self._fulfillments = fulfillments
+        self._loaded = True
+        self._refreshed_at = time.monotonic()
+        logger.debug("Loaded %d fulfillments", len(fulfillments))
+
+    async def refresh(self):
+        """Reload all fulfillments from the DB. Concurrent calls share the same reload"""
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self._load())
+        await asyncio.shield(self._refreshing)
+
+    def _may_refresh(self) -> bool:
+        return not self._loaded or time.monotonic() - self._refreshed_at >= self.miss_refresh_interval
+
+    async def resolve(self, fulfillment_id: int) -> Optional[RegisteredFulfillment]:
+        """Fulfillment by id, without DB access unless it's unknown (reloaded at most every few seconds)"""
+        fulfillment = self._fulfillments.get(fulfillment_id)
+        if fulfillment is None and self._may_refresh():
+            await self.refresh()
+            fulfillment = self._fulfillments.get(fulfillment_id)
+        return fulfillment
+
+    async def resolve_service(self, name: str) -> Optional[ServiceRoute]:
+        """Route of the service by name, like `resolve`"""
+        route = self.services.get(name)
+        if route is None and self._may_refresh():
+            await self.refresh()
+            route = self.services.get(name)
+        return route
+
+    def update(self, fulfillment: RegisteredFulfillment):
+        """Apply a (committed) change of a fulfillment record"""
+        if self._fulfillments.get(fulfillment.fulfillment_id) != fulfillment:
+            self.services.update(fulfillment)
+        self._fulfillments[fulfillment.fulfillment_id] = fulfillment
+
+    def remove(self, fulfillment_id: int):
+        self._fulfillments.pop(fulfillment_id, None)
+        self.services.remove(fulfillment_id)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Failed to load fulfillments:")
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+@lru_cache()
+def get_fulfillment_registry() -> FulfillmentRegistry:
+    settings = FulfillmentSettings()
+    return FulfillmentRegistry(refresh_interval=settings.fulfillment_registry_refresh_interval)
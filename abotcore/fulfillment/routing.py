@@ -0,0 +1,80 @@
+"""Index of the services advertised by fulfillments (in their manifests).
+
+Maps a service name to the fulfillment that serves it, so clients can call
+`/fulfillment/service/{name}...` without knowing the fulfillment's id. The
+index is updated per fulfillment, when the registry sees that it changed.
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from .registry import RegisteredFulfillment
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ServiceRoute:
+    name: str
+    fulfillment_id: int
+    endpoint_base_url: str
+    path: str = ""
+    """Path of the service at the fulfillment (prefix of the endpoints)"""
+
+
+def service_routes(fulfillment: "RegisteredFulfillment") -> List[ServiceRoute]:
+    """Routes of the services in the manifest: `{"name": ..., "path": ...}` entries (or only names)"""
+    routes = []
+    for service in fulfillment.services or ():
+        if isinstance(service, str):
+            name, path = service, ""
+        elif isinstance(service, dict) and isinstance(service.get("name"), str):
+            name, path = service["name"], service.get("path") or service.get("endpoint") or ""
+        else:
+            continue
+        if not isinstance(path, str):
+            continue
+        routes.append(ServiceRoute(name, fulfillment.fulfillment_id, fulfillment.endpoint_base_url, path))
+    return routes
+
+
+class ServiceIndex:
+    def __init__(self):
+        self._routes: Dict[str, ServiceRoute] = {}
+        # All routes of a name (if several fulfillments advertise it, the lowest id is used)
+        self._candidates: Dict[str, Dict[int, ServiceRoute]] = {}
+        self._names: Dict[int, List[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._routes)
+
+    def get(self, name: str) -> Optional[ServiceRoute]:
+        return self._routes.get(name)
+
+    def _select(self, name: str):
+        candidates = self._candidates.get(name)
+        if not candidates:
+            self._candidates.pop(name, None)
+            self._routes.pop(name, None)
+            return
+        if len(candidates) > 1:
+            logger.warning(
+                "Service '%s' is advertised by fulfillments %s, using %d", name, sorted(candidates), min(candidates)
+            )
+        self._routes[name] = candidates[min(candidates)]
+
+    def remove(self, fulfillment_id: int):
+        for name in self._names.pop(fulfillment_id, ()):
+            self._candidates.get(name, {}).pop(fulfillment_id, None)
+            self._select(name)
+
+    def update(self, fulfillment: "RegisteredFulfillment"):
+        """Replace the routes of the fulfillment"""
+        self.remove(fulfillment.fulfillment_id)
+        routes = service_routes(fulfillment)
+        self._names[fulfillment.fulfillment_id] = [route.name for route in routes]
+        for route in routes:
+            self._candidates.setdefault(route.name, {})[fulfillment.fulfillment_id] = route
+            self._select(route.name)
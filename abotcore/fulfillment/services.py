@@ -1,25 +1,57 @@
 
 
-import asyncio
 import logging
 import urllib.parse
-from datetime import datetime
-from itertools import starmap
-from typing import Optional, Tuple
+from datetime import datetime, timezone
 
 import httpx
 from fastapi import Depends, HTTPException, Request, status
-from fastapi.responses import Response
-from sqlalchemy import Result, select
 
-from abotcore.api import AsyncClient
+from abotcore.api import get_fulfillment_client
 from abotcore.db import Session, get_session
 
+from .cache import get_fulfillment_response_cache
 from .models import Fulfillment
+from .proxy import forward_request
+from .registry import RegisteredFulfillment, get_fulfillment_registry
+from .sync import ENDPOINT_ABOT_FULFILLMENTS_QUERY, get_fulfillment_sync_scheduler, manifest_changes  # noqa: F401
 
 logger = logging.getLogger(__name__)
 
-ENDPOINT_ABOT_FULFILLMENTS_QUERY = "/abot"
+
+async def _forward(client, url: str, request: Request):
+    cache = get_fulfillment_response_cache()
+    if cache is not None and cache.accepts(request):
+        return await cache.handle(client, url, request)
+    return await forward_request(client, url, request)
+
+
+async def perform_fulfillment_request(fulfillment_id: int, endpoint_uri: str, request: Request):
+    """Forward the request to the fulfillment (resolved from the registry, without a DB session)"""
+    if len(endpoint_uri) == 0:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Endpoint cannot be empty. Root endpoints need a '/'.")
+
+    found_fulfillment = await get_fulfillment_registry().resolve(fulfillment_id)
+    if not found_fulfillment:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Fulfillment with id %d not found" % fulfillment_id)
+
+    fulfillment_url = urllib.parse.urljoin(found_fulfillment.endpoint_base_url, endpoint_uri)
+
+    client = get_fulfillment_client(found_fulfillment.endpoint_base_url)
+    return await _forward(client, fulfillment_url, request)
+
+
+async def perform_service_request(service_name: str, endpoint_uri: str, request: Request):
+    """Forward the request to the fulfillment that serves the service (by the routing index)"""
+    route = await get_fulfillment_registry().resolve_service(service_name)
+    if route is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Service '%s' not found" % service_name)
+
+    path = route.path.rstrip("/") + endpoint_uri
+    fulfillment_url = urllib.parse.urljoin(route.endpoint_base_url, path or "/")
+
+    client = get_fulfillment_client(route.endpoint_base_url)
+    return await _forward(client, fulfillment_url, request)
 
 
 class FulfillmentSync:
@@ -27,67 +59,36 @@ class FulfillmentSync:
         self.async_session: Session = session
 
     async def perform_fulfillment_request(self, fulfillment_id: int, endpoint_uri: str, request: Request):
-        if len(endpoint_uri) == 0:
-            raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Endpoint cannot be empty. Root endpoints need a '/'.")
-
-        found_fulfillment: Optional[Fulfillment] = await self.async_session.get(Fulfillment, fulfillment_id)
-        if not found_fulfillment:
-            raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Fulfillment with id %d not found" % fulfillment_id)
-
-        fulfillment_url = urllib.parse.urljoin(found_fulfillment.endpoint_base_url, endpoint_uri)
-
-        async with AsyncClient(timeout=30) as client:
-            req = client.build_request(
-                request.method,
-                fulfillment_url,
-                headers=request.headers.raw,
-                params=request.query_params,
-                content=request.stream()
-            )
-
-            logger.debug("Sending fulfillment request to %s using %s method",
-                        fulfillment_url,
-                        request.method)
-
-            res = await client.send(req)
-            return Response(
-                res.content,
-                status_code=res.status_code,
-                headers=res.headers
-            )
+        return await perform_fulfillment_request(fulfillment_id, endpoint_uri, request)
 
     async def update_fulfillment_record(self, fulfillment: Fulfillment, data: dict):
         for var, value in data.items():
             setattr(fulfillment, var, value) if value else None
+        # Attributes are expired by the commit
+        registered = RegisteredFulfillment.from_record(fulfillment)
         await self.async_session.commit()
+        get_fulfillment_registry().update(registered)
 
     async def sync_fulfillment(self, fulfillment: Fulfillment):
         ff_id, ff_endpoint_url = fulfillment.fulfillment_id, fulfillment.endpoint_base_url
         logger.debug("Syncing fulfillment (%d) URL: %s", ff_id, ff_endpoint_url)
-        async with AsyncClient(timeout=30) as cli:
-            try:
-                query_url = urllib.parse.urljoin(ff_endpoint_url, ENDPOINT_ABOT_FULFILLMENTS_QUERY)
-                response = await cli.get(query_url)
-
-                await self.update_fulfillment_record(fulfillment, response.json())
-
-                fulfillment.time_last_sync = datetime.now()
-                await self.async_session.commit()
-                await self.async_session.flush()
-            except (httpx.ConnectError, httpx.ReadTimeout):
-                logger.exception("Failed to synchronize fulfillment %s:", ff_endpoint_url)
-            else:
-                logger.info("Fulfillment \"%s\" synced successfully", ff_endpoint_url)
+        try:
+            scheduler = get_fulfillment_sync_scheduler()
+            manifest, validators = await scheduler.fetch_manifest(ff_endpoint_url, force=True)
+            fulfillment.time_last_sync = datetime.now(timezone.utc)
+            await self.update_fulfillment_record(fulfillment, manifest_changes(manifest))
+            scheduler.store_validators(ff_endpoint_url, validators)
+        except (httpx.HTTPError, ValueError):
+            logger.exception("Failed to synchronize fulfillment %s:", ff_endpoint_url)
+        else:
+            logger.info("Fulfillment \"%s\" synced successfully", ff_endpoint_url)
 
     async def sync_all(self, force: bool = False):
-        result: Result[Tuple[Fulfillment]] = await self.async_session.execute(
-            select(Fulfillment)
-        )
-
-        coros = starmap(self.sync_fulfillment, result)
-        await asyncio.gather(*coros)
+        await get_fulfillment_sync_scheduler().sync_all(force, session=self.async_session)
 
 
 __all__ = [
-    'FulfillmentSync'
+    'FulfillmentSync',
+    'perform_fulfillment_request',
+    'perform_service_request',
 ]
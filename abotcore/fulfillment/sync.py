@@ -0,0 +1,222 @@
+"""Periodic synchronization of fulfillments with their manifests (`/abot`).
+
+Manifests are fetched concurrently (up to a limit), with the ETag/Last-Modified
+of the previous fetch, so unchanged manifests are answered by 304 Not Modified.
+All changes of a round are written back in one commit. Rounds are spread with
+jitter, so workers (each running the scheduler) don't sync at the same time.
+"""
+
+import asyncio
+import contextlib
+import logging
+import random
+import urllib.parse
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import httpx
+from sqlalchemy import select, update
+
+from abotcore.api import get_fulfillment_client
+from abotcore.config import FulfillmentSettings
+from abotcore.db import Session, get_sessionmaker
+
+from .models import Fulfillment
+from .registry import FulfillmentRegistry, get_fulfillment_registry
+
+logger = logging.getLogger(__name__)
+
+ENDPOINT_ABOT_FULFILLMENTS_QUERY = "/abot"
+# Fields of the fulfillment record that are set from its manifest
+MANIFEST_FIELDS = ("app_class", "friendly_name", "description", "version", "services")
+
+
+@dataclass
+class ManifestValidators:
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    def headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+@dataclass
+class SyncResult:
+    fulfillment_id: int
+    base_url: str
+    synced: bool
+    """Whether the manifest was fetched (and valid)"""
+    changes: Optional[dict] = None
+    """Values of the record from the manifest (None if the manifest is unchanged)"""
+    validators: Optional[ManifestValidators] = None
+
+
+def manifest_url(base_url: str) -> str:
+    return urllib.parse.urljoin(base_url, ENDPOINT_ABOT_FULFILLMENTS_QUERY)
+
+
+def manifest_changes(manifest: dict) -> dict:
+    """Values of the record from the manifest (empty values are ignored)"""
+    return {field: manifest[field] for field in MANIFEST_FIELDS if manifest.get(field)}
+
+
+class FulfillmentSyncScheduler:
+    def __init__(
+        self,
+        sessionmaker=None,
+        interval: Optional[float] = 300,
+        concurrency: int = 8,
+        jitter: float = 0.1,
+        client_factory: Callable[[str], httpx.AsyncClient] = get_fulfillment_client,
+        registry: Optional[FulfillmentRegistry] = None,
+    ):
+        """`interval`: seconds between rounds (None: only on request). `jitter`: fraction of the interval
+        by which rounds are shifted randomly, and over which the fetches of a round are spread"""
+        self._sessionmaker = sessionmaker
+        self.interval = interval
+        self.concurrency = concurrency
+        self.jitter = jitter
+        self.client_factory = client_factory
+        self.registry = registry
+
+        # Validators of the last fetched manifest, by manifest URL
+        self._validators: Dict[str, ManifestValidators] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def _get_sessionmaker(self):
+        if self._sessionmaker is None:
+            self._sessionmaker = get_sessionmaker()
+        return self._sessionmaker
+
+    @contextlib.asynccontextmanager
+    async def _session(self, session: Optional[Session]) -> AsyncIterator[Session]:
+        if session is not None:
+            yield session
+            return
+        async with self._get_sessionmaker()() as session:
+            yield session
+
+    async def fetch_manifest(
+        self, base_url: str, force: bool = False
+    ) -> Tuple[Optional[dict], Optional[ManifestValidators]]:
+        """Manifest of the fulfillment and its validators, or None if it wasn't modified since
+        the last fetch. The validators are only used once `store_validators` is called"""
+        url = manifest_url(base_url)
+        validators = self._validators.get(url)
+        headers = validators.headers() if validators is not None and not force else {}
+
+        response = await self.client_factory(base_url).get(url, headers=headers)
+        if response.status_code == httpx.codes.NOT_MODIFIED:
+            return None, None
+        response.raise_for_status()
+        manifest = response.json()
+        return manifest, ManifestValidators(response.headers.get("etag"), response.headers.get("last-modified"))
+
+    def store_validators(self, base_url: str, validators: ManifestValidators):
+        """Use the validators in the next fetches (once the manifest was applied)"""
+        self._validators[manifest_url(base_url)] = validators
+
+    async def _sync_one(
+        self, semaphore: asyncio.Semaphore, fulfillment_id: int, base_url: str, force: bool, delay: float
+    ) -> SyncResult:
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with semaphore:
+            logger.debug("Syncing fulfillment (%d) URL: %s", fulfillment_id, base_url)
+            try:
+                manifest, validators = await self.fetch_manifest(base_url, force)
+            except (httpx.HTTPError, ValueError) as e:
+                logger.warning("Failed to synchronize fulfillment %s: %r", base_url, e)
+                return SyncResult(fulfillment_id, base_url, False)
+        if manifest is None:
+            return SyncResult(fulfillment_id, base_url, True)
+        if not isinstance(manifest, dict):
+            logger.warning("Invalid manifest of fulfillment %s", base_url)
+            return SyncResult(fulfillment_id, base_url, False)
+        return SyncResult(fulfillment_id, base_url, True, manifest_changes(manifest), validators)
+
+    async def sync_all(self, force: bool = False, session: Optional[Session] = None, spread: float = 0) -> int:
+        """Sync all fulfillments (`force`: without conditional requests), with fetches started
+        over `spread` seconds. Returns the number of updated records"""
+        async with self._session(session) as db:
+            result = await db.execute(select(Fulfillment.fulfillment_id, Fulfillment.endpoint_base_url))
+            fulfillments = result.all()
+            # Don't keep the connection during the fetches
+            await db.commit()
+
+            semaphore = asyncio.Semaphore(self.concurrency)
+            results = await asyncio.gather(*[
+                self._sync_one(semaphore, fulfillment_id, base_url, force, random.uniform(0, spread))
+                for fulfillment_id, base_url in fulfillments
+            ])
+
+            now = datetime.now(timezone.utc)
+            changed: List[dict] = []
+            unchanged: List[int] = []
+            for result in results:
+                if result.changes:
+                    changed.append({"fulfillment_id": result.fulfillment_id, "time_last_sync": now, **result.changes})
+                elif result.synced:
+                    unchanged.append(result.fulfillment_id)
+            if changed:
+                await db.execute(update(Fulfillment), changed)
+            if unchanged:
+                await db.execute(
+                    update(Fulfillment)
+                    .where(Fulfillment.fulfillment_id.in_(unchanged))
+                    .values(time_last_sync=now)
+                    .execution_options(synchronize_session=False)
+                )
+            await db.commit()
+
+        # Only now: if the changes weren't written, the manifests are fetched again (not 304)
+        for result in results:
+            if result.validators is not None:
+                self.store_validators(result.base_url, result.validators)
+        logger.info(
+            "Synced %d fulfillments: %d updated, %d unchanged", len(fulfillments), len(changed), len(unchanged)
+        )
+        if changed:
+            registry = self.registry if self.registry is not None else get_fulfillment_registry()
+            await registry.refresh()
+        return len(changed)
+
+    def _next_delay(self) -> float:
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def _run(self):
+        # Workers that start together don't sync together
+        await asyncio.sleep(random.uniform(0, self.jitter * self.interval))
+        while True:
+            try:
+                await self.sync_all(spread=self.jitter * self.interval)
+            except Exception:
+                logger.exception("Fulfillment sync failed:")
+            await asyncio.sleep(self._next_delay())
+
+    def start(self):
+        if self.interval is not None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+@lru_cache()
+def get_fulfillment_sync_scheduler() -> FulfillmentSyncScheduler:
+    settings = FulfillmentSettings()
+    return FulfillmentSyncScheduler(
+        interval=settings.fulfillment_sync_interval,
+        concurrency=settings.fulfillment_sync_concurrency,
+        jitter=settings.fulfillment_sync_jitter,
+    )
@@ -1,12 +1,32 @@
 
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Request
 
-from .services import FulfillmentSync
+from .registry import get_fulfillment_registry
+from .services import perform_fulfillment_request, perform_service_request
+from .sync import get_fulfillment_sync_scheduler
 
 # Main endpoint router for fulfillment endpoints
 router = APIRouter(prefix='/fulfillment')
 
 
+@router.on_event("startup")
+async def start_fulfillment_background_tasks():
+    get_fulfillment_registry().start()
+    get_fulfillment_sync_scheduler().start()
+
+
+@router.on_event("shutdown")
+async def stop_fulfillment_background_tasks():
+    await get_fulfillment_sync_scheduler().stop()
+    await get_fulfillment_registry().stop()
+
+
 @router.api_route('/{id:int}{endpoint:path}')
-async def perform_fulfillment(id: int, endpoint: str, request: Request, ff_sync: FulfillmentSync = Depends(FulfillmentSync)):
-    return await ff_sync.perform_fulfillment_request(id, endpoint, request)
+async def perform_fulfillment(id: int, endpoint: str, request: Request):
+    return await perform_fulfillment_request(id, endpoint, request)
+
+
+@router.api_route('/service/{name}{endpoint:path}')
+async def perform_service(name: str, endpoint: str, request: Request):
+    """Call a service by name (as advertised in the fulfillments' manifests)"""
+    return await perform_service_request(name, endpoint, request)
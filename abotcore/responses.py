@@ -0,0 +1,77 @@
+"""JSON responses encoded with orjson (when it's installed)"""
+
+import json
+import math
+from typing import Any
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class _DifferentFloat(Exception):
+    pass
+
+
+def _has_different_float(content: Any) -> bool:
+    """Whether `content` has floats that orjson doesn't write as `json` does: NaN and
+    Infinity (null), positive exponents (`1e16`) and small exponents (`0.000025`)"""
+    stack = [content]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                return True
+            text = repr(value)
+            if "e+" in text or "e-0" in text:
+                return True
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return False
+
+
+def _orjson_default(value: Any) -> Any:
+    encoded = jsonable_encoder(value)
+    if _has_different_float(encoded):
+        raise _DifferentFloat()
+    return encoded
+
+
+def _json_dumps(content: Any) -> bytes:
+    # Same as JSONResponse
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+        default=jsonable_encoder,
+    ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """Same JSON as `JSONResponse`, encoded faster. Content doesn't need to be passed through
+    `jsonable_encoder`, other types (datetimes, models, etc.) are encoded with it."""
+
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return _json_dumps(content)
+        # Floats are checked in the content (and in what `jsonable_encoder` returns), not in the
+        # rendered JSON, where strings would match too
+        if _has_different_float(content):
+            return _json_dumps(content)
+        try:
+            return orjson.dumps(
+                content,
+                default=_orjson_default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS,
+            )
+        except orjson.JSONEncodeError:
+            # e.g. integers over 64 bits, subclasses of float, floats of encoded objects
+            return _json_dumps(content)
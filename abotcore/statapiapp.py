@@ -9,11 +9,12 @@ from fastapi.responses import JSONResponse
 # Routers
 from abotcore import statistics
 from abotcore.config import ServerSettings
+from abotcore.responses import FastJSONResponse
 
 
 def create_app() -> FastAPI:
     """Application instance"""
-    app = FastAPI()
+    app = FastAPI(default_response_class=FastJSONResponse)
     settings = ServerSettings()
 
     logging.basicConfig(level=settings.app_log_level)
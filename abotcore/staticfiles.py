@@ -0,0 +1,286 @@
+"""Static files with strong ETags, byte ranges and precompressed variants.
+
+Text files are served compressed (brotli or gzip, by Accept-Encoding) from a
+variant next to the file (`style.css.br`, `style.css.gz`, made ahead of time),
+or one that is compressed on the first request into `.compressed/`. Ranges are
+served from the uncompressed file. Files named by their SHA-256 digest (as in
+the file cache) never change, so they can be cached by clients for good.
+"""
+
+import gzip
+import logging
+import os
+import re
+import shutil
+from email.utils import formatdate
+from mimetypes import guess_type
+from tempfile import mkstemp
+from typing import Dict, List, Optional, Tuple
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+LOGGER = logging.getLogger(__name__)
+
+COMPRESSED_DIRECTORY = ".compressed"
+# Content-Encoding -> file extension, in order of preference
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+COMPRESSIBLE_TYPES = (
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+)
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_CONTENT_ADDRESSED = re.compile(r"[0-9a-f]{64}(\.[a-z0-9]{1,16})?")
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def is_content_addressed(name: str) -> bool:
+    return _CONTENT_ADDRESSED.fullmatch(name) is not None
+
+
+def is_compressible(media_type: str) -> bool:
+    return media_type.startswith("text/") or media_type in COMPRESSIBLE_TYPES
+
+
+def remove_compressed_variants(directory: str, name: str):
+    """Remove the variants that were compressed on request (e.g. when the file is removed)"""
+    for extension in ENCODINGS.values():
+        try:
+            os.remove(os.path.join(directory, COMPRESSED_DIRECTORY, name + extension))
+        except FileNotFoundError:
+            pass
+
+
+def _compress(source: str, destination: str, encoding: str):
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    fd, temp_path = mkstemp(dir=os.path.dirname(destination), prefix=".compress-")
+    try:
+        with open(source, "rb") as src, os.fdopen(fd, "wb") as dst:
+            if encoding == "br":
+                dst.write(brotli.compress(src.read()))
+            else:
+                with gzip.GzipFile(fileobj=dst, mode="wb", mtime=0) as compressed:
+                    shutil.copyfileobj(src, compressed)
+        os.replace(temp_path, destination)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def _accepted_encodings(accept_encoding: str) -> List[str]:
+    accepted = []
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.append(coding.strip().lower())
+    return accepted
+
+
+class _RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """First and last byte of a single range. None if the range should be ignored (invalid, or several ranges)"""
+    match = _RANGE.fullmatch(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # Suffix: the last N bytes
+        if int(last) == 0 or size == 0:
+            raise _RangeNotSatisfiable()
+        return max(0, size - int(last)), size - 1
+    first = int(first)
+    if first >= size:
+        raise _RangeNotSatisfiable()
+    if not last:
+        return first, size - 1
+    if int(last) < first:
+        return None
+    return first, min(int(last), size - 1)
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match (weak comparison)"""
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+class FileRangeResponse(FileResponse):
+    """Part of a file (`first` to `last` byte)"""
+
+    def __init__(self, path: str, first: int, last: int, size: int, **kwargs):
+        super().__init__(path, status_code=206, **kwargs)
+        self.first = first
+        self.length = last - first + 1
+        self.headers["content-range"] = "bytes %d-%d/%d" % (first, last, size)
+        self.headers["content-length"] = str(self.length)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.send_header_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            await file.seek(self.first)
+            remaining = self.length
+            while remaining > 0:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                # The file was truncated meanwhile
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+class CachingStaticFiles(StaticFiles):
+    def __init__(
+        self,
+        *args,
+        cache_control: str = "no-cache",
+        compress_min_size: int = 1024,
+        compress_max_size: Optional[int] = 10 * 1024 * 1024,
+        **kwargs,
+    ):
+        """`compress_max_size`: largest file that's compressed on request (None: only variants made ahead of time)"""
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+        self.compress_min_size = compress_min_size
+        self.compress_max_size = compress_max_size
+
+    def file_response(self, full_path, stat_result, scope, status_code=200) -> Response:
+        # Negotiated in get_response
+        return FileResponse(full_path, status_code=status_code, stat_result=stat_result, method=scope["method"])
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        # Hidden files: temporary uploads, compressed variants, indexes...
+        if any(part.startswith(".") and part not in (".", "..") for part in re.split(r"[/\\]", path)):
+            raise HTTPException(status_code=404)
+        response = await super().get_response(path, scope)
+        if isinstance(response, FileResponse) and response.status_code == 200:
+            # Variants and compression are file I/O
+            return await anyio.to_thread.run_sync(
+                self.negotiate, str(response.path), response.stat_result, Headers(scope=scope), scope["method"]
+            )
+        return response
+
+    def _compressed_path(self, full_path: str) -> Optional[str]:
+        if self.directory is None:
+            return None
+        relative = os.path.relpath(full_path, self.directory)
+        if relative.startswith(os.pardir):
+            return None
+        return os.path.join(self.directory, COMPRESSED_DIRECTORY, relative)
+
+    def _variant(self, full_path: str, stat_result: os.stat_result, encoding: str) -> Optional[Tuple[str, int]]:
+        """Path and size of the compressed file, compressed now if needed"""
+        extension = ENCODINGS[encoding]
+        compressed_path = self._compressed_path(full_path)
+        candidates = [full_path + extension]
+        if compressed_path is not None:
+            candidates.append(compressed_path + extension)
+        for candidate in candidates:
+            try:
+                variant_stat = os.stat(candidate)
+            except OSError:
+                continue
+            if variant_stat.st_mtime >= stat_result.st_mtime:
+                return candidate, variant_stat.st_size
+
+        if (
+            compressed_path is None
+            or self.compress_max_size is None
+            or not self.compress_min_size <= stat_result.st_size <= self.compress_max_size
+            or (encoding == "br" and brotli is None)
+        ):
+            return None
+        try:
+            _compress(full_path, compressed_path + extension, encoding)
+            return compressed_path + extension, os.stat(compressed_path + extension).st_size
+        except OSError as e:
+            LOGGER.warning("Could not compress %s: %s", full_path, e)
+            return None
+
+    def _select_variant(
+        self, full_path: str, stat_result: os.stat_result, request_headers: Headers
+    ) -> Tuple[Optional[str], str, int]:
+        """Encoding, path and size of the representation to send"""
+        accepted = _accepted_encodings(request_headers.get("accept-encoding", ""))
+        for encoding in ENCODINGS:
+            if encoding in accepted:
+                variant = self._variant(full_path, stat_result, encoding)
+                if variant is not None:
+                    return encoding, variant[0], variant[1]
+        return None, full_path, stat_result.st_size
+
+    def negotiate(
+        self, full_path: str, stat_result: os.stat_result, request_headers: Headers, method: str
+    ) -> Response:
+        name = os.path.basename(full_path)
+        media_type, file_encoding = guess_type(full_path)
+        media_type = media_type or "text/plain"
+        headers: Dict[str, str] = {
+            "accept-ranges": "bytes",
+            "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        }
+        if is_content_addressed(name):
+            etag = '"%s"' % os.path.splitext(name)[0]
+            headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            etag = '"%x-%x"' % (stat_result.st_mtime_ns, stat_result.st_size)
+            headers["cache-control"] = self.cache_control
+
+        encoding, path, size = None, full_path, stat_result.st_size
+        range_header = request_headers.get("range")
+        # Not variants themselves (e.g. style.css.gz)
+        if file_encoding is None and is_compressible(media_type):
+            headers["vary"] = "Accept-Encoding"
+            if range_header is None:
+                encoding, path, size = self._select_variant(full_path, stat_result, request_headers)
+        if encoding is not None:
+            headers["content-encoding"] = encoding
+            etag = etag[:-1] + '-%s"' % encoding
+        headers["etag"] = etag
+        headers["content-length"] = str(size)
+
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None and etag_matches(if_none_match, etag):
+            del headers["content-length"]
+            return Response(status_code=304, headers=headers)
+
+        if range_header is not None and request_headers.get("if-range", etag) in (etag, headers["last-modified"]):
+            try:
+                byte_range = parse_range(range_header, size)
+            except _RangeNotSatisfiable:
+                headers["content-range"] = "bytes */%d" % size
+                del headers["content-length"]
+                return Response(status_code=416, headers=headers)
+            if byte_range is not None:
+                return FileRangeResponse(
+                    path, *byte_range, size, headers=headers, media_type=media_type, method=method
+                )
+        return FileResponse(path, headers=headers, media_type=media_type, method=method, stat_result=stat_result)
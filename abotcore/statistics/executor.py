@@ -0,0 +1,121 @@
+"""Workers of the statistics computations (pandas), off the event loop.
+
+Small inputs run in a thread pool, inputs of `process_min_size` bytes or more
+in a process pool (they'd hold the GIL for long, and are worth pickling). The
+size of the request body is used, as the rows aren't known before it's parsed
+(in the worker). The number of running and queued computations is bounded:
+over it, requests are rejected with 503 rather than queued behind the others.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Any, Callable, Optional, TypeVar
+
+from fastapi import HTTPException, status
+
+from abotcore.config import StatisticsSettings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+RETRY_AFTER_SECONDS = 1
+
+
+class StatisticsExecutor:
+    def __init__(
+        self,
+        processes: Optional[int] = None,
+        threads: int = 4,
+        process_min_size: int = 1024 * 1024,
+        max_pending: int = 32,
+    ):
+        """`processes`: size of the process pool (None: number of CPUs, 0: no processes)"""
+        self.processes = processes
+        self.threads = threads
+        self.process_min_size = process_min_size
+        self.max_pending = max_pending
+
+        # Pools are started on first use
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        # Submitted computations that are not done (released from the pools' threads)
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _get_pool(self, size: int) -> Executor:
+        if self.processes != 0 and size >= self.process_min_size:
+            if self._process_pool is None:
+                # Not forked: the parent has an event loop and threads
+                self._process_pool = ProcessPoolExecutor(
+                    self.processes, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._process_pool
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(self.threads, thread_name_prefix="statistics")
+        return self._thread_pool
+
+    def _release(self, future: Future):
+        with self._lock:
+            self._pending -= 1
+
+    def _submit(self, pool: Executor, fn: Callable[..., T], *args: Any) -> Future:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise HTTPException(
+                    status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Statistics workers are busy",
+                    headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+                )
+            self._pending += 1
+        try:
+            future = pool.submit(fn, *args)
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    async def run(self, size: int, fn: Callable[..., T], *args: Any) -> T:
+        """Result of `fn(*args)` (picklable, if it may run in a process) on an input of `size` bytes"""
+        pool = self._get_pool(size)
+        try:
+            future = self._submit(pool, fn, *args)
+            # Cancelled (e.g. the client is gone) before it started: it's removed from the queue
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            if pool is self._process_pool:
+                logger.error("Statistics worker process died, restarting the process pool")
+                self._reset_process_pool()
+            raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, detail="Statistics worker failed")
+
+    def _reset_process_pool(self):
+        pool, self._process_pool = self._process_pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        self._reset_process_pool()
+        pool, self._thread_pool = self._thread_pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+@lru_cache()
+def get_statistics_executor() -> StatisticsExecutor:
+    settings = StatisticsSettings()
+    return StatisticsExecutor(
+        processes=settings.statistics_processes,
+        threads=settings.statistics_threads,
+        process_min_size=settings.statistics_process_min_size,
+        max_pending=settings.statistics_max_pending,
+    )
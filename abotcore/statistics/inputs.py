@@ -0,0 +1,192 @@
+"""Request bodies of the statistics endpoints.
+
+Besides JSON rows (`{"data": [{...}, ...]}`, validated by pydantic), data can be
+sent column-oriented, which is turned into a data frame without validating each
+value:
+
+- JSON columns: `{"columns": {"y": [...], ...}, "index": [...], ...options}`
+- CSV (`text/csv`), Arrow IPC (stream or file) and Parquet bodies, with the
+  options in the query string (`?method=average&method=count&aggregation_column=y`)
+
+Bodies are parsed in the statistics workers (with the computation), not on the
+event loop.
+"""
+
+import io
+import json
+from typing import Any, Dict, Optional, Tuple, Type
+
+import pandas as pd
+from fastapi import HTTPException, Request, status
+from starlette.datastructures import QueryParams
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+
+from .schemas import DataIn, DataOptions
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_MEDIA_TYPE = "application/json"
+CSV_MEDIA_TYPE = "text/csv"
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+ARROW_FILE_MEDIA_TYPE = "application/vnd.apache.arrow.file"
+PARQUET_MEDIA_TYPES = ("application/vnd.apache.parquet", "application/x-parquet")
+
+# Options sent as JSON in the query string
+JSON_QUERY_OPTIONS = frozenset(("aggregation_options",))
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise HTTPException(
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Arrow and Parquet data require pyarrow on the server"
+        )
+    return pyarrow
+
+
+def _json_loads(body: bytes) -> Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(body)
+        except orjson.JSONDecodeError:
+            # e.g. NaN or integers over 64 bits, which `json` accepts
+            pass
+    try:
+        return json.loads(body)
+    except json.JSONDecodeError as e:
+        raise RequestValidationError([ErrorWrapper(e, ("body", e.pos))])
+
+
+def _parse_model(model: Type[DataOptions], values: Dict[str, Any], loc: str):
+    try:
+        return model.parse_obj(values)
+    except ValidationError as e:
+        raise RequestValidationError([ErrorWrapper(e, (loc,))])
+
+
+def _bad_data(e: Exception) -> HTTPException:
+    return HTTPException(status.HTTP_400_BAD_REQUEST, detail=f"Invalid data: {e}")
+
+
+def query_options(query: QueryParams, options_model: Type[DataOptions]) -> DataOptions:
+    """Options from the query string (repeated parameters are lists)"""
+    values: Dict[str, Any] = {}
+    for name in options_model.__fields__:
+        items = query.getlist(name)
+        if not items:
+            continue
+        if name in JSON_QUERY_OPTIONS:
+            try:
+                values[name] = json.loads(items[-1])
+            except ValueError:
+                raise _bad_data(f"{name} is not JSON")
+        else:
+            values[name] = items if len(items) > 1 else items[0]
+    return _parse_model(options_model, values, "query")
+
+
+def columns_frame(columns: Dict[str, Any], index: Optional[Any] = None) -> pd.DataFrame:
+    """Data frame of `{"column": [values...]}` (all of the same length)"""
+    if not all(isinstance(values, list) for values in columns.values()):
+        raise _bad_data("columns must be lists of values")
+    try:
+        return pd.DataFrame(columns, index=index)
+    except (TypeError, ValueError) as e:
+        raise _bad_data(e)
+
+
+def read_frame(media_type: str, body: bytes) -> Optional[pd.DataFrame]:
+    """Data frame of a CSV, Arrow or Parquet body (None for other media types)"""
+    if media_type == CSV_MEDIA_TYPE:
+        try:
+            return pd.read_csv(io.BytesIO(body))
+        except ValueError as e:
+            raise _bad_data(e)
+    if media_type not in (ARROW_STREAM_MEDIA_TYPE, ARROW_FILE_MEDIA_TYPE) + PARQUET_MEDIA_TYPES:
+        return None
+
+    pa = _import_pyarrow()
+    try:
+        if media_type == ARROW_STREAM_MEDIA_TYPE:
+            table = pa.ipc.open_stream(body).read_all()
+        elif media_type == ARROW_FILE_MEDIA_TYPE:
+            table = pa.ipc.open_file(pa.BufferReader(body)).read_all()
+        else:
+            table = pa.parquet.read_table(pa.BufferReader(body))
+    except (pa.ArrowException, ValueError) as e:
+        raise _bad_data(e)
+    # The index is restored from the pandas metadata (if the data was written from a data frame)
+    return table.to_pandas()
+
+
+def request_media_type(request: Request) -> str:
+    return request.headers.get("content-type", JSON_MEDIA_TYPE).split(";")[0].strip().lower()
+
+
+def parse_statistics_input(
+    media_type: str, body: bytes, query: str, rows_model: Type[DataIn], options_model: Type[DataOptions]
+) -> Tuple[DataOptions, Optional[pd.DataFrame]]:
+    """Options and data frame of a request body (and its query string). JSON rows
+    are validated with `rows_model` (returned as the options, without a frame)"""
+    frame = read_frame(media_type, body)
+    if frame is not None:
+        return query_options(QueryParams(query), options_model), frame
+    if media_type != JSON_MEDIA_TYPE and not media_type.endswith("+json"):
+        raise HTTPException(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=f"Unsupported data type: {media_type}")
+
+    content = _json_loads(body)
+    if isinstance(content, dict) and isinstance(content.get("columns"), dict):
+        values = dict(content)
+        frame = columns_frame(values.pop("columns"), values.pop("index", None))
+        return _parse_model(options_model, values, "body"), frame
+    return _parse_model(rows_model, content, "body"), None
+
+
+def _inline_schema(model: Type[DataOptions]) -> dict:
+    # OpenAPI schema of the model, with its definitions (enums) in place of references
+    schema = model.schema()
+    definitions = schema.pop("definitions", {})
+
+    def resolve(value):
+        if isinstance(value, dict):
+            if "$ref" in value:
+                return resolve(definitions[value["$ref"].rsplit("/", 1)[-1]])
+            return {key: resolve(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [resolve(item) for item in value]
+        return value
+
+    return resolve(schema)
+
+
+def request_body_openapi(rows_model: Type[DataIn], options_model: Type[DataOptions]) -> dict:
+    """`openapi_extra` of an endpoint that reads its body with `parse_statistics_input`"""
+    columns_schema = _inline_schema(options_model)
+    columns_schema["title"] = f"{rows_model.__name__} (columns)"
+    columns_schema["properties"] = {
+        "columns": {"type": "object", "additionalProperties": {"type": "array", "items": {}}},
+        "index": {"type": "array", "items": {}},
+        **columns_schema["properties"],
+    }
+    columns_schema["required"] = ["columns"]
+    binary_schema = {"type": "string", "format": "binary"}
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                JSON_MEDIA_TYPE: {"schema": {"oneOf": [_inline_schema(rows_model), columns_schema]}},
+                CSV_MEDIA_TYPE: {"schema": {"type": "string"}},
+                ARROW_STREAM_MEDIA_TYPE: {"schema": binary_schema},
+                ARROW_FILE_MEDIA_TYPE: {"schema": binary_schema},
+                PARQUET_MEDIA_TYPES[0]: {"schema": binary_schema},
+            },
+        }
+    }
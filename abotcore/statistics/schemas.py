@@ -40,3 +40,21 @@ AggregationOut = Dict[AggregationMethod, Union[float, int]]
 
 class OutliersIn(DataIn, BaseModel):
     outliers_column: Optional[str]
+
+
+# Options of data that isn't sent as JSON rows (`DataIn.data`)
+
+
+class DataOptions(BaseModel):
+    index_column_names: Optional[Union[str, List[str]]]
+    datetime_column_names: Optional[Union[str, List[str]]]
+
+
+class AggregationOptions(DataOptions):
+    method: Union[AggregationMethod, List[AggregationMethod]] = AggregationMethod.RECENT
+    aggregation_column: Optional[str] = None
+    aggregation_options: Optional[Dict[str, Any]] = None
+
+
+class OutliersOptions(DataOptions):
+    outliers_column: Optional[str]
@@ -1,13 +1,19 @@
-from typing import Any, Callable, Dict, List, Optional, Tuple, Set
+from typing import Any, Callable, Dict, List, Optional, Tuple, Set, Union
 
 import pandas as pd
+from fastapi import Depends
 
+from .executor import StatisticsExecutor, get_statistics_executor
+from .inputs import parse_statistics_input
 from .schemas import (
     AggregationIn,
     AggregationMethod,
+    AggregationOptions,
     AggregationOut,
     DataIn,
+    DataOptions,
     OutliersIn,
+    OutliersOptions,
 )
 
 PERCENTILE_25 = 0.25
@@ -122,14 +128,19 @@ class DataStatisticsService:
         AggregationMethod.COUNT,
     }
 
-    async def extract_data(self, data_in: DataIn) -> pd.DataFrame:
-        df = pd.DataFrame(
-            **data_in.dict(
-                include=DataIn.__fields__.keys(),
-                exclude={"index_column_names", "datetime_column_names"},
-                exclude_unset=True,
+    # Computations on the request data (run in the executor's threads or processes)
+
+    def extract_data(data_in: Union[DataIn, DataOptions], frame: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+        """Data frame of the rows of `data_in`, or the given frame (from columnar/binary input)"""
+        df = frame
+        if df is None:
+            df = pd.DataFrame(
+                **data_in.dict(
+                    include=DataIn.__fields__.keys(),
+                    exclude={"index_column_names", "datetime_column_names"},
+                    exclude_unset=True,
+                )
             )
-        )
         if data_in.datetime_column_names is not None:
             dt_cols = data_in.datetime_column_names
             if isinstance(dt_cols, str):
@@ -142,9 +153,11 @@ class DataStatisticsService:
             df.set_index(data_in.index_column_names, inplace=True)
         return df
 
-    async def aggregation(self, agg_data: AggregationIn) -> AggregationOut:
+    def data_aggregation(
+        agg_data: Union[AggregationIn, AggregationOptions], frame: Optional[pd.DataFrame] = None
+    ) -> AggregationOut:
         """Calculates aggregation on given data using the given method or methods"""
-        df = await self.extract_data(agg_data)
+        df = DataStatisticsService.extract_data(agg_data, frame)
 
         def _do_aggregation(
             data: pd.Series, methods: Set[AggregationMethod], options: Dict[str, Any]
@@ -153,10 +166,10 @@ class DataStatisticsService:
             for mthd in methods:
                 if mthd == AggregationMethod.SUMMARY:
                     result.update(
-                        _do_aggregation(data, self.AGG_SUMMARY_METHODS, options)
+                        _do_aggregation(data, DataStatisticsService.AGG_SUMMARY_METHODS, options)
                     )
                     continue
-                result[mthd] = self.AGG_METHODS[mthd](data, **options)
+                result[mthd] = DataStatisticsService.AGG_METHODS[mthd](data, **options)
             return result
 
         methods: Set[AggregationMethod] = (
@@ -169,8 +182,33 @@ class DataStatisticsService:
 
         return _do_aggregation(data_series, methods, agg_options)
 
-    async def outliers(self, data: OutliersIn) -> List[dict]:
-        df = await self.extract_data(data)
+    def data_outliers(
+        data: Union[OutliersIn, OutliersOptions], frame: Optional[pd.DataFrame] = None
+    ) -> List[dict]:
+        df = DataStatisticsService.extract_data(data, frame)
         return DataStatisticsService.data_get_outliers(
             df[data.outliers_column or df.columns[-1]]
         ).to_dict(orient="records")
+
+    def aggregation_of_body(media_type: str, body: bytes, query: str = "") -> AggregationOut:
+        agg_data, frame = parse_statistics_input(media_type, body, query, AggregationIn, AggregationOptions)
+        return DataStatisticsService.data_aggregation(agg_data, frame)
+
+    def outliers_of_body(media_type: str, body: bytes, query: str = "") -> List[dict]:
+        data, frame = parse_statistics_input(media_type, body, query, OutliersIn, OutliersOptions)
+        return DataStatisticsService.data_outliers(data, frame)
+
+    def __init__(self, executor: StatisticsExecutor = Depends(get_statistics_executor)):
+        self.executor = executor
+
+    # The body is parsed in the worker too (see `inputs`)
+
+    async def aggregation(self, media_type: str, body: bytes, query: str = "") -> AggregationOut:
+        return await self.executor.run(
+            len(body), DataStatisticsService.aggregation_of_body, media_type, body, query
+        )
+
+    async def outliers(self, media_type: str, body: bytes, query: str = "") -> List[dict]:
+        return await self.executor.run(
+            len(body), DataStatisticsService.outliers_of_body, media_type, body, query
+        )
@@ -1,25 +1,41 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request
 
+from abotcore.responses import FastJSONResponse
+
+from .executor import get_statistics_executor
+from .inputs import request_body_openapi, request_media_type
 from .services import DataStatisticsService
-from .schemas import AggregationIn, AggregationOut, OutliersIn
+from .schemas import AggregationIn, AggregationOptions, AggregationOut, OutliersIn, OutliersOptions
 
 router = APIRouter(prefix="/statistics")
 
 
+@router.on_event("shutdown")
+async def stop_statistics_executor():
+    get_statistics_executor().shutdown()
+
+
 """ /statistics/ """
 
 
-@router.post("/aggregation")
+# Bodies are JSON rows, JSON columns, CSV, Arrow or Parquet (see `inputs`)
+
+
+@router.post("/aggregation", openapi_extra=request_body_openapi(AggregationIn, AggregationOptions))
 async def data_aggregation(
-    agg_data: AggregationIn,
+    request: Request,
     stat_serv: DataStatisticsService = Depends(DataStatisticsService),
 ) -> AggregationOut:
-    return await stat_serv.aggregation(agg_data)
+    body = await request.body()
+    return await stat_serv.aggregation(request_media_type(request), body, str(request.query_params))
 
 
-@router.post("/outliers")
+@router.post("/outliers", openapi_extra=request_body_openapi(OutliersIn, OutliersOptions))
 async def data_outliers(
-    agg_data: OutliersIn,
+    request: Request,
     stat_serv: DataStatisticsService = Depends(DataStatisticsService),
-):
-    return await stat_serv.outliers(agg_data)
+) -> FastJSONResponse:
+    body = await request.body()
+    records = await stat_serv.outliers(request_media_type(request), body, str(request.query_params))
+    # Records are encoded directly (values that orjson can't encode go through jsonable_encoder)
+    return FastJSONResponse(records)
@@ -0,0 +1,58 @@
+"""Micro-benchmark of the per-request overhead of `/chat`, with the dummy chat server.
+
+Requests are sent in-process (ASGI), so the time is spent in the app only.
+DB sessions come from a temporary SQLite DB, like they would from the configured one.
+
+Usage: python -m benchmarks.chat_overhead [requests]
+"""
+
+import asyncio
+import os
+import sys
+import time
+from tempfile import mkstemp
+
+import httpx
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from abotcore.coreapp import create_app
+from abotcore.db import Session, get_session
+
+WARMUP_REQUESTS = 200
+
+
+async def main(requests: int):
+    fd, db_path = mkstemp(suffix=".sqlite3")
+    os.close(fd)
+    engine = create_async_engine("sqlite+aiosqlite:///%s" % db_path)
+    sessions = sessionmaker(bind=engine, class_=Session, autoflush=False, future=True)
+
+    async def _session():
+        async with sessions() as session:
+            yield session
+
+    app = create_app()
+    app.dependency_overrides[get_session] = _session
+
+    try:
+        async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+            for i in range(WARMUP_REQUESTS):
+                await client.post("/chat", json={"text": "ping", "sender_id": "user%d" % (i % 10)})
+
+            started = time.perf_counter()
+            for i in range(requests):
+                response = await client.post(
+                    "/chat", json={"text": "ping", "sender_id": "user%d" % (i % 10)}
+                )
+                response.raise_for_status()
+            elapsed = time.perf_counter() - started
+    finally:
+        await engine.dispose()
+        os.remove(db_path)
+
+    print("%d requests: %.1f us/request" % (requests, elapsed / requests * 1e6))
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
@@ -0,0 +1,78 @@
+import asyncio
+import unittest
+
+import httpx
+
+from abotcore.api import ROUTE_KEY, BalancingTransport
+
+ENDPOINTS = ["http://replica-a:5005", "http://replica-b:5005", "http://replica-c:5005/base"]
+
+
+class TestBalancingTransport(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.down = set()
+
+        async def _handler(request: httpx.Request):
+            if request.url.host in self.down:
+                raise httpx.ConnectError("down", request=request)
+            if request.url.path.endswith("/slow"):
+                await asyncio.sleep(1)
+            return httpx.Response(200, text=request.url.host + request.url.path)
+
+        self.transport = BalancingTransport(
+            ENDPOINTS, max_failures=2, transport_factory=lambda: httpx.MockTransport(_handler)
+        )
+        self.client = httpx.AsyncClient(base_url="http://upstream", transport=self.transport)
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+
+    async def test_least_outstanding(self):
+        # Requests are outstanding until their responses are closed
+        async with self.client.stream("GET", "/one") as first:
+            async with self.client.stream("GET", "/two") as second:
+                third = await self.client.get("/three")
+                replies = [(await first.aread()).decode(), (await second.aread()).decode(), third.text]
+        self.assertEqual(
+            sorted(reply.split("/")[0] for reply in replies), ["replica-a", "replica-b", "replica-c"]
+        )
+        self.assertEqual([replica.outstanding for replica in self.transport.replicas], [0, 0, 0])
+
+    async def test_sticky_with_ejection(self):
+        self.transport.sticky = True
+        replies = {(await self.client.get("/hook", extensions={ROUTE_KEY: "user1"})).text for _ in range(3)}
+        self.assertEqual(len(replies), 1)
+
+        # Connection failures move the sender to another replica, and eject the failing one
+        sticky_host = replies.pop().split("/")[0]
+        self.down.add(sticky_host)
+        for _ in range(2):
+            response = await self.client.get("/hook", extensions={ROUTE_KEY: "user1"})
+            self.assertNotEqual(response.text.split("/")[0], sticky_host)
+        self.assertEqual(
+            [replica.url.host for replica in self.transport.replicas if replica.ejected_until], [sticky_host]
+        )
+
+    async def test_base_path(self):
+        self.down.update({"replica-a", "replica-b"})
+        response = await self.client.get("/webhooks/rest?x=1")
+        self.assertEqual(response.text, "replica-c/base/webhooks/rest")
+        self.assertEqual(response.request.headers["Host"], "replica-c:5005")
+
+    async def test_cancelled_request_not_recorded(self):
+        replica = self.transport.replicas[0]
+        replica.failures = 1
+        self.transport.pick = lambda *args, **kwargs: replica
+
+        request = asyncio.ensure_future(self.client.get("/slow"))
+        await asyncio.sleep(0.01)
+        request.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await request
+
+        self.assertEqual(replica.failures, 1)
+        self.assertEqual(replica.outstanding, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+
+import time
+import unittest
+
+from abotcore.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_entry_budget(self):
+        cache = LRUCache(max_entries=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+
+        # "b" was least recently used
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_byte_budget(self):
+        cache = LRUCache(max_bytes=10, sizeof=len)
+        cache.put("a", "12345")
+        cache.put("b", "12345")
+        cache.put("c", "123")
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.total_bytes, 8)
+
+        # Larger than the whole budget, never stored
+        cache.put("d", "x" * 11)
+        self.assertNotIn("d", cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.01)
+        cache.put("a", 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+
+    def test_counters(self):
+        cache = LRUCache()
+        cache.put("a", 1)
+        cache.get("a")
+        cache.get("b")
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
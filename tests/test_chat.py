@@ -0,0 +1,136 @@
+
+import json
+import os
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+from abotcore.config import FileCacheServerSettings
+from abotcore.coreapp import create_app
+from abotcore.db import get_session
+
+
+async def _no_session():
+    yield None
+
+
+def create_test_client() -> TestClient:
+    """Client of the core app, without DB sessions (dummy chat server doesn't use them)"""
+    app = create_app()
+    app.dependency_overrides[get_session] = _no_session
+    return TestClient(app)
+
+
+class TestChatStream(unittest.TestCase):
+    client = create_test_client()
+    ENDPOINT = "/chat/webhook/dummy/stream"
+
+    def test_sse(self):
+        response = self.client.post(self.ENDPOINT, json={"text": "hello", "sender_id": "user1"})
+
+        self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+        events = [
+            line[len("event: "):] for line in response.text.splitlines() if line.startswith("event: ")
+        ]
+        self.assertEqual(events[-2:], ["message", "done"])
+        self.assertTrue(all(event == "delta" for event in events[:-2]))
+
+    def test_ndjson(self):
+        response = self.client.post(
+            self.ENDPOINT,
+            json={"text": "hello", "sender_id": "user1"},
+            headers={"Accept": "application/x-ndjson"},
+        )
+
+        chunks = [json.loads(line) for line in response.text.splitlines()]
+        deltas = "".join(chunk["data"]["text"] for chunk in chunks if chunk["event"] == "delta")
+        self.assertEqual(deltas, "Hi! How may I help?")
+        self.assertEqual(
+            chunks[-2], {"event": "message", "data": {"text": "Hi! How may I help?", "recipient_id": "user1"}}
+        )
+        self.assertEqual(chunks[-1], {"event": "done"})
+
+
+class TestChatBatch(unittest.TestCase):
+    client = create_test_client()
+    ENDPOINT = "/chat/webhook/dummy/batch"
+
+    def test_results_in_input_order(self):
+        response = self.client.post(self.ENDPOINT, json=[
+            {"text": "hello", "sender_id": "user1"},
+            {"text": "ping", "sender_id": "user2"},
+            {"text": "ping", "sender_id": "user1"},
+        ])
+
+        result = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(item["messages"][0]["recipient_id"], item["messages"][0]["text"]) for item in result],
+            [("user1", "Hi! How may I help?"), ("user2", "Pong"), ("user1", "Pong")],
+        )
+
+
+class TestChatWebSocket(unittest.TestCase):
+    client = create_test_client()
+
+    def test_turns_on_one_connection(self):
+        with self.client.websocket_connect("/chat/webhook/dummy/ws?sender_id=user1") as websocket:
+            for text, reply in [("hello", "Hi! How may I help?"), ("ping", "Pong")]:
+                websocket.send_text(json.dumps({"text": text}))
+                chunks = []
+                while not chunks or chunks[-1]["event"] != "done":
+                    chunks.append(json.loads(websocket.receive_text()))
+                messages = [chunk["data"] for chunk in chunks if chunk["event"] == "message"]
+                self.assertEqual(messages, [{"text": reply, "recipient_id": "user1"}])
+
+            websocket.send_text(json.dumps({"message": "ping"}))
+            self.assertEqual(json.loads(websocket.receive_text())["event"], "error")
+
+
+class TestChatCache(unittest.TestCase):
+    client = create_test_client()
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        patches = [
+            mock.patch.object(
+                FileCacheServerSettings, "get_cache_storage_path", return_value=Path(self.directory.name)
+            ),
+            mock.patch.object(FileCacheServerSettings, "get_cache_max_upload_size", return_value=1000),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.directory.cleanup)
+
+    def cached_files(self):
+        return [name for name in os.listdir(self.directory.name) if not name.startswith(".")]
+
+    def test_upload_streamed_to_file(self):
+        response = self.client.post("/chat/cache", files={"file": ("image.png", b"\x89PNG" * 200)})
+
+        self.assertEqual(response.status_code, 200)
+        (name,) = self.cached_files()
+        self.assertTrue(response.json()["url"].endswith(name))
+        with open(os.path.join(self.directory.name, name), "rb") as f:
+            self.assertEqual(f.read(), b"\x89PNG" * 200)
+
+    def test_duplicate_upload(self):
+        first = self.client.post("/chat/cache", files={"file": ("a.png", b"same")})
+        second = self.client.post("/chat/cache", files={"file": ("b.png", b"same")})
+
+        self.assertEqual(first.json()["url"], second.json()["url"])
+        self.assertEqual(len(self.cached_files()), 1)
+
+    def test_too_large(self):
+        response = self.client.post("/chat/cache", files={"file": ("image.png", b"\x89PNG" * 300)})
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
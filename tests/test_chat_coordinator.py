@@ -0,0 +1,85 @@
+
+import asyncio
+import unittest
+
+from abotcore.chat.schemas import ChatMessageIn, ChatMessageOut, ChatStreamChunk, ChatStreamEvent
+from abotcore.chat.services.coordinator import ChatTurnCoordinator
+
+
+class TestChatTurnCoordinator(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.coordinator = ChatTurnCoordinator()
+        self.calls = []
+
+    async def _reply(self, chat_message: ChatMessageIn):
+        self.calls.append(("start", chat_message.text))
+        await asyncio.sleep(0.01)
+        self.calls.append(("end", chat_message.text))
+        return [ChatMessageOut(recipient_id=chat_message.sender_id, text=chat_message.text)]
+
+    async def test_sender_turns_are_serialized(self):
+        await asyncio.gather(
+            self.coordinator.run(ChatMessageIn(text="1", sender_id="a"), self._reply),
+            self.coordinator.run(ChatMessageIn(text="2", sender_id="a"), self._reply),
+        )
+        self.assertEqual(
+            self.calls, [("start", "1"), ("end", "1"), ("start", "2"), ("end", "2")]
+        )
+
+    async def test_duplicates_attach_to_original(self):
+        msg = dict(text="1", sender_id="a", idempotency_key="k1")
+        first, second = await asyncio.gather(
+            self.coordinator.run(ChatMessageIn(**msg), self._reply),
+            self.coordinator.run(ChatMessageIn(**msg), self._reply),
+        )
+        third = await self.coordinator.run(ChatMessageIn(**msg), self._reply)
+
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(first, second)
+        self.assertEqual(first, third)
+
+        # Different key is a different message
+        await self.coordinator.run(ChatMessageIn(text="1", sender_id="a", idempotency_key="k2"), self._reply)
+        self.assertEqual(len(self.calls), 4)
+
+    async def test_failures_are_not_remembered(self):
+        async def _fail(chat_message):
+            raise ValueError("fail")
+
+        msg = ChatMessageIn(text="1", sender_id="a", idempotency_key="k1")
+        with self.assertRaises(ValueError):
+            await self.coordinator.run(msg, _fail)
+        await self.coordinator.run(msg, self._reply)
+        self.assertEqual(len(self.calls), 2)
+
+    async def test_anonymous_messages_not_deduplicated(self):
+        async def _reply(chat_message):
+            return await self._reply(chat_message.copy(update={"sender_id": "anonymous"}))
+
+        await self.coordinator.run(ChatMessageIn(text="1", idempotency_key="1"), _reply)
+        await self.coordinator.run(ChatMessageIn(text="2", idempotency_key="1"), _reply)
+        self.assertEqual(len(self.calls), 4)
+
+    async def test_retry_of_cancelled_stream(self):
+        msg = dict(text="1", sender_id="a", idempotency_key="k1")
+
+        async def _stream_reply(chat_message):
+            for message in await self._reply(chat_message):
+                yield ChatStreamChunk(event=ChatStreamEvent.MESSAGE, data=message)
+
+        async def _consume():
+            async for _ in self.coordinator.stream(ChatMessageIn(**msg), _stream_reply):
+                pass
+
+        original = asyncio.ensure_future(_consume())
+        await asyncio.sleep(0)
+        retry = asyncio.ensure_future(self.coordinator.run(ChatMessageIn(**msg), self._reply))
+        await asyncio.sleep(0)
+        # The client of the stream disconnects
+        original.cancel()
+
+        self.assertEqual((await retry)[0].text, "1")
+
+
+if __name__ == '__main__':
+    unittest.main()
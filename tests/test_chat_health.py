@@ -0,0 +1,59 @@
+
+import unittest
+
+from fastapi import HTTPException
+
+from abotcore.chat.schemas import ChatStatusOut, RestEndpointStatus
+from abotcore.chat.services.health import ChatHealthMonitor, CircuitBreaker, CircuitState
+from abotcore.schemas import ChatServiceType
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_after_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitState.OPEN)
+        self.assertFalse(breaker.allow_request())
+
+    def test_half_open_trial(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+        self.assertEqual(breaker.state, CircuitState.HALF_OPEN)
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitState.CLOSED)
+
+
+class _Server:
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    async def get_status(self):
+        return ChatStatusOut(status=self.statuses.pop(0))
+
+
+class TestChatHealthMonitor(unittest.IsolatedAsyncioTestCase):
+    async def test_cached_status_and_fail_fast(self):
+        statuses = [RestEndpointStatus.UNREACHABLE, RestEndpointStatus.OK]
+        monitor = ChatHealthMonitor(lambda service: _Server(statuses), status_ttl=60)
+
+        status = await monitor.get_status(ChatServiceType.RASA)
+        self.assertEqual(status.status, RestEndpointStatus.UNREACHABLE)
+        # Answered from the cache
+        status = await monitor.get_status(ChatServiceType.RASA)
+        self.assertEqual(status.status, RestEndpointStatus.UNREACHABLE)
+        self.assertEqual(len(statuses), 1)
+
+        with self.assertRaises(HTTPException) as ctx:
+            monitor.ensure_available(ChatServiceType.RASA)
+        self.assertEqual(ctx.exception.status_code, 503)
+
+        # Service is back up
+        await monitor.probe(ChatServiceType.RASA)
+        monitor.ensure_available(ChatServiceType.RASA)
+
+
+if __name__ == '__main__':
+    unittest.main()
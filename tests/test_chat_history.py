@@ -0,0 +1,130 @@
+import importlib.util
+import unittest
+from datetime import datetime, timedelta, timezone
+from tempfile import TemporaryDirectory
+
+from sqlalchemy import func, insert, inspect, select
+
+from abotcore.chat.archive import ChatHistoryMaintenance, HistoryArchive
+from abotcore.chat.models import ChatHistory
+from abotcore.chat.schemas import ChatRole
+from abotcore.db import create_missing_indexes, Base
+
+from .utils import TemporaryDB
+
+
+class TestChatHistoryPages(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = await TemporaryDB().create()
+        start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        rows = [
+            # Pairs of messages at the same time
+            dict(chat_handler="chain", message_client_id="user1", message_role=ChatRole.HUMAN,
+                 message_content=str(i), message_time=start + timedelta(seconds=i // 2))
+            for i in range(7)
+        ] + [
+            dict(chat_handler="other", message_client_id="user1", message_role=ChatRole.AI,
+                 message_content="other", message_time=start),
+            dict(chat_handler="chain", message_client_id="user2", message_role=ChatRole.AI,
+                 message_content="user2", message_time=start),
+        ]
+        async with self.db.sessionmaker() as session:
+            await session.execute(insert(ChatHistory), rows)
+            await session.commit()
+
+    async def asyncTearDown(self):
+        await self.db.dispose()
+
+    async def test_pages_in_order_without_gaps(self):
+        contents, before = [], None
+        async with self.db.sessionmaker() as session:
+            while True:
+                page = await ChatHistory.history_page(
+                    session, "user1", 3, chat_handler="chain", before=before
+                )
+                contents.extend(message.message_content for message in page)
+                if len(page) < 3:
+                    break
+                before = (page[-1].message_time, page[-1].chat_message_id)
+
+        self.assertEqual(contents, ["6", "5", "4", "3", "2", "1", "0"])
+
+    async def test_create_missing_indexes(self):
+        def _index_names(sync_conn):
+            return [index["name"] for index in inspect(sync_conn).get_indexes("chat_history")]
+
+        indexes = ChatHistory.__table__.indexes
+        async with self.db.engine.begin() as conn:
+            for index in indexes:
+                await conn.run_sync(index.drop)
+            self.assertEqual(await conn.run_sync(_index_names), [])
+
+            await conn.run_sync(create_missing_indexes, Base.metadata)
+            # Existing indexes are skipped
+            await conn.run_sync(create_missing_indexes, Base.metadata)
+            self.assertEqual(
+                sorted(await conn.run_sync(_index_names)), sorted(index.name for index in indexes)
+            )
+
+
+@unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+class TestChatHistoryArchive(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = await TemporaryDB().create()
+        self.directory = TemporaryDirectory()
+        self.archive = HistoryArchive(self.directory.name)
+        rows = [
+            dict(chat_handler="chain", message_client_id="user1", message_role=ChatRole.HUMAN,
+                 message_content=str(i), message_time=datetime(2023, 1 + i // 2, 10 + i, tzinfo=timezone.utc))
+            for i in range(6)
+        ]
+        async with self.db.sessionmaker() as session:
+            await session.execute(insert(ChatHistory), rows)
+            await session.commit()
+
+    async def asyncTearDown(self):
+        await self.db.dispose()
+        self.directory.cleanup()
+
+    async def test_archive_expired_months(self):
+        maintenance = ChatHistoryMaintenance(
+            self.archive, retention_days=30, sessionmaker=self.db.sessionmaker
+        )
+        # March is within the retention
+        archived = await maintenance.run_once(now=datetime(2023, 3, 31, tzinfo=timezone.utc))
+
+        self.assertEqual(archived, [(2023, 1), (2023, 2)])
+        self.assertEqual(self.archive.months(), [(2023, 1), (2023, 2)])
+        async with self.db.sessionmaker() as session:
+            self.assertEqual(await session.scalar(select(func.count()).select_from(ChatHistory)), 2)
+
+        page = await self.archive.read_page("user1", 3)
+        self.assertEqual([message["message_content"] for message in page], ["3", "2", "1"])
+        page = await self.archive.read_page(
+            "user1", 3, before=(page[-1]["message_time"], page[-1]["chat_message_id"])
+        )
+        self.assertEqual([message["message_content"] for message in page], ["0"])
+        self.assertEqual(await self.archive.read_page("user2", 3), [])
+
+    async def test_month_archived_again(self):
+        maintenance = ChatHistoryMaintenance(
+            self.archive, retention_days=30, sessionmaker=self.db.sessionmaker
+        )
+        await maintenance.run_once(now=datetime(2023, 3, 31, tzinfo=timezone.utc))
+        # Written late (e.g. by a journal that couldn't reach the DB)
+        async with self.db.sessionmaker() as session:
+            await session.execute(insert(ChatHistory), [
+                dict(chat_handler="chain", message_client_id="user1", message_role=ChatRole.AI,
+                     message_content="late", message_time=datetime(2023, 1, 20, tzinfo=timezone.utc))
+            ])
+            await session.commit()
+        await maintenance.run_once(now=datetime(2023, 3, 31, tzinfo=timezone.utc))
+
+        self.assertEqual(self.archive.months(), [(2023, 1), (2023, 2)])
+        self.assertTrue(self.archive.path((2023, 1), 1).exists())
+        page = await self.archive.read_page("user1", 10)
+        self.assertEqual([message["message_content"] for message in page], ["3", "2", "late", "1", "0"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+
+import asyncio
+import unittest
+
+from sqlalchemy import select
+
+from abotcore.cache import LRUCache
+from abotcore.chat.journal import ChatJournal
+from abotcore.chat.memory import CachedMemory, load_memory_window, memory_versions
+from abotcore.chat.models import ChatHistory, UserChatMemoryEntry
+from abotcore.chat.schemas import ChatRole, Memory
+from abotcore.chat.services.langcorn import LangcornChatServer
+
+from .utils import TemporaryDB
+
+
+def _memory(*contents):
+    return [
+        Memory.parse_obj({"type": "human", "data": {"content": content, "additional_kwargs": {}}})
+        for content in contents
+    ]
+
+
+MEMORY = _memory("hi")
+
+
+class TestChatJournal(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = await TemporaryDB().create()
+        self.sessionmaker = self.db.sessionmaker
+
+    async def asyncTearDown(self):
+        await self.db.dispose()
+
+    async def _history(self):
+        async with self.sessionmaker() as session:
+            return (
+                await session.scalars(select(ChatHistory).order_by(ChatHistory.chat_message_id))
+            ).all()
+
+    async def test_write_behind_flush_on_stop(self):
+        journal = ChatJournal(self.sessionmaker, flush_interval=60)
+        await journal.start()
+
+        await journal.record_history("chain", "user1", ChatRole.HUMAN, "one")
+        await journal.record_history("chain", "user1", ChatRole.AI, "two")
+        await journal.record_memory("user1", MEMORY)
+
+        # Nothing written yet
+        self.assertEqual(len(await self._history()), 0)
+        self.assertTrue(journal.has_pending_memory("user1"))
+        self.assertTrue(journal.has_pending_history("user1"))
+        self.assertFalse(journal.has_pending_history("user2"))
+
+        await journal.stop()
+
+        history = await self._history()
+        self.assertEqual([h.message_content for h in history], ["one", "two"])
+        self.assertFalse(journal.has_pending_memory("user1"))
+        async with self.sessionmaker() as session:
+            self.assertEqual(await load_memory_window(session, "user1"), MEMORY)
+
+    async def test_flush_on_batch_size(self):
+        journal = ChatJournal(self.sessionmaker, max_batch=2, flush_interval=60)
+        await journal.start()
+
+        await journal.record_history("chain", "user1", ChatRole.HUMAN, "one")
+        await journal.record_history("chain", "user1", ChatRole.AI, "two")
+        for _ in range(50):
+            if journal.pending == 0:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(len(await self._history()), 2)
+
+        await journal.stop()
+
+    async def test_unreachable_database(self):
+        def unreachable():
+            raise ConnectionRefusedError("database is down")
+
+        journal = ChatJournal(unreachable, write_behind=False)
+        await journal.record_history("chain", "user1", ChatRole.HUMAN, "one")
+        await journal.record_history("chain", "user1", ChatRole.AI, "two")
+        self.assertEqual(journal.pending, 2)
+
+        journal._sessionmaker = self.sessionmaker
+        await journal.flush()
+        self.assertEqual([row.message_content for row in await self._history()], ["one", "two"])
+
+    async def test_rejected_row_dropped(self):
+        journal = ChatJournal(self.sessionmaker, max_retries=1, flush_interval=60)
+        await journal.start()
+        await journal.record_history("chain", "user1", ChatRole.HUMAN, "one")
+        await journal.record_history({"not": "a name"}, "user1", ChatRole.HUMAN, "bad")
+        await journal.record_history("chain", "user1", ChatRole.AI, "two")
+
+        for _ in range(3):
+            await journal.flush()
+        await journal.stop()
+
+        self.assertEqual(journal.pending, 0)
+        self.assertEqual([row.message_content for row in await self._history()], ["one", "two"])
+
+    async def test_memory_append_and_replace(self):
+        journal = ChatJournal(self.sessionmaker, write_behind=False)
+
+        await journal.record_memory("user1", _memory("a", "b"))
+        await journal.record_memory("user1", _memory("c"))
+        async with self.sessionmaker() as session:
+            self.assertEqual(await load_memory_window(session, "user1"), _memory("a", "b", "c"))
+
+        await journal.record_memory("user1", _memory("x"), replace=True)
+        async with self.sessionmaker() as session:
+            self.assertEqual(await load_memory_window(session, "user1"), _memory("x"))
+
+    async def test_memory_window_archival(self):
+        journal = ChatJournal(self.sessionmaker, write_behind=False, memory_window_entries=2)
+
+        await journal.record_memory("user1", _memory("a", "b", "c"))
+        await journal.record_memory("user2", _memory("d"))
+
+        async with self.sessionmaker() as session:
+            self.assertEqual(await load_memory_window(session, "user1"), _memory("b", "c"))
+            self.assertEqual(await load_memory_window(session, "user2"), _memory("d"))
+            # Archived entries are kept
+            entries = (await session.scalars(select(UserChatMemoryEntry))).all()
+            self.assertEqual(len(entries), 4)
+            self.assertEqual(
+                await load_memory_window(session, "user1", max_bytes=1), _memory("c")
+            )
+
+    async def test_cached_memory_version(self):
+        cache = LRUCache()
+        journal = ChatJournal(self.sessionmaker, write_behind=False, memory_cache=cache)
+
+        cache.put("user1", CachedMemory(_memory("a"), None))
+        await journal.record_memory("user1", _memory("a"))
+        async with self.sessionmaker() as session:
+            versions = await memory_versions(session, ["user1", "user2"])
+        self.assertEqual(versions["user2"], 0)
+        self.assertEqual(cache.get("user1"), CachedMemory(_memory("a"), versions["user1"]))
+
+        await journal.record_memory("user1", [], replace=True)
+        self.assertEqual(cache.get("user1").version, versions["user1"])
+        async with self.sessionmaker() as session:
+            self.assertEqual(await memory_versions(session, ["user1"]), {"user1": 0})
+
+    async def test_memory_changed_by_another_worker(self):
+        def worker():
+            cache = LRUCache()
+            journal = ChatJournal(self.sessionmaker, write_behind=False, memory_cache=cache)
+            return LangcornChatServer(
+                chain_name="chain", sessionmaker=self.sessionmaker, journal=journal, memory_cache=cache
+            )
+
+        worker1, worker2 = worker(), worker()
+        self.assertEqual(await worker1._get_user_memory("user1"), [])
+        await worker1._upsert_user_memory("user1", [], _memory("a"))
+        self.assertEqual(await worker2._get_user_memory("user1"), _memory("a"))
+        self.assertEqual(await worker1._get_user_memory("user1"), _memory("a"))
+
+        await worker2._upsert_user_memory("user1", _memory("a"), _memory("a", "b"))
+        self.assertEqual(await worker1._get_user_memory("user1"), _memory("a", "b"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import hashlib
+import os
+import unittest
+from tempfile import TemporaryDirectory, mkstemp
+
+from abotcore.chat.filecache import FileCacheStore
+from abotcore.chat.uploads import ReceivedUpload
+
+
+class TestFileCacheStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.index_directory = TemporaryDirectory()
+        self.addCleanup(self.index_directory.cleanup)
+        self.index_path = os.path.join(self.index_directory.name, "index.jsonl")
+
+    def upload(self, content: bytes, filename="file.txt") -> ReceivedUpload:
+        fd, path = mkstemp(dir=self.directory.name, prefix=".upload-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        return ReceivedUpload(path, filename, len(content), hashlib.sha256(content).hexdigest())
+
+    def test_evicts_least_recently_used(self):
+        store = FileCacheStore(self.directory.name, max_bytes=10, index_path=self.index_path)
+        first = store.add(self.upload(b"aaaa"))
+        second = store.add(self.upload(b"bbbb"))
+        store.add(self.upload(b"aaaa"))  # first is used again
+        store.add(self.upload(b"cccc"))
+
+        self.assertTrue(first.exists())
+        self.assertFalse(second.exists())
+        self.assertEqual(store.total_bytes, 8)
+
+    def test_index_is_reloaded(self):
+        store = FileCacheStore(self.directory.name, max_bytes=10, index_path=self.index_path)
+        for content in (b"aaaa", b"bbbb", b"cccc"):
+            store.add(self.upload(content))
+
+        reloaded = FileCacheStore(self.directory.name, max_bytes=10, index_path=self.index_path)
+        reloaded.load()
+        self.assertEqual(list(reloaded._entries), list(store._entries))
+        self.assertEqual(reloaded.total_bytes, 8)
+
+    def test_index_not_in_directory(self):
+        store = FileCacheStore(self.directory.name)
+        self.addCleanup(lambda: os.remove(store.index_path))
+        store.add(self.upload(b"aaaa"))
+
+        self.assertEqual([name for name in os.listdir(self.directory.name) if name.startswith(".")], [])
+
+    def test_workers_share_index(self):
+        first = FileCacheStore(self.directory.name, max_bytes=10, index_path=self.index_path)
+        second = FileCacheStore(self.directory.name, max_bytes=10, index_path=self.index_path)
+        first_path = first.add(self.upload(b"aaaa"))
+        second.add(self.upload(b"bbbb"))
+        second._compact()
+        second.add(self.upload(b"cccc"))  # over the quota, the first worker's file is evicted
+
+        self.assertFalse(first_path.exists())
+        reloaded = FileCacheStore(self.directory.name, max_bytes=10, index_path=self.index_path)
+        reloaded.load()
+        self.assertEqual(reloaded.total_bytes, 8)
+        first.add(self.upload(b"dddd"))
+        self.assertEqual(first.total_bytes, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+import asyncio
+import unittest
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from abotcore.fulfillment.models import Fulfillment
+from abotcore.fulfillment.proxy import filter_headers, forward_request, streaming_response
+from abotcore.fulfillment.registry import FulfillmentRegistry, RegisteredFulfillment
+from abotcore.fulfillment.routing import ServiceIndex
+from abotcore.fulfillment.sync import FulfillmentSyncScheduler
+
+from .utils import TemporaryDB
+
+
+def upstream(request: httpx.Request) -> httpx.Response:
+    if request.url.path == "/down":
+        raise httpx.ConnectError("Connection refused", request=request)
+    return httpx.Response(
+        200,
+        headers={
+            "Content-Type": "text/plain",
+            "Connection": "keep-alive, X-Hop",
+            "Keep-Alive": "timeout=5",
+            "X-Hop": "1",
+            "X-Host": request.headers["host"],
+            "X-Custom": request.headers.get("x-custom", ""),
+        },
+        stream=httpx.ByteStream(request.url.path.encode() + b":" + request.content),
+    )
+
+
+class BrokenStream(httpx.AsyncByteStream):
+    """Body that fails after its first chunk (e.g. the fulfillment went away)"""
+
+    def __init__(self):
+        self.closed = False
+
+    async def __aiter__(self):
+        yield b"partial"
+        raise httpx.ReadError("Connection reset")
+
+    async def aclose(self):
+        self.closed = True
+
+
+def create_test_client() -> TestClient:
+    app = FastAPI()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(upstream))
+
+    @app.api_route("/proxy/{path:path}", methods=["GET", "POST"])
+    async def proxy(path: str, request: Request):
+        return await forward_request(client, "http://fulfillment.local/%s" % path, request)
+
+    return TestClient(app)
+
+
+class TestFulfillmentProxy(unittest.TestCase):
+    client = create_test_client()
+
+    def test_forwarded(self):
+        response = self.client.post("/proxy/echo", content=b"body", headers={"X-Custom": "yes", "TE": "trailers"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"/echo:body")
+        self.assertEqual(response.headers["x-host"], "fulfillment.local")
+        self.assertEqual(response.headers["x-custom"], "yes")
+        for name in ("keep-alive", "x-hop"):
+            self.assertNotIn(name, response.headers)
+
+    def test_unavailable(self):
+        response = self.client.get("/proxy/down")
+        self.assertEqual(response.status_code, 502)
+
+    def test_filter_headers(self):
+        headers = [(b"Connection", b"close, X-Option"), (b"X-Option", b"1"), (b"Host", b"a"), (b"Accept", b"*/*")]
+        self.assertEqual(filter_headers(headers, exclude=[b"host"]), [(b"accept", b"*/*")])
+
+
+class TestStreamingResponse(unittest.IsolatedAsyncioTestCase):
+    async def test_upstream_closed_on_error(self):
+        stream = BrokenStream()
+        client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, stream=stream)))
+        upstream_response = await client.send(client.build_request("GET", "http://fulfillment.local/"), stream=True)
+        response = streaming_response(upstream_response)
+
+        chunks = []
+        with self.assertRaises(httpx.ReadError):
+            async for chunk in response.body_iterator:
+                chunks.append(chunk)
+        self.assertEqual(chunks, [b"partial"])
+        self.assertTrue(stream.closed)
+
+
+class TestFulfillmentRegistry(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = await TemporaryDB().create()
+        async with self.db.sessionmaker() as session:
+            session.add(Fulfillment(fulfillment_id=1, endpoint_base_url="http://one.local"))
+            await session.commit()
+        self.sessions = 0
+        self.registry = FulfillmentRegistry(self.sessionmaker, miss_refresh_interval=60)
+
+    def sessionmaker(self):
+        self.sessions += 1
+        return self.db.sessionmaker()
+
+    async def asyncTearDown(self):
+        await self.db.dispose()
+
+    async def test_resolved_from_memory(self):
+        self.assertEqual((await self.registry.resolve(1)).endpoint_base_url, "http://one.local")
+
+        async with self.db.sessionmaker() as session:
+            session.add(Fulfillment(fulfillment_id=2, endpoint_base_url="http://two.local"))
+            await session.commit()
+
+        self.assertEqual((await self.registry.resolve(1)).endpoint_base_url, "http://one.local")
+        # Not reloaded again for unknown ids so soon
+        self.assertIsNone(await self.registry.resolve(2))
+        self.assertEqual(self.sessions, 1)
+
+    async def test_refresh(self):
+        await self.registry.refresh()
+        async with self.db.sessionmaker() as session:
+            session.add(Fulfillment(fulfillment_id=2, endpoint_base_url="http://two.local"))
+            await session.commit()
+
+        await self.registry.refresh()
+        self.assertEqual(len(self.registry), 2)
+
+
+class TestServiceIndex(unittest.TestCase):
+    def test_routes(self):
+        index = ServiceIndex()
+        index.update(RegisteredFulfillment(2, "http://two.local", services=[{"name": "sensors", "path": "/v2"}]))
+        index.update(RegisteredFulfillment(1, "http://one.local", services=["sensors", {"name": "weather"}]))
+
+        # Advertised by both, the lowest id is used
+        self.assertEqual(index.get("sensors").endpoint_base_url, "http://one.local")
+        self.assertEqual(index.get("weather").fulfillment_id, 1)
+
+        index.update(RegisteredFulfillment(1, "http://one.local", services=[]))
+        self.assertEqual(index.get("sensors").path, "/v2")
+        self.assertIsNone(index.get("weather"))
+
+        index.remove(2)
+        self.assertEqual(len(index), 0)
+
+
+class TestFulfillmentSync(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = await TemporaryDB().create()
+        async with self.db.sessionmaker() as session:
+            session.add_all([
+                Fulfillment(fulfillment_id=1, endpoint_base_url="http://one.local"),
+                Fulfillment(fulfillment_id=2, endpoint_base_url="http://down.local"),
+            ])
+            await session.commit()
+
+        self.fetches = []
+        self.in_flight = self.max_in_flight = 0
+        client = httpx.AsyncClient(transport=httpx.MockTransport(self.manifest))
+        self.registry = FulfillmentRegistry(self.db.sessionmaker)
+        self.scheduler = FulfillmentSyncScheduler(
+            self.db.sessionmaker, client_factory=lambda base_url: client, registry=self.registry
+        )
+
+    async def asyncTearDown(self):
+        await self.db.dispose()
+
+    async def manifest(self, request: httpx.Request) -> httpx.Response:
+        self.fetches.append(request)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        if request.url.host == "down.local":
+            raise httpx.ConnectError("Connection refused", request=request)
+        if request.headers.get("if-none-match") == '"v1"':
+            return httpx.Response(304)
+        manifest = {"friendly_name": "One", "services": [{"name": "sensors"}], "unknown": 1}
+        return httpx.Response(200, json=manifest, headers={"ETag": '"v1"'})
+
+    async def test_conditional_sync(self):
+        self.assertEqual(await self.scheduler.sync_all(), 1)
+        self.assertEqual(await self.scheduler.sync_all(), 0)
+
+        self.assertEqual(self.fetches[-2].headers["if-none-match"], '"v1"')
+        async with self.db.sessionmaker() as session:
+            one = await session.get(Fulfillment, 1)
+            down = await session.get(Fulfillment, 2)
+            self.assertEqual(one.friendly_name, "One")
+            self.assertEqual(one.services, [{"name": "sensors"}])
+            self.assertIsNotNone(one.time_last_sync)
+            self.assertIsNone(down.time_last_sync)
+        self.assertEqual(self.registry.get(1).friendly_name, "One")
+        self.assertEqual(self.registry.services.get("sensors").fulfillment_id, 1)
+
+    async def test_concurrency(self):
+        self.scheduler.concurrency = 1
+        await self.scheduler.sync_all(force=True)
+        self.assertEqual(len(self.fetches), 2)
+        self.assertEqual(self.max_in_flight, 1)
+        self.assertNotIn("if-none-match", self.fetches[0].headers)
+
+        self.scheduler.concurrency = 2
+        await self.scheduler.sync_all(force=True)
+        self.assertEqual(self.max_in_flight, 2)
+
+    async def test_changes_not_written(self):
+        async with self.db.sessionmaker() as session:
+            execute = session.execute
+
+            async def failing_execute(statement, *args, **kwargs):
+                if statement.is_dml:
+                    raise ConnectionResetError("Connection lost")
+                return await execute(statement, *args, **kwargs)
+
+            session.execute = failing_execute
+            with self.assertRaises(ConnectionResetError):
+                await self.scheduler.sync_all(session=session)
+
+        # The manifest is fetched again (not 304), and applied
+        self.assertEqual(await self.scheduler.sync_all(), 1)
+        self.assertNotIn("if-none-match", self.fetches[-2].headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import asyncio
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+
+import httpx
+from fastapi import FastAPI, Request
+
+from abotcore.fulfillment.cache import CachedResponse, DiskResponseStore, FulfillmentResponseCache, freshness
+
+
+class TestFulfillmentResponseCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.requests = []
+        self.cache_control = "max-age=60"
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    async def upstream(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        await asyncio.sleep(0.01)
+        if request.headers.get("if-none-match") == '"v1"':
+            return httpx.Response(304, headers={"ETag": '"v1"', "Cache-Control": self.cache_control})
+        body = b"reading %d" % len(self.requests)
+        headers = {"ETag": '"v1"', "Cache-Control": self.cache_control, "Content-Length": str(len(body))}
+        # Streamed, as from a connection
+        return httpx.Response(200, headers=headers, stream=httpx.ByteStream(body))
+
+    def create_client(self, cache: FulfillmentResponseCache) -> httpx.AsyncClient:
+        app = FastAPI()
+        upstream_client = httpx.AsyncClient(transport=httpx.MockTransport(self.upstream))
+
+        @app.get("/sensors")
+        async def sensors(request: Request):
+            return await cache.handle(upstream_client, "http://fulfillment.local/sensors", request)
+
+        return httpx.AsyncClient(app=app, base_url="http://test")
+
+    async def test_fresh_response_is_cached(self):
+        async with self.create_client(FulfillmentResponseCache()) as client:
+            first = await client.get("/sensors")
+            second = await client.get("/sensors")
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(second.content, first.content)
+        self.assertIn("age", second.headers)
+
+    async def test_concurrent_misses_coalesced(self):
+        async with self.create_client(FulfillmentResponseCache()) as client:
+            responses = await asyncio.gather(*[client.get("/sensors") for _ in range(5)])
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual({response.content for response in responses}, {b"reading 1"})
+
+    async def test_stale_response_revalidated(self):
+        self.cache_control = "no-cache"
+        async with self.create_client(FulfillmentResponseCache()) as client:
+            await client.get("/sensors")
+            second = await client.get("/sensors")
+
+        self.assertEqual(self.requests[1].headers["if-none-match"], '"v1"')
+        self.assertEqual(second.content, b"reading 1")
+
+    async def test_revalidated_in_background(self):
+        self.cache_control = "max-age=0, stale-while-revalidate=60"
+        cache = FulfillmentResponseCache()
+        async with self.create_client(cache) as client:
+            await client.get("/sensors")
+            second = await client.get("/sensors")
+            self.assertEqual(second.content, b"reading 1")
+            await asyncio.gather(*cache._revalidations.values())
+
+        self.assertEqual(len(self.requests), 2)
+
+    async def test_not_stored(self):
+        self.cache_control = "no-store"
+        async with self.create_client(FulfillmentResponseCache()) as client:
+            await client.get("/sensors")
+            second = await client.get("/sensors")
+
+        self.assertEqual(second.content, b"reading 2")
+
+    async def test_disk_tier(self):
+        async with self.create_client(FulfillmentResponseCache(disk=DiskResponseStore(self.directory.name))) as client:
+            await client.get("/sensors")
+        # e.g. after a restart
+        async with self.create_client(FulfillmentResponseCache(disk=DiskResponseStore(self.directory.name))) as client:
+            response = await client.get("/sensors")
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(response.content, b"reading 1")
+
+
+class TestDiskResponseStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def _entry(self, url: str) -> CachedResponse:
+        return CachedResponse(url=url, status_code=200, headers=[], body=b"x" * 100, stored_at=0, lifetime=60)
+
+    def test_concurrent_use(self):
+        store = DiskResponseStore(self.directory.name, max_bytes=1000)
+
+        def use(i: int):
+            key = "/sensors/%d" % (i % 20)
+            store.put(key, self._entry(key))
+            store.get(key)
+            if i % 3 == 0:
+                store.remove(key)
+
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(use, range(500)))
+
+        files = [name for name in os.listdir(self.directory.name) if name.endswith(".response")]
+        self.assertEqual(store.total_bytes, sum(store._index().values()))
+        self.assertLessEqual(store.total_bytes, 1000)
+        # (The index can list files removed concurrently, they are dropped once read)
+        self.assertLessEqual(set(files), set(store._index()))
+
+    def test_shared_directory(self):
+        store1 = DiskResponseStore(self.directory.name)
+        store2 = DiskResponseStore(self.directory.name)
+        self.assertIsNone(store2.get("/sensors"))
+        store1.put("/sensors", self._entry("/sensors"))
+        # Written by another worker
+        self.assertEqual(store2.get("/sensors"), self._entry("/sensors"))
+        self.assertEqual(store2.total_bytes, store1.total_bytes)
+
+
+class TestFreshness(unittest.TestCase):
+    def test_freshness(self):
+        self.assertEqual(freshness("public, max-age=60, s-maxage=30"), (30, None))
+        self.assertEqual(freshness("no-cache, stale-while-revalidate=5"), (0, 5))
+        self.assertEqual(freshness("private, max-age=60"), (None, None))
+        self.assertEqual(freshness(""), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
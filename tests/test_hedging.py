@@ -0,0 +1,66 @@
+import asyncio
+import unittest
+
+import httpx
+
+from abotcore.api import RequestPolicy, RetryBudget
+
+
+class TestRequestPolicy(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.sent = []
+
+    def _request(self, *replies):
+        """Request whose copies get the given (delay, status code) replies in order"""
+
+        async def _send():
+            delay, status_code = replies[len(self.sent)]
+            self.sent.append(status_code)
+            await asyncio.sleep(delay)
+            return httpx.Response(status_code, text=str(len(self.sent)))
+
+        return _send
+
+    async def test_hedge_answers_first(self):
+        policy = RequestPolicy(RetryBudget(min_per_second=100), hedging=True, hedge_min_delay=0.05)
+        await asyncio.sleep(0.05)
+
+        response = await policy.send("run", self._request((5, 200), (0, 201)))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.sent), 2)
+
+    async def test_no_hedge_without_budget(self):
+        policy = RequestPolicy(RetryBudget(ratio=0, min_per_second=0), hedging=True, hedge_min_delay=0.01)
+
+        response = await policy.send("run", self._request((0.1, 200), (0, 201)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.sent), 1)
+
+    async def test_retry_unavailable(self):
+        budget = RetryBudget(ratio=1, min_per_second=0)
+        policy = RequestPolicy(budget)
+
+        # The request itself adds enough budget for one retry
+        response = await policy.send("run", self._request((0, 503), (0, 200)))
+        self.assertEqual(response.status_code, 200)
+
+        self.sent.clear()
+        budget.ratio = 0
+        response = await policy.send("run", self._request((0, 503), (0, 200)))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(self.sent), 1)
+
+    async def test_broken_connection_not_retried(self):
+        policy = RequestPolicy(RetryBudget(ratio=1, min_per_second=0))
+
+        async def _send():
+            self.sent.append(None)
+            raise httpx.RemoteProtocolError("Server disconnected without sending a response")
+
+        with self.assertRaises(httpx.RemoteProtocolError):
+            await policy.send("run", _send)
+        self.assertEqual(len(self.sent), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
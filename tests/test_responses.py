@@ -0,0 +1,50 @@
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from abotcore.responses import FastJSONResponse
+
+
+class TestFastJSONResponse(unittest.TestCase):
+    def test_same_json_as_json_response(self):
+        contents = [
+            [{"text": "Hi é </script>\n ", "recipient_id": "user1", "buttons": [{"title": "a", "payload": ""}]}],
+            {"average": 144.5, "count": 7, "tiny": 2.5e-05, "huge": 1e17, "negative": -0.0},
+            {"flag": True, "none": None},
+            [{"text": "1e5 and 0.00001 as text"}],
+            {"big": 2 ** 70},
+        ]
+        for content in contents:
+            self.assertEqual(FastJSONResponse(content).body, JSONResponse(content).body)
+
+    def test_non_finite_floats_rejected(self):
+        for value in (float("nan"), float("inf")):
+            with self.assertRaises(ValueError):
+                FastJSONResponse([{"x": value}])
+
+    def test_other_types_are_encoded_like_jsonable_encoder(self):
+        content = {"time": datetime(2023, 1, 2, 3, 4, 5, 6000, tzinfo=timezone.utc)}
+        self.assertEqual(FastJSONResponse(content).body, JSONResponse(jsonable_encoder(content)).body)
+
+    def test_floats_of_encoded_objects(self):
+        class Point(BaseModel):
+            x: float
+            y: float
+
+        content = [Point(x=1e17, y=2.5e-05), Point(x=0.5, y=-3.0)]
+        self.assertEqual(FastJSONResponse(content).body, JSONResponse(jsonable_encoder(content)).body)
+
+    def test_strings_like_numbers_not_encoded_twice(self):
+        content = [{"id": "6f1e3a0e", "text": "1e5 null 0.00001", "score": 0.25}]
+        with mock.patch("abotcore.responses._json_dumps") as json_dumps:
+            body = FastJSONResponse(content).body
+        json_dumps.assert_not_called()
+        self.assertEqual(body, JSONResponse(content).body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import gzip
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from abotcore.staticfiles import IMMUTABLE_CACHE_CONTROL, CachingStaticFiles, parse_range
+
+DIGEST = "ab" * 32
+
+
+class TestCachingStaticFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.write("style.css", b"body { color: red; }\n" * 100)
+        self.write(DIGEST + ".png", bytes(range(256)))
+
+        app = FastAPI()
+        app.mount("/static", CachingStaticFiles(directory=self.directory.name), name="static")
+        self.client = TestClient(app)
+
+    def write(self, name: str, content: bytes):
+        with open(os.path.join(self.directory.name, name), "wb") as f:
+            f.write(content)
+
+    def test_not_modified(self):
+        response = self.client.get("/static/style.css", headers={"Accept-Encoding": "identity"})
+        etag = response.headers["etag"]
+        self.assertEqual(response.headers["cache-control"], "no-cache")
+
+        response = self.client.get(
+            "/static/style.css", headers={"Accept-Encoding": "identity", "If-None-Match": "W/%s" % etag}
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["etag"], etag)
+
+    def test_hidden_files(self):
+        self.write(".index.jsonl", b"{}\n")
+        self.client.get("/static/style.css", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(self.client.get("/static/.index.jsonl").status_code, 404)
+        self.assertEqual(self.client.get("/static/.compressed/style.css.gz").status_code, 404)
+
+    def test_content_addressed(self):
+        response = self.client.get("/static/%s.png" % DIGEST)
+        self.assertEqual(response.headers["etag"], '"%s"' % DIGEST)
+        self.assertEqual(response.headers["cache-control"], IMMUTABLE_CACHE_CONTROL)
+
+    def test_range(self):
+        url = "/static/%s.png" % DIGEST
+        response = self.client.get(url, headers={"Range": "bytes=10-19"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, bytes(range(10, 20)))
+        self.assertEqual(response.headers["content-range"], "bytes 10-19/256")
+
+        response = self.client.get(url, headers={"Range": "bytes=-6"})
+        self.assertEqual(response.content, bytes(range(250, 256)))
+
+        response = self.client.get(url, headers={"Range": "bytes=300-"})
+        self.assertEqual(response.status_code, 416)
+
+        # The file changed
+        response = self.client.get(url, headers={"Range": "bytes=10-19", "If-Range": '"other"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.content), 256)
+
+    def test_compressed_on_request(self):
+        response = self.client.get("/static/style.css", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertEqual(response.headers["vary"], "Accept-Encoding")
+        self.assertTrue(response.headers["etag"].endswith('-gzip"'))
+        self.assertEqual(response.content, b"body { color: red; }\n" * 100)
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, ".compressed", "style.css.gz")))
+
+    def test_precompressed_variant(self):
+        self.write("style.css.gz", gzip.compress(b"precompressed"))
+        response = self.client.get("/static/style.css", headers={"Accept-Encoding": "br;q=0, gzip"})
+        self.assertEqual(response.content, b"precompressed")
+
+
+class TestParseRange(unittest.TestCase):
+    def test_ignored(self):
+        self.assertIsNone(parse_range("bytes=0-1,4-5", 10))
+        self.assertIsNone(parse_range("items=0-1", 10))
+        self.assertIsNone(parse_range("bytes=5-2", 10))
+
+    def test_clamped(self):
+        self.assertEqual(parse_range("bytes=5-100", 10), (5, 9))
+        self.assertEqual(parse_range("bytes=-100", 10), (0, 9))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,20 @@
 
 from fastapi.testclient import TestClient
 
-from abotcore.coreapp import create_app
+from abotcore.statapiapp import create_app
 
+import asyncio
+import importlib.util
+import io
+import threading
 import unittest
 
+import pandas as pd
+from fastapi import HTTPException
+
+from abotcore.statistics.executor import StatisticsExecutor
+from abotcore.statistics.services import DataStatisticsService
+
 
 class TestStatisticsAggregation(unittest.TestCase):
     client = TestClient(create_app())
@@ -54,6 +64,82 @@ class TestStatisticsAggregation(unittest.TestCase):
             "count": 3
         })
 
+    def test_columns(self):
+        response = self.client.post(self.ENDPOINT, json={
+            "columns": {"y": [10, 20, 30]},
+            "method": ["average", "count"],
+            "aggregation_column": "y"
+        })
+
+        self.assertDictEqual(response.json(), {"average": 20, "count": 3})
+
+    def test_columns_of_different_lengths(self):
+        response = self.client.post(self.ENDPOINT, json={"columns": {"x": [1, 2], "y": [10, 20, 30]}})
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_csv(self):
+        response = self.client.post(
+            self.ENDPOINT,
+            params=[("method", "maximum"), ("method", "count"), ("aggregation_column", "y")],
+            content=b"t,y\n2023-01-01,10\n2023-01-02,20\n2023-01-03,30\n",
+            headers={"Content-Type": "text/csv"},
+        )
+
+        self.assertDictEqual(response.json(), {"maximum": 30, "count": 3})
+
+    def test_unsupported_media_type(self):
+        response = self.client.post(self.ENDPOINT, content=b"y=10", headers={"Content-Type": "text/plain"})
+
+        self.assertEqual(response.status_code, 415)
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    def test_parquet_outliers(self):
+        body = io.BytesIO()
+        pd.DataFrame({"y": [10, 11, 12, 11, 10, 100]}).to_parquet(body)
+
+        response = self.client.post(
+            "/statistics/outliers",
+            content=body.getvalue(),
+            headers={"Content-Type": "application/vnd.apache.parquet"},
+        )
+
+        self.assertEqual([record["y"] for record in response.json()], [100])
+
+
+class TestStatisticsExecutor(unittest.IsolatedAsyncioTestCase):
+    async def test_large_input_in_process(self):
+        executor = StatisticsExecutor(processes=1, process_min_size=8)
+        self.addCleanup(executor.shutdown)
+
+        result = await executor.run(
+            8, DataStatisticsService.aggregation_of_body, "text/csv", b"y\n1\n2\n3\n", "method=average"
+        )
+
+        self.assertEqual(result, {"average": 2})
+        self.assertIsNotNone(executor._process_pool)
+        self.assertIsNone(executor._thread_pool)
+
+        # Invalid bodies are errors of the request
+        with self.assertRaises(HTTPException) as e:
+            await executor.run(8, DataStatisticsService.aggregation_of_body, "text/plain", b"y=1,2,3")
+        self.assertEqual(e.exception.status_code, 415)
+
+    async def test_saturated(self):
+        executor = StatisticsExecutor(processes=0, threads=1, max_pending=2)
+        self.addCleanup(executor.shutdown)
+        release = threading.Event()
+        running = [asyncio.ensure_future(executor.run(1, release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+
+        with self.assertRaises(HTTPException) as e:
+            await executor.run(1, release.wait)
+        self.assertEqual(e.exception.status_code, 503)
+
+        release.set()
+        await asyncio.gather(*running)
+        self.assertEqual(executor.pending, 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,32 @@
+
+import os
+from tempfile import mkstemp
+
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from abotcore.db import Base, Session
+
+
+class TemporaryDB:
+    """Temporary SQLite DB with all tables (schemas are mapped to the default one)"""
+
+    def __init__(self):
+        fd, self.db_path = mkstemp(suffix=".sqlite3")
+        os.close(fd)
+        self.engine = create_async_engine(
+            "sqlite+aiosqlite:///%s" % self.db_path,
+            execution_options={"schema_translate_map": {"abot": None}},
+        )
+        self.sessionmaker = sessionmaker(
+            bind=self.engine, class_=Session, autoflush=False, future=True
+        )
+
+    async def create(self):
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        return self
+
+    async def dispose(self):
+        await self.engine.dispose()
+        os.remove(self.db_path)